@@ -0,0 +1,149 @@
+import asyncio
+import os
+import time
+from datetime import timezone
+from email.utils import formatdate, parsedate_to_datetime
+
+from db import Query
+
+# Кэш ответов /api/chat/{chat_id}: короткий TTL, объединение одновременных
+# запросов и версии статистики чата для ETag/Last-Modified. Версии хранятся в базе
+# и увеличиваются в сбросах счетчиков, поэтому процессы api без приема апдейтов
+# и несколько ingest-процессов видят одни и те же изменения.
+
+API_CACHE_TTL = float(os.getenv("API_CACHE_TTL", 30))
+API_CACHE_MAX_CHATS = int(os.getenv("API_CACHE_MAX_CHATS", 10000))
+# Ссылка на аватарку в ответе живет ограниченное время, поэтому ETag меняется хотя бы так часто
+API_ETAG_EPOCH = int(os.getenv("API_ETAG_EPOCH", 1800))
+
+CHAT_VERSIONS_SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS chat_versions (chat_id BIGINT PRIMARY KEY, version BIGINT NOT NULL, updated_at TIMESTAMP NOT NULL)''',
+]
+
+# Выполняется в сбросах счетчиков и реакций и после удаления данных чата
+BUMP_CHAT_VERSIONS = Query("chat_versions_bump", '''
+    INSERT INTO chat_versions (chat_id, version, updated_at)
+    SELECT c, 1, now() AT TIME ZONE 'utc' FROM unnest($1::bigint[]) AS c
+    ON CONFLICT (chat_id) DO UPDATE SET version = chat_versions.version + 1, updated_at = EXCLUDED.updated_at
+''')
+CHAT_VERSION = Query("chat_version", 'SELECT version, updated_at FROM chat_versions WHERE chat_id = $1')
+
+
+class ChatVersion:
+    """Версия статистики чата на момент запроса"""
+
+    def __init__(self, chat_id, version, changed_at):
+        self.chat_id = chat_id
+        self.version = version
+        # Ссылка на аватарку устаревает, поэтому ответ считается измененным хотя бы раз в эпоху
+        epoch = int(time.time()) // API_ETAG_EPOCH
+        self.epoch = epoch
+        self.modified_at = max(int(changed_at), epoch * API_ETAG_EPOCH)
+
+    @property
+    def etag(self):
+        return f'"{self.chat_id}-{self.version}-{self.modified_at}-{self.epoch}"'
+
+    @property
+    def last_modified(self):
+        return formatdate(self.modified_at, usegmt=True)
+
+    def headers(self):
+        return {"ETag": self.etag, "Last-Modified": self.last_modified, "Cache-Control": "no-cache"}
+
+    def not_modified(self, if_none_match, if_modified_since):
+        if if_none_match:
+            return self.etag in [tag.strip() for tag in if_none_match.split(",")]
+        if if_modified_since:
+            try:
+                since = parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+            return self.modified_at <= since
+        return False
+
+
+class ChatVersions:
+    """Версии статистики чатов из таблицы chat_versions"""
+
+    def __init__(self, pool=None):
+        self.pool = pool
+
+    async def get(self, chat_id):
+        async with self.pool.acquire() as conn:
+            row = await CHAT_VERSION.fetchrow(conn, chat_id)
+        if row is None:
+            return ChatVersion(chat_id, 0, 0)
+        return ChatVersion(chat_id, row['version'], row['updated_at'].replace(tzinfo=timezone.utc).timestamp())
+
+
+class ApiResponseCache:
+    def __init__(self, versions, ttl=API_CACHE_TTL, max_chats=API_CACHE_MAX_CHATS):
+        self.versions = versions
+        self.ttl = ttl
+        self.max_chats = max_chats
+        self.entries = {}   # chat_id -> {вариант (период): (версия, истекает, ответ)}
+        self._pending = {}  # (chat_id, вариант) -> future
+
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    async def get(self, chat_id, build, variant=None, version=None):
+        if version is None:
+            version = (await self.versions.get(chat_id)).version
+        entry = self.entries.get(chat_id, {}).get(variant)
+        if entry and entry[0] == version and entry[1] > time.monotonic():
+            self.hits += 1
+            return entry[2]
+
+        pending_key = (chat_id, variant)
+        future = self._pending.get(pending_key)
+        if future is not None:
+            self.coalesced += 1
+            return await asyncio.shield(future)
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._pending[pending_key] = future
+        try:
+            payload = await build()
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()
+            raise
+        else:
+            if len(self.entries) >= self.max_chats:
+                self.prune()
+            self.entries.setdefault(chat_id, {})[variant] = (version, time.monotonic() + self.ttl, payload)
+            future.set_result(payload)
+            return payload
+        finally:
+            # Отмененный запрос не должен оставлять ожидающих висеть на future
+            if not future.done():
+                future.cancel()
+            self._pending.pop(pending_key, None)
+
+    def invalidate(self, chat_ids):
+        # Версии в базе увеличил сброс; здесь только выбрасываем локальные ответы
+        for chat_id in chat_ids:
+            self.entries.pop(chat_id, None)
+
+    def prune(self):
+        now = time.monotonic()
+        entries = {}
+        for chat_id, variants in self.entries.items():
+            variants = {k: v for k, v in variants.items() if v[1] > now}
+            if variants:
+                entries[chat_id] = variants
+        self.entries = entries
+        while len(self.entries) >= self.max_chats:
+            self.entries.pop(next(iter(self.entries)))
+
+    def stats(self):
+        return {
+            "entries": sum(len(v) for v in self.entries.values()),
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+        }
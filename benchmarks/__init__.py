@@ -0,0 +1,2 @@
+# Бенчмарки горячих путей: разбор текста, прием сообщений в Postgres, /stats и рендеринг.
+# Запуск: python -m benchmarks --help
@@ -0,0 +1,96 @@
+import argparse
+import json
+import os
+import sys
+
+from benchmarks import report
+
+# python -m benchmarks                                  - разбор текста и рендеринг
+# BENCH_DATABASE_URL=postgresql://... python -m benchmarks --only ingest,stats
+# python -m benchmarks --out new.json --baseline base.json
+# python -m benchmarks record-updates updates.jsonl 50000
+
+SUITES = ("text", "render", "ingest", "stats")
+
+
+def _run_suites(args):
+    only = set(args.only.split(",")) if args.only else set(SUITES)
+    unknown = only - set(SUITES)
+    if unknown:
+        raise SystemExit(f"Неизвестные бенчмарки: {', '.join(sorted(unknown))}")
+    database_url = os.getenv("BENCH_DATABASE_URL")
+
+    results = {}
+    skipped = {}
+    if "text" in only:
+        from benchmarks import text
+        print("⏱ text...", file=sys.stderr)
+        results["text"] = text.run(args.size, args.seed)
+    if "render" in only:
+        from benchmarks import render
+        print("⏱ render...", file=sys.stderr)
+        results["render"] = render.run(args.repeats)
+    # Бенчмарки с базой пишут в таблицы бота, поэтому нужна отдельная база, а не DATABASE_URL
+    for name in ("ingest", "stats"):
+        if name not in only:
+            continue
+        if not database_url:
+            skipped[name] = "не задан BENCH_DATABASE_URL"
+            continue
+        print(f"⏱ {name}...", file=sys.stderr)
+        if name == "ingest":
+            from benchmarks import ingest
+            results["ingest"] = ingest.run(database_url, args.size, args.seed, args.updates)
+        else:
+            from benchmarks import stats
+            results["stats"] = stats.run(database_url, min(args.size, 5000), args.requests, args.seed, args.telegram_latency)
+    return {"environment": report.environment(), "params": vars(args), "results": results, "skipped": skipped}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks")
+    parser.add_argument("command", nargs="?", default="run", choices=("run", "record-updates"))
+    parser.add_argument("path", nargs="?", help="record-updates: куда записать апдейты")
+    parser.add_argument("count", nargs="?", type=int, default=20000, help="record-updates: сколько апдейтов")
+    parser.add_argument("--only", help=f"через запятую: {', '.join(SUITES)}")
+    parser.add_argument("--size", type=int, default=20000, help="число сообщений в корпусе")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--repeats", type=int, default=5, help="повторов рендера каждой карточки")
+    parser.add_argument("--requests", type=int, default=50, help="запросов /stats в каждом режиме")
+    parser.add_argument("--telegram-latency", type=float, default=0.05, help="задержка ответа Bot API, с")
+    parser.add_argument("--updates", help="JSONL с записанными апдейтами вместо синтетического корпуса")
+    parser.add_argument("--out", help="файл для результатов (по умолчанию stdout)")
+    parser.add_argument("--baseline", help="результаты прошлого прогона для сравнения")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="допустимое отклонение от базового прогона")
+    args = parser.parse_args(argv)
+
+    if args.command == "record-updates":
+        if not args.path:
+            parser.error("укажите файл: python -m benchmarks record-updates updates.jsonl [count]")
+        from benchmarks.corpus import write_updates
+        write_updates(args.path, args.count, seed=args.seed)
+        print(f"✅ Записано апдейтов: {args.count} -> {args.path}", file=sys.stderr)
+        return 0
+
+    output = _run_suites(args)
+    payload = json.dumps(output, ensure_ascii=False, indent=2)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(payload + "\n")
+    else:
+        print(payload)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            changes = report.compare(output, json.load(f), args.tolerance)
+        if changes:
+            print(report.format_changes(changes), file=sys.stderr)
+        else:
+            print(f"✅ Отличий от базового прогона больше {args.tolerance:.0%} нет", file=sys.stderr)
+        # Ненулевой код, если что-то стало хуже - удобно для CI
+        return 1 if any(worse for *_, worse in changes) else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,162 @@
+import io
+import json
+import random
+import subprocess
+import time
+
+import imageio_ffmpeg
+from PIL import Image, ImageDraw
+
+# Воспроизводимые синтетические данные: русский чат с распределением слов по Ципфу,
+# апдейты Telegram в том же JSON, что присылает Bot API, аватарки и webm-стикеры.
+
+STEMS = [
+    "привет", "работа", "сегодня", "завтра", "вечер", "утро", "кофе", "проект", "задача", "встреча",
+    "машина", "город", "погода", "дождь", "солнце", "музыка", "фильм", "книга", "игра", "команда",
+    "друг", "подруга", "семья", "мама", "папа", "кошка", "собака", "дом", "квартира", "магазин",
+    "деньги", "зарплата", "отпуск", "море", "горы", "поезд", "самолет", "билет", "праздник", "подарок",
+    "телефон", "компьютер", "интернет", "сервер", "база", "данные", "ошибка", "релиз", "тест", "код",
+    "думать", "сделать", "написать", "прочитать", "посмотреть", "купить", "приехать", "уехать", "работать", "играть",
+    "хороший", "плохой", "новый", "старый", "большой", "маленький", "быстрый", "медленный", "красивый", "смешной",
+]
+FILLERS = ["и", "в", "не", "на", "что", "как", "это", "уже", "очень", "ну", "вот", "да"]
+EMOJI = ["😂", "👍", "🔥", "❤️", "🤔", ")", "))", "!", "?", "..."]
+NAMES = ["Анна", "Иван", "Мария", "Дмитрий", "Ольга", "Сергей", "Екатерина", "Алексей", "Наталья", "Павел"]
+
+
+def _word_forms(stems):
+    """Настоящие словоформы (падежи, спряжения), как в живом чате; без pymorphy3 - только основы"""
+    try:
+        from pymorphy3 import MorphAnalyzer
+    except ImportError:
+        return list(stems)
+    morph = MorphAnalyzer()
+    forms = []
+    for stem in stems:
+        forms += sorted({form.word for form in morph.parse(stem)[0].lexeme})[:12]
+    return forms
+
+
+def _zipf_weights(n, s=1.1):
+    return [1 / (rank ** s) for rank in range(1, n + 1)]
+
+
+class ChatCorpus:
+    """Поток сообщений нескольких чатов; одинаковый seed - одинаковые данные"""
+
+    def __init__(self, chats=10, users_per_chat=30, seed=42):
+        self.random = random.Random(seed)
+        self.chats = [-1000000000000 - i for i in range(chats)]
+        self.users = {
+            chat_id: [(100000 + chat_index * 1000 + i, f"{self.random.choice(NAMES)} {i}") for i in range(users_per_chat)]
+            for chat_index, chat_id in enumerate(self.chats)
+        }
+        self.vocabulary = _word_forms(STEMS)
+        self.random.shuffle(self.vocabulary)
+        self.word_weights = _zipf_weights(len(self.vocabulary))
+        self.user_weights = _zipf_weights(users_per_chat, 0.8)
+        self.chat_weights = _zipf_weights(chats, 0.6)
+        self.message_ids = {chat_id: 0 for chat_id in self.chats}
+
+    def text(self):
+        length = max(1, int(self.random.expovariate(1 / 8)))
+        words = self.random.choices(self.vocabulary, self.word_weights, k=length)
+        for _ in range(length // 3):
+            words.insert(self.random.randrange(len(words) + 1), self.random.choice(FILLERS))
+        text = " ".join(words)
+        if self.random.random() < 0.3:
+            text += " " + self.random.choice(EMOJI)
+        return text.capitalize()
+
+    def messages(self, count):
+        """(chat_id, message_id, user_id, имя, текст)"""
+        for _ in range(count):
+            chat_id = self.random.choices(self.chats, self.chat_weights)[0]
+            user_id, name = self.random.choices(self.users[chat_id], self.user_weights)[0]
+            self.message_ids[chat_id] += 1
+            yield chat_id, self.message_ids[chat_id], user_id, name, self.text()
+
+
+def make_update(update_id, chat_id, message_id, user_id, name, text, date=None):
+    """Апдейт с текстовым сообщением в группе, как его присылает Bot API"""
+    first_name, _, last_name = name.partition(" ")
+    sender = {"id": user_id, "is_bot": False, "first_name": first_name}
+    if last_name:
+        sender["last_name"] = last_name
+    message = {
+        "message_id": message_id,
+        "from": sender,
+        "chat": {"id": chat_id, "type": "supergroup", "title": f"Бенчмарк {chat_id}"},
+        "date": int(date or time.time()),
+        "text": text,
+    }
+    if text.startswith("/"):
+        command = text.split()[0]
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(command)}]
+    return {"update_id": update_id, "message": message}
+
+
+def make_updates(corpus, count, first_update_id=1):
+    for update_id, (chat_id, message_id, user_id, name, text) in enumerate(corpus.messages(count), first_update_id):
+        yield make_update(update_id, chat_id, message_id, user_id, name, text)
+
+
+def write_updates(path, count, chats=10, seed=42):
+    """Записывает апдейты в JSONL, чтобы прогонять один и тот же поток между версиями"""
+    with open(path, "w", encoding="utf-8") as f:
+        for update in make_updates(ChatCorpus(chats=chats, seed=seed), count):
+            f.write(json.dumps(update, ensure_ascii=False) + "\n")
+
+
+def read_updates(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def make_avatar(size=640, seed=0):
+    """PNG-аватарка: градиент с кругами, чтобы сжатие и ресайз работали как с фото"""
+    rng = random.Random(seed)
+    img = Image.new("RGB", (size, size))
+    draw = ImageDraw.Draw(img)
+    top, bottom = [rng.randrange(256) for _ in range(3)], [rng.randrange(256) for _ in range(3)]
+    for y in range(size):
+        t = y / size
+        draw.line([(0, y), (size, y)], fill=tuple(int(a + (b - a) * t) for a, b in zip(top, bottom)))
+    for _ in range(20):
+        x, y, r = rng.randrange(size), rng.randrange(size), rng.randrange(10, size // 4)
+        draw.ellipse([x - r, y - r, x + r, y + r], fill=tuple(rng.randrange(256) for _ in range(3)))
+    out = io.BytesIO()
+    img.save(out, format="PNG")
+    return out.getvalue()
+
+
+def make_sticker_png(size=512, seed=0):
+    """Статичный стикер с прозрачностью"""
+    rng = random.Random(seed)
+    img = Image.new("RGBA", (size, size), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(img)
+    draw.ellipse([size // 8, size // 8, size * 7 // 8, size * 7 // 8], fill=tuple(rng.randrange(256) for _ in range(3)) + (255,))
+    out = io.BytesIO()
+    img.save(out, format="WEBP")
+    return out.getvalue()
+
+
+def make_webm_sticker(size=512, seconds=3.0, fps=30, seed=0):
+    """Видео-стикер как в Telegram: VP9 с альфа-каналом, 512x512, до 3 секунд"""
+    rng = random.Random(seed)
+    color = tuple(rng.randrange(256) for _ in range(3))
+    cmd = [imageio_ffmpeg.get_ffmpeg_exe(), "-hide_banner", "-loglevel", "error",
+           "-f", "rawvideo", "-pix_fmt", "rgba", "-s", f"{size}x{size}", "-r", str(fps), "-i", "pipe:0",
+           "-c:v", "libvpx-vp9", "-pix_fmt", "yuva420p", "-b:v", "400k", "-deadline", "realtime", "-f", "webm", "pipe:1"]
+    frames = []
+    for i in range(int(seconds * fps)):
+        img = Image.new("RGBA", (size, size), (0, 0, 0, 0))
+        draw = ImageDraw.Draw(img)
+        r = size // 4 + int(size // 8 * ((i % fps) / fps))
+        c = size // 2
+        draw.ellipse([c - r, c - r, c + r, c + r], fill=color + (255,))
+        frames.append(img.tobytes())
+    result = subprocess.run(cmd, input=b"".join(frames), stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=False)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.decode("utf-8", "replace").strip())
+    return result.stdout
@@ -0,0 +1,116 @@
+import asyncio
+import importlib
+import itertools
+import logging
+import os
+import time
+
+from aiogram import types
+from aiogram.client.session.base import BaseSession
+from aiogram.methods import GetChatMember, GetFile, GetMe, GetUserProfilePhotos, SendMediaGroup, SendMessage
+
+from benchmarks.corpus import make_avatar, make_sticker_png
+
+# Запуск bot.py внутри бенчмарка: настоящая база (отдельная, из BENCH_DATABASE_URL),
+# настоящие обработчики и рендеринг, а вместо Bot API - сессия с фиксированной задержкой.
+
+BENCH_BOT_ID = 1
+BENCH_TOKEN = "123456:BENCHMARK"
+
+
+class MockSession(BaseSession):
+    """Ответы Bot API без сети: отправка возвращает сообщения, аватарки и стикеры - синтетические"""
+
+    def __init__(self, latency=0.05):
+        super().__init__()
+        self.latency = latency
+        self.calls = {}
+        self._ids = itertools.count(1)
+        self.avatar = make_avatar()
+        self.sticker = make_sticker_png()
+
+    def _message(self, chat_id, **fields):
+        return types.Message(message_id=next(self._ids), date=int(time.time()),
+                             chat=types.Chat(id=chat_id, type="supergroup"), **fields)
+
+    def _photo(self):
+        n = next(self._ids)
+        return types.PhotoSize(file_id=f"bench-photo-{n}", file_unique_id=f"bench-photo-{n}", width=640, height=640)
+
+    async def make_request(self, bot, method, timeout=None):
+        name = method.__api_method__
+        self.calls[name] = self.calls.get(name, 0) + 1
+        await asyncio.sleep(self.latency)
+        if isinstance(method, SendMediaGroup):
+            return [self._message(method.chat_id, photo=[self._photo()]) for _ in method.media]
+        if isinstance(method, SendMessage):
+            return self._message(method.chat_id, text=method.text)
+        if isinstance(method, GetUserProfilePhotos):
+            return types.UserProfilePhotos(total_count=1, photos=[[types.PhotoSize(
+                file_id=f"avatar-{method.user_id}", file_unique_id=f"avatar-{method.user_id}", width=640, height=640,
+            )]])
+        if isinstance(method, GetFile):
+            extension = "jpg" if method.file_id.startswith("avatar-") else "webp"
+            return types.File(file_id=method.file_id, file_unique_id=method.file_id, file_path=f"bench/{method.file_id}.{extension}")
+        if isinstance(method, GetMe):
+            return types.User(id=BENCH_BOT_ID, is_bot=True, first_name="Benchmark")
+        if isinstance(method, GetChatMember):
+            # Бот не администратор: титулы не выдаются, но проверка прав проходит целиком
+            return types.ChatMemberMember(user=types.User(id=method.user_id, is_bot=False, first_name="User"))
+        return True
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        await asyncio.sleep(self.latency)
+        yield self.avatar if url.endswith(".jpg") else self.sticker
+
+    async def close(self):
+        pass
+
+
+def load_bot(database_url, latency=0.05):
+    """Импортирует bot.py с базой бенчмарка и сессией-заглушкой"""
+    os.environ["DATABASE_URL"] = database_url
+    os.environ.setdefault("BOT_TOKEN", BENCH_TOKEN)
+    # Меряем свой код, а не лимиты Telegram на чат
+    os.environ.setdefault("TELEGRAM_CHAT_RATE", "1000")
+    os.environ.setdefault("TELEGRAM_CHAT_BURST", "1000")
+    os.environ.setdefault("TELEGRAM_GLOBAL_RATE", "1000")
+    os.environ.setdefault("TELEGRAM_GLOBAL_BURST", "1000")
+    bot_module = importlib.import_module("bot")
+    logging.getLogger("aiogram").setLevel(logging.WARNING)
+
+    session = MockSession(latency)
+    session.middleware(bot_module.telegram_limiter)
+    bot_module.bot.session = session
+    return bot_module, session
+
+
+async def start(bot_module, render=False):
+    await bot_module.init_db_pool()
+    if not bot_module.db_pool:
+        raise RuntimeError("Не удалось подключиться к базе бенчмарка")
+    bot_module.text_service = bot_module.TextAnalysisService()
+    bot_module.text_service.start()
+    if render:
+        bot_module.render_service = bot_module.RenderService()
+        bot_module.render_service.start()
+
+
+async def stop(bot_module):
+    if bot_module.text_service:
+        await bot_module.text_service.stop()
+    if bot_module.render_service:
+        await bot_module.render_service.stop()
+    if bot_module.db_pool:
+        await bot_module.db_pool.close()
+
+
+async def cleanup(bot_module, chat_ids):
+    """Удаляет данные чатов бенчмарка из всех таблиц"""
+    from chat_purge import PURGE_TABLES
+
+    async with bot_module.db_pool.acquire() as conn:
+        for table in PURGE_TABLES:
+            await conn.execute(f'DELETE FROM {table} WHERE chat_id = ANY($1::bigint[])', list(chat_ids))
+    for chat_id in chat_ids:
+        bot_module.leaderboards.forget(chat_id)
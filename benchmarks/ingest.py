@@ -0,0 +1,66 @@
+import asyncio
+import time
+
+from aiogram import types
+
+from benchmarks import harness
+from benchmarks.corpus import ChatCorpus, make_updates, read_updates
+from benchmarks.report import peak_rss_mb
+
+# Прием сообщений: апдейты проходят через dp.feed_update (фильтры, разбор текста, буфер),
+# в конце буфер сбрасывается в Postgres. Параллельность - как у обработчиков aiogram.
+
+INGEST_CONCURRENCY = 100
+
+
+async def ingest(bot_module, updates, concurrency=INGEST_CONCURRENCY):
+    """Скармливает апдейты боту и ждет записи в базу; возвращает длительность в секундах"""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def feed(update):
+        async with semaphore:
+            await bot_module.dp.feed_update(bot_module.bot, update)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(feed(update) for update in updates))
+    fed = time.perf_counter() - started
+    await bot_module.stats_buffer.flush()
+    return fed, time.perf_counter() - started
+
+
+def parse_updates(bot_module, raw_updates):
+    return [types.Update.model_validate(raw, context={"bot": bot_module.bot}) for raw in raw_updates]
+
+
+async def _run(database_url, size, seed, updates_path, keep):
+    bot_module, _ = harness.load_bot(database_url)
+    await harness.start(bot_module)
+    try:
+        raw = read_updates(updates_path) if updates_path else list(make_updates(ChatCorpus(seed=seed), size))
+        updates = parse_updates(bot_module, raw)
+        chat_ids = {u.message.chat.id for u in updates if u.message}
+        await harness.cleanup(bot_module, chat_ids)
+
+        fed, total = await ingest(bot_module, updates)
+        metrics = bot_module.stats_buffer.metrics()
+        result = {
+            "messages": len(updates),
+            "chats": len(chat_ids),
+            "messages_per_sec": round(len(updates) / total, 1),
+            "handlers_messages_per_sec": round(len(updates) / fed, 1),
+            "total_seconds": round(total, 3),
+            "flush_count": metrics["flush_count"],
+            "flush_errors": metrics["flush_errors"],
+            "max_flush_lag_seconds": metrics["max_flush_lag_seconds"],
+            "text_analysis_dropped": bot_module.text_service.dropped,
+            "peak_rss_mb": peak_rss_mb(),
+        }
+        if not keep:
+            await harness.cleanup(bot_module, chat_ids)
+        return result
+    finally:
+        await harness.stop(bot_module)
+
+
+def run(database_url, size=20000, seed=42, updates_path=None, keep=False):
+    return asyncio.run(_run(database_url, size, seed, updates_path, keep))
@@ -0,0 +1,64 @@
+import multiprocessing
+import statistics
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from benchmarks.corpus import make_avatar, make_sticker_png, make_webm_sticker
+from benchmarks.report import peak_rss_mb, reset_peak_rss
+
+# Рендеринг карточек и перекодирование видео-стикера. Каждый шаблон меряется в отдельном
+# свежем процессе, чтобы пиковая память (RSS) относилась только к нему.
+
+
+def _cases():
+    top_words = [("привет", 1523), ("работа", 987), ("сегодня", 654)]
+    return {
+        "active": ("active", (make_avatar(), 12345, "Екатерина Великолепная")),
+        "active_no_avatar": ("active", (None, 12345, "Екатерина Великолепная")),
+        "words": ("words", (top_words,)),
+        "sticker": ("sticker", (make_sticker_png(), 321)),
+        "sticker_video": ("sticker_video", (make_webm_sticker(), 321)),
+        "reactions": ("reactions", ("Кто-нибудь видел мои ключи? Оставлял их на столе у кофемашины утром", "Екатерина Великолепная", 48)),
+    }
+
+
+def _measure(template, args, repeats):
+    import main_draw
+    from render_service import RENDERERS
+
+    started = time.perf_counter()
+    main_draw.assets.preload()
+    preload = time.perf_counter() - started
+    rss_before = peak_rss_mb()
+    reset_peak_rss()
+
+    samples = []
+    size = 0
+    for _ in range(repeats):
+        started = time.perf_counter()
+        result = RENDERERS[template](*args)
+        data = result.read() if result else b""
+        samples.append(time.perf_counter() - started)
+        size = len(data)
+    return {
+        "first_ms": round(samples[0] * 1000, 3),
+        "median_ms": round(statistics.median(samples) * 1000, 3),
+        "min_ms": round(min(samples) * 1000, 3),
+        "output_bytes": size,
+        "assets_preload_seconds": round(preload, 3),
+        "rss_after_preload_mb": rss_before,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def run(repeats=5, only=None):
+    results = {}
+    context = multiprocessing.get_context("spawn")
+    for name, (template, args) in _cases().items():
+        if only and name not in only:
+            continue
+        # Видео перекодируется заметно дольше, хватит меньшего числа повторов
+        case_repeats = max(1, repeats // 2) if template == "sticker_video" else repeats
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            results[name] = executor.submit(_measure, template, args, case_repeats).result()
+    return results
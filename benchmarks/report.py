@@ -0,0 +1,106 @@
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+
+# Результаты бенчмарков в JSON и сравнение с базовым прогоном.
+# Направление метрики определяется суффиксом: *_per_sec - чем больше, тем лучше;
+# *_ms, *_seconds, *_mb, *_bytes - чем меньше, тем лучше; остальные не сравниваются.
+
+HIGHER_IS_BETTER = ("_per_sec",)
+LOWER_IS_BETTER = ("_ms", "_seconds", "_mb", "_bytes")
+
+
+def percentiles(samples, points=(50, 90, 99)):
+    """{'p50_ms': ..., 'p99_ms': ...} по выборке длительностей в секундах"""
+    if not samples:
+        return {}
+    ordered = sorted(samples)
+    result = {}
+    for point in points:
+        index = min(len(ordered) - 1, max(0, round(point / 100 * len(ordered)) - 1))
+        result[f"p{point}_ms"] = round(ordered[index] * 1000, 3)
+    result["max_ms"] = round(ordered[-1] * 1000, 3)
+    return result
+
+
+def peak_rss_mb():
+    """Пиковая память процесса; в Linux - VmHWM, который можно сбросить reset_peak_rss()"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    # ru_maxrss в Linux в килобайтах, в macOS в байтах; сохраняется через exec
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def reset_peak_rss():
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def environment():
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "commit": _git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def _direction(metric):
+    if metric.endswith(HIGHER_IS_BETTER):
+        return 1
+    if metric.endswith(LOWER_IS_BETTER):
+        return -1
+    return 0
+
+
+def _flatten(results, prefix=""):
+    for key, value in results.items():
+        name = f"{prefix}.{key}" if prefix else key
+        if isinstance(value, dict):
+            yield from _flatten(value, name)
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield name, key, value
+
+
+def compare(current, baseline, tolerance=0.1):
+    """Изменения метрик относительно базового прогона: [(метрика, было, стало, изменение, хуже ли)]"""
+    old = {name: value for name, _, value in _flatten(baseline.get("results", {}))}
+    changes = []
+    for name, key, value in _flatten(current.get("results", {})):
+        direction = _direction(key)
+        if not direction or name not in old or not old[name]:
+            continue
+        change = (value - old[name]) / abs(old[name])
+        if abs(change) <= tolerance:
+            continue
+        changes.append((name, old[name], value, change, change * direction < 0))
+    return changes
+
+
+def format_changes(changes):
+    lines = []
+    for name, old, new, change, worse in sorted(changes, key=lambda c: (not c[4], c[0])):
+        mark = "🔴" if worse else "🟢"
+        lines.append(f"{mark} {name}: {old} -> {new} ({change:+.1%})")
+    return "\n".join(lines)
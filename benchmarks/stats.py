@@ -0,0 +1,61 @@
+import asyncio
+import time
+
+from benchmarks import harness
+from benchmarks.corpus import ChatCorpus, make_update, make_updates
+from benchmarks.ingest import ingest, parse_updates
+from benchmarks.report import peak_rss_mb, percentiles
+from render_cache import RenderCache
+from media_cache import MediaCache
+
+# Задержка /stats от апдейта до отправки последнего сообщения при Bot API с фиксированной
+# задержкой. cold - кэши карточек и медиа сбрасываются перед каждым запросом (полный рендер),
+# warm - данные не менялись и карточки берутся из кэша.
+
+
+async def _measure(bot_module, chat_ids, requests, cold):
+    samples = []
+    for i in range(requests):
+        chat_id = chat_ids[i % len(chat_ids)]
+        if cold:
+            bot_module.render_cache = RenderCache(disk_dir=None)
+            bot_module.media_cache = MediaCache(bot_module.bot, disk_dir=None)
+        update = parse_updates(bot_module, [make_update(10 ** 9 + i, chat_id, 10 ** 6 + i, 100000, "Бенчмарк", "/stats")])[0]
+        started = time.perf_counter()
+        await bot_module.dp.feed_update(bot_module.bot, update)
+        samples.append(time.perf_counter() - started)
+    return samples
+
+
+async def _run(database_url, size, requests, seed, latency):
+    bot_module, session = harness.load_bot(database_url, latency)
+    await harness.start(bot_module, render=True)
+    try:
+        corpus = ChatCorpus(seed=seed)
+        updates = parse_updates(bot_module, list(make_updates(corpus, size)))
+        chat_ids = sorted({u.message.chat.id for u in updates})
+        await harness.cleanup(bot_module, chat_ids)
+        await ingest(bot_module, updates)
+        for chat_id in chat_ids:
+            bot_module.stats_buffer.add_sticker(chat_id, f"sticker-{chat_id}", f"sticker-{chat_id}")
+        await bot_module.stats_buffer.flush()
+
+        result = {"telegram_latency_ms": latency * 1000, "requests": requests}
+        for mode, cold in (("cold", True), ("warm", False)):
+            samples = await _measure(bot_module, chat_ids, requests, cold)
+            result[mode] = percentiles(samples)
+        result["telegram_calls"] = dict(session.calls)
+        result["render_service"] = {
+            "completed": bot_module.render_service.completed,
+            "deduplicated": bot_module.render_service.deduplicated,
+        }
+        result["peak_rss_mb"] = peak_rss_mb()
+
+        await harness.cleanup(bot_module, chat_ids)
+        return result
+    finally:
+        await harness.stop(bot_module)
+
+
+def run(database_url, size=5000, requests=50, seed=42, latency=0.05):
+    return asyncio.run(_run(database_url, size, requests, seed, latency))
@@ -0,0 +1,56 @@
+import time
+
+from benchmarks.corpus import ChatCorpus
+from text_analysis import Lemmatizer, tokenize
+
+# Разбор текста: токенизация и лемматизация с пустым и прогретым кэшем.
+# Быстрые проходы повторяются, в результат идет лучший из них.
+
+REPEATS = 3
+
+
+def _throughput(count, elapsed):
+    return round(count / elapsed, 1) if elapsed else None
+
+
+def _best(fn):
+    elapsed = []
+    for _ in range(REPEATS):
+        started = time.perf_counter()
+        fn()
+        elapsed.append(time.perf_counter() - started)
+    return min(elapsed)
+
+
+def run(size=20000, seed=42):
+    texts = [text for *_, text in ChatCorpus(seed=seed).messages(size)]
+
+    tokens = sum(len(tokenize(text)) for text in texts)
+    tokenize_elapsed = _best(lambda: [tokenize(text) for text in texts])
+
+    started = time.perf_counter()
+    lemmatizer = Lemmatizer()
+    init_elapsed = time.perf_counter() - started
+
+    started = time.perf_counter()
+    lemmatizer.analyze_many(texts)
+    cold_elapsed = time.perf_counter() - started
+    misses = lemmatizer.misses
+
+    warm_elapsed = _best(lambda: lemmatizer.analyze_many(texts))
+
+    return {
+        "messages": size,
+        "tokens": tokens,
+        "tokenize": {"messages_per_sec": _throughput(size, tokenize_elapsed)},
+        "lemmatizer_init_seconds": round(init_elapsed, 3),
+        "cold_cache": {
+            "messages_per_sec": _throughput(size, cold_elapsed),
+            "tokens_per_sec": _throughput(tokens, cold_elapsed),
+            "unique_tokens": misses,
+        },
+        "warm_cache": {
+            "messages_per_sec": _throughput(size, warm_elapsed),
+            "tokens_per_sec": _throughput(tokens, warm_elapsed),
+        },
+    }
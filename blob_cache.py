@@ -0,0 +1,139 @@
+import os
+import time
+from collections import OrderedDict
+from log import get_logger
+
+logger = get_logger(__name__)
+
+# Двухуровневый кэш байтов: LRU в памяти с лимитом по объему и необязательный
+# каталог на диске с вытеснением самых старых файлов и сроком жизни записей.
+
+
+class BlobCache:
+    def __init__(self, max_bytes, disk_dir=None, disk_max_bytes=0, ttl=None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.memory = OrderedDict()  # ключ -> (байты, время записи)
+        self.memory_bytes = 0
+
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self.disk_index = OrderedDict()  # ключ -> (размер, время записи), от старых к новым
+        self.disk_bytes = 0
+        if disk_dir:
+            self._load_disk_index()
+
+        self.hits = {"memory": 0, "disk": 0}
+        self.misses = 0
+
+    def _expired(self, created):
+        return self.ttl is not None and time.time() - created > self.ttl
+
+    # --- дисковый уровень ---
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, key[:2], key + ".bin")
+
+    def _load_disk_index(self):
+        entries = []
+        for root, _, files in os.walk(self.disk_dir):
+            for name in files:
+                if not name.endswith(".bin"):
+                    continue
+                st = os.stat(os.path.join(root, name))
+                entries.append((st.st_mtime, name[:-4], st.st_size))
+        for mtime, key, size in sorted(entries):
+            self.disk_index[key] = (size, mtime)
+            self.disk_bytes += size
+
+    def _disk_remove(self, key):
+        size, _ = self.disk_index.pop(key)
+        self.disk_bytes -= size
+        try:
+            os.unlink(self._disk_path(key))
+        except OSError:
+            pass
+
+    def _disk_get(self, key):
+        entry = self.disk_index.get(key)
+        if entry is None:
+            return None
+        if self._expired(entry[1]):
+            self._disk_remove(key)
+            return None
+        try:
+            with open(self._disk_path(key), "rb") as f:
+                data = f.read()
+        except OSError:
+            self.disk_bytes -= self.disk_index.pop(key)[0]
+            return None
+        self.disk_index.move_to_end(key)
+        return data
+
+    def _disk_put(self, key, data):
+        path = self._disk_path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning("Не удалось записать кэш на диск: %s", e)
+            return
+        if key in self.disk_index:
+            self.disk_bytes -= self.disk_index.pop(key)[0]
+        self.disk_index[key] = (len(data), time.time())
+        self.disk_bytes += len(data)
+        while self.disk_bytes > self.disk_max_bytes and len(self.disk_index) > 1:
+            self._disk_remove(next(iter(self.disk_index)))
+
+    # --- память ---
+
+    def _memory_put(self, key, data, created):
+        if len(data) > self.max_bytes:
+            return
+        if key in self.memory:
+            self.memory_bytes -= len(self.memory.pop(key)[0])
+        self.memory[key] = (data, created)
+        self.memory_bytes += len(data)
+        while self.memory_bytes > self.max_bytes:
+            _, (old, _) = self.memory.popitem(last=False)
+            self.memory_bytes -= len(old)
+
+    def get(self, key):
+        entry = self.memory.get(key)
+        if entry is not None:
+            if not self._expired(entry[1]):
+                self.memory.move_to_end(key)
+                self.hits["memory"] += 1
+                return entry[0]
+            self.memory_bytes -= len(self.memory.pop(key)[0])
+        if self.disk_dir:
+            data = self._disk_get(key)
+            if data is not None:
+                self.hits["disk"] += 1
+                self._memory_put(key, data, self.disk_index[key][1])
+                return data
+        self.misses += 1
+        return None
+
+    def put(self, key, data):
+        now = time.time()
+        self._memory_put(key, data, now)
+        if self.disk_dir:
+            self._disk_put(key, data)
+
+    def contains(self, key):
+        entry = self.memory.get(key) or self.disk_index.get(key)
+        return entry is not None and not self._expired(entry[1])
+
+    def stats(self):
+        return {
+            "memory_entries": len(self.memory),
+            "memory_bytes": self.memory_bytes,
+            "disk_entries": len(self.disk_index),
+            "disk_bytes": self.disk_bytes,
+            "hits": dict(self.hits),
+            "misses": self.misses,
+        }
@@ -1,27 +1,52 @@
+import argparse
 import asyncio
-import logging
-import asyncpg
-import re
 import os
+import time
 import dotenv
 import httpx
 from contextlib import asynccontextmanager
-from fastapi import FastAPI
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 import uvicorn
-from pymorphy3 import MorphAnalyzer
 
 from aiogram import Bot, Dispatcher, F, types
-from aiogram.filters import Command
+from aiogram.filters import Command, CommandObject
 from aiogram.enums import ChatMemberStatus
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
 from aiogram.exceptions import TelegramBadRequest
-from aiogram.types import BotCommand, MessageReactionUpdated, BufferedInputFile, InputMediaPhoto, InputMediaAnimation, InputMediaVideo
+from aiogram.types import BotCommand, MessageReactionUpdated, MessageReactionCountUpdated, BufferedInputFile, InputMediaPhoto, InputMediaAnimation, InputMediaVideo
 from datetime import datetime, timedelta
-from main_draw import create_active_user_image, create_top_words_image, create_top_sticker_image, create_top_sticker_gif
+from main_draw import assets
+from stats_buffer import StatsBuffer
+from reactions import ReactionBuffer
+from word_sketches import WordSketches
+from leaderboard import Leaderboards, LEADERBOARD_TTL
+from rollups import Rollups, parse_window, describe_window, utc_now
+from message_retention import MessageRetention
+from chat_purge import ChatPurger
+from report_scheduler import ReportScheduler
+from telegram_limiter import TelegramLimiter, background_requests
+from title_reconciler import TitleReconciler
+from roles import BOT_ROLES, has_role, configure as configure_roles
+from leader import LeaderElection
+from jobs import JobQueue
+from webhook import WebhookReceiver, BOT_MODE, WEBHOOK_URL, WEBHOOK_PATH, SECRET_HEADER, webhook_secret
+from text_analysis import TextAnalysisService, lemmatizer
+from render_cache import RenderCache, make_key
+from media_cache import MediaCache
+from api_cache import ApiResponseCache, ChatVersions
+from render_service import RenderService, PRIORITY_BACKGROUND, PRIORITY_INTERACTIVE
+from log import setup_logging, get_logger, fields, sampled
+from metrics import REGISTRY
+from instrumentation import UpdateMetricsMiddleware
+from db import create_pool, PoolExhausted
+from migrations import migrate, pending, DB_MIGRATE_ON_START
+
+logger = get_logger(__name__)
 
-logging.basicConfig(level=logging.INFO)
 dotenv.load_dotenv()
+setup_logging()
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 
@@ -30,182 +55,86 @@ if not DATABASE_URL:
     try:
         from config import DATABASE_URL as FILE_DB_URL
         DATABASE_URL = FILE_DB_URL
-        print("✅ DATABASE_URL загружен из config.py")
+        logger.info("DATABASE_URL загружен из config.py")
     except ImportError:
-        print("⚠️ DATABASE_URL не найден ни в переменных, ни в config.py!")
+        logger.warning("DATABASE_URL не найден ни в переменных, ни в config.py")
         DATABASE_URL = "" 
 
 bot = Bot(token=BOT_TOKEN)
+telegram_limiter = TelegramLimiter()
+bot.session.middleware(telegram_limiter)
 dp = Dispatcher()
+dp.update.outer_middleware(UpdateMetricsMiddleware())
 db_pool = None
-morph = MorphAnalyzer()
-
-STOP_WORDS = {
-    "и", "в", "не", "на", "я", "что", "с", "а", "то", "как", "у", "все", "но", "по", "он", "она", 
-    "так", "же", "от", "о", "ты", "за", "да", "из", "к", "мы", "бы", "вы", "ну", "ли", "ни", "много", 
-    "это", "этот", "эта", "эти", "этот", "эту", "этим", "этого", "этой", "этих", "этими", "этом",
-    "он", "она", "оно", "они", "его", "её", "их", "ему", "ей", "им", "его", "её", "их", "ним", "ней", "ними",
-    "мой", "моя", "моё", "мои", "твой", "твоя", "твоё", "твои", "наш", "наша", "наше", "наши", "ваш", "ваша", "ваше", "ваши",
-    "себя", "себе", "собой", "собою",
-    "кто", "что", "какой", "какая", "какое", "какие", "чей", "чья", "чьё", "чьи", "который", "которая", "которое", "которые",
-    "где", "куда", "откуда", "когда", "почему", "зачем", "как", "сколько", "чей",
-    "быть", "был", "была", "было", "были", "будет", "будут", "буду", "будешь", "будем", "будете",
-    "есть", "есть", "суть",
-    "весь", "вся", "всё", "все", "всего", "всей", "всем", "всеми", "всём",
-    "сам", "сама", "само", "сами", "самого", "самой", "самому", "самим", "самими", "самом", "самой",
-    "уже", "ещё", "тоже", "только", "лишь", "просто", "даже", "вот", "вон", "тут", "там", "здесь", "туда", "сюда",
-    "очень", "совсем", "почти", "чуть", "немного", "много", "мало", "больше", "меньше",
-    "или", "либо", "ни", "нибудь", "либо", "ли", "же", "ведь", "хотя", "если", "когда", "пока", "чтобы", "чтоб",
-    "без", "для", "до", "из", "к", "на", "над", "о", "об", "от", "перед", "по", "под", "при", "про", "с", "со", "у", "через",
-    "можно", "нужно", "надо", "должен", "должна", "должно", "должны", "может", "может", "может", "могут",
-    "будет", "будет", "будет", "будут", "стал", "стала", "стало", "стали", "станет", "станут"
-}
+stats_buffer = None
+reaction_buffer = None
+word_sketches = None
+leaderboards = None
+rollups = None
+message_retention = None
+chat_purger = None
+report_scheduler = None
+title_reconciler = None
+text_service = None
+render_cache = RenderCache()
+media_cache = MediaCache(bot)
+chat_versions = ChatVersions()
+api_cache = ApiResponseCache(chat_versions)
+render_service = None
+webhook_receiver = None
+job_queue = None
+leaders = {}
+
+ALLOWED_UPDATES = ["message", "message_reaction", "message_reaction_count", "chat_member", "my_chat_member", "callback_query"]
 
 async def init_db_pool():
-    global db_pool
+    global db_pool, stats_buffer, reaction_buffer, word_sketches, leaderboards, rollups, message_retention, chat_purger, report_scheduler, title_reconciler, job_queue
     if not DATABASE_URL:
-        print("❌ Ошибка: Нет ссылки на базу данных!")
+        logger.error("Нет ссылки на базу данных")
         return
     try:
-        db_pool = await asyncpg.create_pool(dsn=DATABASE_URL)
-        async with db_pool.acquire() as connection:
-            await connection.execute('''CREATE TABLE IF NOT EXISTS sticker_stats (chat_id BIGINT, unique_id TEXT, file_id TEXT, count INTEGER DEFAULT 1, PRIMARY KEY (chat_id, unique_id))''')
-            await connection.execute('''CREATE TABLE IF NOT EXISTS word_stats (chat_id BIGINT, word TEXT, count INTEGER DEFAULT 1, PRIMARY KEY (chat_id, word))''')
-            await connection.execute('''CREATE TABLE IF NOT EXISTS user_stats (chat_id BIGINT, user_id BIGINT, full_name TEXT, msg_count INTEGER DEFAULT 1, PRIMARY KEY (chat_id, user_id))''')
-            await connection.execute('''CREATE TABLE IF NOT EXISTS message_stats (chat_id BIGINT, message_id BIGINT, user_id BIGINT, full_name TEXT, content TEXT, length INTEGER, reaction_count INTEGER DEFAULT 0, PRIMARY KEY (chat_id, message_id))''')
-            await connection.execute('''CREATE TABLE IF NOT EXISTS chat_settings (chat_id BIGINT PRIMARY KEY, auto_report_interval INTEGER DEFAULT NULL, last_report_time TIMESTAMP DEFAULT NULL)''')
-        print("✅ База данных успешно подключена")
+        db_pool = await create_pool(DATABASE_URL)
+        chat_versions.pool = db_pool
+        if DB_MIGRATE_ON_START:
+            await migrate(db_pool)
+        else:
+            missing = await pending(db_pool)
+            if missing:
+                logger.warning("Не применены миграции: %s (python migrations.py up)", ", ".join(str(m[0]) for m in missing))
+        # Процесс видит только свои сбросы: сбросы других процессов он узнает из базы
+        word_sketches = WordSketches(db_pool)
+        leaderboards = Leaderboards(db_pool, ttl=LEADERBOARD_TTL, sources={"word": word_sketches})
+        rollups = Rollups(db_pool)
+        message_retention = MessageRetention(db_pool)
+        stats_buffer = StatsBuffer(db_pool, leaderboards=leaderboards, word_sketches=word_sketches)
+        stats_buffer.on_flush.append(api_cache.invalidate)
+        reaction_buffer = ReactionBuffer(db_pool, stats_buffer, leaderboards=leaderboards)
+        reaction_buffer.on_flush.append(api_cache.invalidate)
+        title_reconciler = TitleReconciler(bot, db_pool, leaderboards, track_activity=not has_role("ingest"))
+        stats_buffer.on_flush.append(title_reconciler.mark_dirty)
+        chat_purger = ChatPurger(db_pool, stats_buffer)
+        chat_purger.on_purged.append(leaderboards.forget)
+        chat_purger.on_purged.append(word_sketches.forget)
+        chat_purger.on_purged.append(title_reconciler.forget)
+        chat_purger.on_purged.append(lambda chat_id: api_cache.invalidate([chat_id]))
+        job_queue = JobQueue(db_pool)
+        job_queue.register("report", run_report_job)
+        job_queue.register("stats", run_stats_job)
+        report_scheduler = ReportScheduler(db_pool, send_scheduled_report if has_role("render") else enqueue_scheduled_report)
+        logger.info("База данных подключена")
     except Exception as e:
-        print(f"❌ Ошибка подключения к БД: {e}")
+        logger.error("Ошибка подключения к БД: %s", e)
 
 async def delete_chat_data(chat_id):
+    """Прием статистики чата останавливается сразу, а сами данные удаляет фоновое задание"""
     if not db_pool: return
-    async with db_pool.acquire() as connection:
-        await connection.execute('DELETE FROM sticker_stats WHERE chat_id = $1', chat_id)
-        await connection.execute('DELETE FROM word_stats WHERE chat_id = $1', chat_id)
-        await connection.execute('DELETE FROM user_stats WHERE chat_id = $1', chat_id)
-        await connection.execute('DELETE FROM message_stats WHERE chat_id = $1', chat_id)
-
-def normalize_word(word):
-    try:
-        parsed = morph.parse(word)[0]
-        normal_form = parsed.normal_form
-        return normal_form.lower()
-    except:
-        return word.lower()
-
-def clean_and_split_text(text):
-    if not text: return []
-    text = re.sub(r'[^\w\s]', '', text.lower())
-    words = []
-    for w in text.split():
-        if len(w) > 2:
-            normalized = normalize_word(w)
-            if normalized not in STOP_WORDS:
-                words.append(normalized)
-    return words
-
-async def update_active_user_title(chat_id):
-    if not db_pool:
-        print(f"⚠️ База данных не подключена для чата {chat_id}")
-        return
-    
-    try:
-        async with db_pool.acquire() as conn:
-            user_row = await conn.fetchrow(
-                'SELECT user_id, full_name, msg_count FROM user_stats WHERE chat_id=$1 ORDER BY msg_count DESC LIMIT 1',
-                chat_id
-            )
-            
-            if not user_row:
-                print(f"⚠️ Не найден активный пользователь для чата {chat_id}")
-                return
-            
-            if user_row['msg_count'] < 10:
-                print(f"⚠️ У пользователя {user_row['user_id']} недостаточно сообщений ({user_row['msg_count']} < 10) для чата {chat_id}")
-                return
-            
-            user_id = user_row['user_id']
-            print(f"🔍 Проверка установки титула для пользователя {user_id} (сообщений: {user_row['msg_count']}) в чате {chat_id}")
-            
-            try:
-                bot_info = await bot.get_me()
-                bot_member = await bot.get_chat_member(chat_id, bot_info.id)
-                if bot_member.status != ChatMemberStatus.ADMINISTRATOR:
-                    print(f"⚠️ Бот не является администратором в чате {chat_id}")
-                    return
-                
-                if not bot_member.can_promote_members:
-                    print(f"⚠️ У бота нет прав на повышение участников в чате {chat_id}")
-                    return
-                
-                print(f"✅ Бот имеет необходимые права в чате {chat_id}")
-            except Exception as e:
-                print(f"⚠️ Ошибка проверки прав бота для чата {chat_id}: {e}")
-                return
-            
-            try:
-                user_member = await bot.get_chat_member(chat_id, user_id)
-                print(f"🔍 Статус пользователя {user_id}: {user_member.status}")
-                
-                if user_member.status == ChatMemberStatus.ADMINISTRATOR:
-                    try:
-                        await bot.set_chat_administrator_custom_title(chat_id, user_id, "Самый активный")
-                        print(f"✅ Установлен титул 'Самый активный' для пользователя {user_id} в чате {chat_id}")
-                    except TelegramBadRequest as e:
-                        error_msg = str(e).lower()
-                        print(f"⚠️ Ошибка установки титула для администратора {user_id} в чате {chat_id}: {e}")
-                        if "not enough rights" in error_msg:
-                            print(f"⚠️ У бота недостаточно прав для изменения титула администратора")
-                        elif "can't change" in error_msg or "can not change" in error_msg:
-                            print(f"⚠️ Нельзя изменить титул этого администратора (возможно, он выше бота)")
-                elif user_member.status == ChatMemberStatus.MEMBER:
-                    try:
-                        print(f"🔧 Повышение пользователя {user_id} до администратора...")
-                        await bot.promote_chat_member(
-                            chat_id=chat_id,
-                            user_id=user_id,
-                            can_manage_chat=False,
-                            can_delete_messages=False,
-                            can_manage_video_chats=False,
-                            can_restrict_members=False,
-                            can_promote_members=False,
-                            can_change_info=False,
-                            can_invite_users=False,
-                            can_post_messages=False,
-                            can_edit_messages=False,
-                            can_pin_messages=False,
-                            can_manage_topics=False
-                        )
-                        await asyncio.sleep(1)  # Увеличил задержку для надежности
-                        await bot.set_chat_administrator_custom_title(chat_id, user_id, "Самый активный")
-                        print(f"✅ Пользователь {user_id} назначен администратором с титулом 'Самый активный' в чате {chat_id}")
-                    except TelegramBadRequest as e:
-                        error_msg = str(e).lower()
-                        print(f"⚠️ Не удалось назначить администратором пользователя {user_id} в чате {chat_id}: {e}")
-                        if "not enough rights" in error_msg:
-                            print(f"⚠️ У бота недостаточно прав для повышения участников")
-                        elif "user is already" in error_msg:
-                            print(f"⚠️ Пользователь уже администратор, пытаемся установить титул...")
-                            try:
-                                await bot.set_chat_administrator_custom_title(chat_id, user_id, "Самый активный")
-                                print(f"✅ Титул установлен для уже существующего администратора {user_id}")
-                            except Exception as e2:
-                                print(f"⚠️ Не удалось установить титул: {e2}")
-                else:
-                    print(f"⚠️ Пользователь {user_id} имеет статус {user_member.status}, который не поддерживается")
-            except Exception as e:
-                print(f"⚠️ Ошибка при обновлении титула для чата {chat_id}, пользователя {user_id}: {e}")
-                import traceback
-                traceback.print_exc()
-    except Exception as e:
-        print(f"⚠️ Ошибка в update_active_user_title для чата {chat_id}: {e}")
-        import traceback
-        traceback.print_exc()
+    await chat_purger.request(chat_id)
+    leaderboards.forget(chat_id)
+    api_cache.invalidate([chat_id])
 
 async def keep_alive_task():
     url = "https://chatly-backend-nflu.onrender.com/ping" 
-    print(f"🔄 Запущен пингер для: {url}")
+    logger.info("Запущен пингер", extra=fields(url=url))
 
     while True:
         await asyncio.sleep(600)
@@ -213,61 +142,92 @@ async def keep_alive_task():
             async with httpx.AsyncClient() as client:
                 await client.get(url)
         except Exception as e:
-            print(f"⚠️ Ошибка пинга: {e}")
+            logger.warning("Ошибка пинга: %s", e)
 
-async def update_titles_task():
-    if not db_pool:
-        return
-    
-    while True:
-        await asyncio.sleep(3600)
-        try:
-            async with db_pool.acquire() as conn:
-                chat_ids = await conn.fetch('SELECT DISTINCT chat_id FROM user_stats')
-                for row in chat_ids:
-                    chat_id = row['chat_id']
-                    try:
-                        await update_active_user_title(chat_id)
-                    except Exception as e:
-                        print(f"⚠️ Ошибка обновления титула для чата {chat_id}: {e}")
-        except Exception as e:
-            print(f"⚠️ Ошибка в update_titles_task: {e}")
+async def run_polling():
+    await bot.delete_webhook(drop_pending_updates=True)
+    await dp.start_polling(bot, allowed_updates=ALLOWED_UPDATES)
+
+async def run_report_scheduler():
+    try:
+        await report_scheduler.run()
+    finally:
+        await report_scheduler.stop()
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    global text_service, render_service, webhook_receiver
     await init_db_pool()
+    logger.info("Роли процесса: %s", ", ".join(sorted(BOT_ROLES)))
+    if has_role("ingest"):
+        text_service = TextAnalysisService()
+        text_service.start()
+    if has_role("render"):
+        await asyncio.to_thread(assets.preload)
+        render_service = RenderService()
+        render_service.start()
+
+    tasks = [asyncio.create_task(keep_alive_task())]
+    if has_role("ingest"):
+        await bot.set_my_commands([
+            BotCommand(command="stats", description="Показать статистику (/stats 7d - за период)"),
+            BotCommand(command="settings", description="Настройки автоматических отчетов")
+        ])
+        if BOT_MODE == "webhook":
+            webhook_receiver = WebhookReceiver(bot, dp, webhook_secret(BOT_TOKEN))
+            webhook_receiver.start()
+            await webhook_receiver.setup(WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH, ALLOWED_UPDATES)
+            logger.info("Webhook: %s%s", WEBHOOK_URL.rstrip("/"), WEBHOOK_PATH)
+        elif db_pool:
+            # getUpdates может вызывать только один процесс
+            leaders["polling"] = LeaderElection(db_pool, "polling")
+            tasks.append(asyncio.create_task(leaders["polling"].run(run_polling)))
+        else:
+            tasks.append(asyncio.create_task(run_polling()))
+        if stats_buffer:
+            tasks.append(asyncio.create_task(stats_buffer.run()))
+            tasks.append(asyncio.create_task(reaction_buffer.run()))
+        if chat_purger:
+            await chat_purger.start()
+    if has_role("scheduler") and db_pool:
+        leaders["scheduler"] = LeaderElection(db_pool, "scheduler")
+        tasks.append(asyncio.create_task(leaders["scheduler"].run(
+            run_report_scheduler, title_reconciler.run, rollups.run, message_retention.run, chat_purger.run,
+        )))
+    if has_role("render") and job_queue:
+        tasks.append(asyncio.create_task(job_queue.run()))
     
-    await bot.set_my_commands([
-        BotCommand(command="stats", description="Показать статистику"),
-        BotCommand(command="settings", description="Настройки автоматических отчетов")
-    ])
-    await bot.delete_webhook(drop_pending_updates=True)
-    
-    polling_task = asyncio.create_task(dp.start_polling(bot, allowed_updates=["message", "message_reaction", "chat_member", "my_chat_member", "callback_query"]))
-    ping_task = asyncio.create_task(keep_alive_task())
-    titles_task = asyncio.create_task(update_titles_task())
-    auto_reports_task_obj = asyncio.create_task(auto_reports_task())
-    
-    print("🚀 Сервер и Бот запущены!")
+    logger.info("Сервер и бот запущены")
     
     yield
     
-    print("🛑 Остановка сервера...")
-    polling_task.cancel()
-    ping_task.cancel()
-    titles_task.cancel()
-    auto_reports_task_obj.cancel()
-    try:
-        await polling_task
-        await ping_task
-        await titles_task
-        await auto_reports_task_obj
-    except asyncio.CancelledError:
-        pass
+    logger.info("Остановка сервера")
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+    if webhook_receiver:
+        await webhook_receiver.stop()
+    if job_queue:
+        await job_queue.stop()
+    if text_service:
+        await text_service.stop()
+    if render_service:
+        await render_service.stop()
+    if chat_purger:
+        await chat_purger.stop()
+
+    if reaction_buffer:
+        await reaction_buffer.flush()
+    if stats_buffer:
+        await stats_buffer.flush()
+        logger.info("Буфер статистики сброшен", extra=fields(**stats_buffer.metrics()))
+    if word_sketches:
+        await word_sketches.stop()
 
     if db_pool:
         await db_pool.close()
-    print("👋 Все соединения закрыты.")
+    logger.info("Все соединения закрыты")
 
 app = FastAPI(lifespan=lifespan)
 
@@ -279,6 +239,11 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.exception_handler(PoolExhausted)
+async def pool_exhausted_handler(request: Request, exc: PoolExhausted):
+    # База перегружена: клиент может повторить запрос позже
+    return JSONResponse({"error": "База данных перегружена, попробуйте позже"}, status_code=503, headers={"Retry-After": "5"})
+
 @app.get("/")
 async def root():
     return "Bot is running!"
@@ -287,261 +252,380 @@ async def root():
 async def ping_server():
     return {"status": "alive"}
 
-@app.get("/api/chat/{chat_id}")
-async def get_chat_stats_api(chat_id: int):
-    if not db_pool:
-        return {"error": "База данных не подключена"}
+@app.get("/internal/metrics")
+async def internal_metrics():
+    return {
+        "roles": sorted(BOT_ROLES),
+        "db_pool": db_pool.stats() if db_pool else None,
+        "leaders": {name: election.stats() for name, election in leaders.items()},
+        "jobs": job_queue.stats() if job_queue else None,
+        "stats_buffer": stats_buffer.metrics() if stats_buffer else None,
+        "reactions": reaction_buffer.stats() if reaction_buffer else None,
+        "word_sketches": word_sketches.stats() if word_sketches else None,
+        "leaderboards": leaderboards.stats() if leaderboards else None,
+        "rollups": rollups.stats() if rollups else None,
+        "message_retention": message_retention.stats() if message_retention else None,
+        "chat_purge": chat_purger.stats() if chat_purger else None,
+        "report_scheduler": report_scheduler.stats() if report_scheduler else None,
+        "titles": title_reconciler.stats() if title_reconciler else None,
+        "telegram": telegram_limiter.stats(),
+        "webhook": webhook_receiver.stats() if webhook_receiver else None,
+        "lemmatizer": lemmatizer.stats(),
+        "text_analysis": text_service.stats() if text_service else None,
+        "render_cache": render_cache.stats(),
+        "media_cache": media_cache.stats(),
+        "api_cache": api_cache.stats(),
+        "assets": assets.memory_usage(),
+        "render_service": render_service.stats() if render_service else None,
+    }
 
-    async with db_pool.acquire() as conn:
-        user_row = await conn.fetchrow('SELECT user_id, full_name, msg_count FROM user_stats WHERE chat_id=$1 ORDER BY msg_count DESC LIMIT 1', chat_id)
-        
-        active_user_data = None
-        if user_row:
-            avatar_url = None
-            try:
-                photos = await bot.get_user_profile_photos(user_row['user_id'])
-                if photos.total_count > 0:
-                    file_id = photos.photos[0][0].file_id 
-                    file_info = await bot.get_file(file_id)
-                    avatar_url = f"https://api.telegram.org/file/bot{BOT_TOKEN}/{file_info.file_path}"
-            except Exception as e:
-                print(f"Не удалось получить аватар для API: {e}")
-
-            active_user_data = {
-                "name": user_row['full_name'],
-                "count": user_row['msg_count'],
-                "avatar_url": avatar_url
-            }
-
-        words_rows = await conn.fetch('SELECT word, count FROM word_stats WHERE chat_id=$1 ORDER BY count DESC LIMIT 10', chat_id)
-        top_words = [{"word": r['word'], "count": r['count']} for r in words_rows]
+@REGISTRY.collector
+def collect_components():
+    for component in (stats_buffer, reaction_buffer, word_sketches, report_scheduler, title_reconciler, chat_purger, job_queue,
+                      webhook_receiver, text_service, render_service, telegram_limiter):
+        if component is not None:
+            yield from component.collect()
+    yield "leader", "gauge", "1, если процесс ведущий", [({"election": n}, int(e.is_leader)) for n, e in leaders.items()]
+    if db_pool:
+        yield from db_pool.collect()
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    return Response(REGISTRY.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.post(WEBHOOK_PATH)
+async def telegram_webhook(request: Request):
+    if not webhook_receiver:
+        return Response(status_code=404)
+    if not webhook_receiver.check_secret(request.headers.get(SECRET_HEADER)):
+        webhook_receiver.unauthorized += 1
+        return Response(status_code=401)
+    if not webhook_receiver.accept(await request.body()):
+        return Response(status_code=503)
+    return Response(status_code=200)
+
+async def top_entries(chat_id, kind, limit, window=None):
+    """Топ за все время из лидербордов или за период из часовых/суточных корзин"""
+    if window is None:
+        return await leaderboards.top(chat_id, kind, limit)
+    if kind == "message":
+        # Реакции не раскладываются по корзинам: топ среди сообщений, отправленных за период
+        return await reaction_buffer.top_since(chat_id, utc_now() - window, limit)
+    return await rollups.top(chat_id, kind, window, limit)
+
+async def most_reacted_message(chat_id, window=None):
+    """Сообщение с наибольшим числом реакций: автор, текст и число реакций"""
+    top = await top_entries(chat_id, "message", 1, window)
+    if not top:
+        return None
+    message_id, full_name, count = top[0]
+    row = await reaction_buffer.message(chat_id, int(message_id))
+    return {
+        "message_id": int(message_id),
+        "user_id": row['user_id'] if row else None,
+        "full_name": full_name,
+        "text": row['content'] if row else None,
+        "reaction_count": count,
+    }
+
+async def build_chat_stats(chat_id, window=None):
+    # Текст сообщения в открытый API не отдается: только автор и число реакций
+    top_users, top_words_rows, top_messages = await asyncio.gather(
+        top_entries(chat_id, "user", 1, window),
+        top_entries(chat_id, "word", 10, window),
+        top_entries(chat_id, "message", 1, window),
+    )
+
+    active_user_data = None
+    if top_users:
+        user_id, full_name, msg_count = top_users[0]
+        avatar_url = None
+        try:
+            sizes = await media_cache.profile_photo_sizes(int(user_id))
+            if sizes:
+                file_path = await media_cache.file_path(sizes[0][0])
+                avatar_url = f"https://api.telegram.org/file/bot{BOT_TOKEN}/{file_path}"
+        except Exception as e:
+            logger.warning("Не удалось получить аватар для API: %s", e, extra=fields(chat_id=chat_id))
+
+        active_user_data = {
+            "name": full_name,
+            "count": msg_count,
+            "avatar_url": avatar_url
+        }
+
+    top_words = [{"word": word, "count": count} for word, _, count in top_words_rows]
 
     return {
         "chat_id": chat_id,
+        "window_hours": int(window.total_seconds() // 3600) if window else None,
         "active_user": active_user_data,
-        "top_words": top_words
+        "top_words": top_words,
+        "most_reacted": {
+            "name": top_messages[0][1],
+            "count": top_messages[0][2],
+        } if top_messages else None,
     }
 
-async def send_stats_auto(chat_id: int):
-    """Автоматическая отправка статистики без message объекта"""
-    if not db_pool: 
-        return
-
-    user_name = "Никто"
-    user_id = None
-    msg_count = 0
+@app.get("/api/chat/{chat_id}")
+async def get_chat_stats_api(chat_id: int, request: Request, window: str = None):
+    if not db_pool:
+        return {"error": "База данных не подключена"}
+    try:
+        period = parse_window(window)
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+
+    version = await chat_versions.get(chat_id)
+    headers = version.headers()
+    if version.not_modified(request.headers.get("if-none-match"), request.headers.get("if-modified-since")):
+        return Response(status_code=304, headers=headers)
+
+    payload = await api_cache.get(chat_id, lambda: build_chat_stats(chat_id, period), variant=period, version=version.version)
+    return JSONResponse(payload, headers=headers)
+
+async def card_media(key, media_type, filename, template, args, caption=None, priority=PRIORITY_BACKGROUND):
+    """Карточка из кэша (file_id или готовые байты) или свежий рендер"""
+    file_id = render_cache.get_file_id(key)
+    if file_id:
+        return media_type(media=file_id, caption=caption)
+
+    data = render_cache.get(key)
+    if data is None:
+        data = await render_service.render(template, args, key, priority)
+        if not data:
+            return None
+        render_cache.put(key, data)
+    return media_type(media=BufferedInputFile(data, filename=filename), caption=caption)
+
+def remember_sent_media(keys, messages):
+    """Запоминаем file_id загруженных карточек, чтобы в следующий раз не загружать их снова"""
+    for key, sent in zip(keys, messages):
+        if sent.photo:
+            render_cache.put_file_id(key, sent.photo[-1].file_id)
+        elif sent.video:
+            render_cache.put_file_id(key, sent.video.file_id)
+        elif sent.animation:
+            render_cache.put_file_id(key, sent.animation.file_id)
+
+def forget_sent_media(keys):
+    for key in keys:
+        render_cache.forget_file_id(key)
+
+class ReportTimings:
+    """Длительность этапов построения отчета"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages = {}
+
+    @asynccontextmanager
+    async def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = time.perf_counter() - started
+
+    def summary(self):
+        """Секунды по этапам и общее время отчета"""
+        summary = {name: round(elapsed, 3) for name, elapsed in self.stages.items()}
+        summary["total"] = round(time.perf_counter() - self.started, 3)
+        return summary
+
+async def fetch_report_data(chat_id, window=None):
+    """Лидер по сообщениям, топ-3 слов, топ стикер и сообщение с наибольшим числом реакций
+    за все время или за период"""
+    data = {"user": None, "top_words": [], "sticker": None, "message": None}
+    users, words, stickers, data["message"] = await asyncio.gather(
+        top_entries(chat_id, "user", 1, window),
+        top_entries(chat_id, "word", 3, window),
+        top_entries(chat_id, "sticker", 1, window),
+        most_reacted_message(chat_id, window),
+    )
+    for key, label, count in users:
+        data["user"] = {"user_id": int(key), "full_name": label, "msg_count": count}
+    for key, _, count in words:
+        data["top_words"].append((key, count))
+    for key, label, count in stickers:
+        data["sticker"] = {"unique_id": key, "file_id": label, "count": count}
+    return data
+
+async def active_user_card(user, priority, timings, caption="Статистика чата"):
     avatar_bytes = None
-    top_words = [] 
-    sticker_file_id = None
-    sticker_count = 0
-    sticker_bytes = None
-    is_video_sticker = False
-
-    async with db_pool.acquire() as conn:
-        user_row = await conn.fetchrow('SELECT user_id, full_name, msg_count FROM user_stats WHERE chat_id=$1 ORDER BY msg_count DESC LIMIT 1', chat_id)
-        if user_row:
-            user_name = user_row['full_name']
-            msg_count = user_row['msg_count']
-            user_id = user_row['user_id']
-        
-        words_rows = await conn.fetch('SELECT word, count FROM word_stats WHERE chat_id=$1 ORDER BY count DESC LIMIT 3', chat_id)
-        top_words = [(r['word'], r['count']) for r in words_rows]
+    avatar_file_id = None
+    avatar_unique_id = None
 
-        sticker_row = await conn.fetchrow('SELECT file_id, count FROM sticker_stats WHERE chat_id=$1 ORDER BY count DESC LIMIT 1', chat_id)
-        if sticker_row:
-            sticker_file_id = sticker_row['file_id']
-            sticker_count = sticker_row['count']
-
-    if user_id:
+    async with timings.stage("avatar"):
         try:
-            photos = await bot.get_user_profile_photos(user_id)
-            if photos.total_count > 0:
-                file_id = photos.photos[0][-1].file_id 
-                file_info = await bot.get_file(file_id)
-                downloaded_file = await bot.download_file(file_info.file_path)
-                avatar_bytes = downloaded_file.read()
+            sizes = await media_cache.profile_photo_sizes(user['user_id'])
+            if sizes:
+                avatar_file_id, avatar_unique_id = sizes[-1]
         except Exception: pass
-            
-    if sticker_file_id:
-        try:
-            st_file_info = await bot.get_file(sticker_file_id)
-            file_path = st_file_info.file_path
-            
-            if file_path and file_path.endswith('.webm'):
-                st_downloaded = await bot.download_file(file_path)
-                sticker_bytes = st_downloaded.read()
-                is_video_sticker = True
-            elif file_path and file_path.endswith('.tgs'):
-                sticker_bytes = None
-            else:
-                st_downloaded = await bot.download_file(file_path)
-                sticker_bytes = st_downloaded.read()
-                is_video_sticker = False
-        except Exception: 
-            sticker_bytes = None
-            is_video_sticker = False
 
-    media_group = []
-    
-    if msg_count > 0:
-        try:
-            image_active = await asyncio.to_thread(create_active_user_image, avatar_bytes, msg_count, user_name)
-            if image_active:
-                file_active = BufferedInputFile(image_active.read(), filename="active.png")
-                media_group.append(InputMediaPhoto(media=file_active, caption="Статистика чата"))
-        except Exception as e:
-            print(f"Ошибка генерации картинки active: {e}")
+        key = make_key("active", user['msg_count'], user['full_name'], avatar_unique_id)
 
-    if top_words:
-        try:
-            image_words = await asyncio.to_thread(create_top_words_image, top_words)
-            if image_words:
-                file_words = BufferedInputFile(image_words.read(), filename="words.png")
-                media_group.append(InputMediaPhoto(media=file_words))
-        except Exception as e:
-            print(f"Ошибка генерации картинки words: {e}")
+        # Качаем аватарку только если карточки нет в кэше
+        if avatar_file_id and not render_cache.contains(key):
+            try:
+                avatar_bytes = await media_cache.download(avatar_file_id, avatar_unique_id)
+            except Exception: pass
 
-    if sticker_bytes:
-        try:
-            if is_video_sticker:
-                video_sticker = await asyncio.to_thread(create_top_sticker_gif, sticker_bytes, sticker_count)
-                if video_sticker:
-                    file_sticker = BufferedInputFile(video_sticker.read(), filename="sticker.mp4")
-                    media_group.append(InputMediaVideo(media=file_sticker))
-            else:
-                image_sticker = await asyncio.to_thread(create_top_sticker_image, sticker_bytes, sticker_count)
-                if image_sticker:
-                    file_sticker = BufferedInputFile(image_sticker.read(), filename="sticker.png")
-                    media_group.append(InputMediaPhoto(media=file_sticker))
-        except Exception as e:
-            print(f"Ошибка генерации картинки sticker: {e}")
+    async with timings.stage("render_active"):
+        media = await card_media(key, InputMediaPhoto, "active.png", "active", (avatar_bytes, user['msg_count'], user['full_name']), caption=caption, priority=priority)
+    return media, key
+
+async def top_words_card(top_words, priority, timings):
+    key = make_key("words", top_words)
+    async with timings.stage("render_words"):
+        media = await card_media(key, InputMediaPhoto, "words.png", "words", (top_words,), priority=priority)
+    return media, key
+
+async def top_sticker_card(sticker, priority, timings):
+    sticker_bytes = None
+    is_video_sticker = False
+    key_sticker = make_key("sticker", sticker['count'], sticker['unique_id'])
+    key_sticker_video = make_key("sticker_video", sticker['count'], sticker['unique_id'])
 
+    async with timings.stage("sticker"):
+        if render_cache.contains(key_sticker_video):
+            is_video_sticker = True
+        elif not render_cache.contains(key_sticker):
+            try:
+                file_path = await media_cache.file_path(sticker['file_id'])
+
+                if not file_path or file_path.endswith('.tgs'):
+                    return None, None
+                sticker_bytes = await media_cache.download(sticker['file_id'], sticker['unique_id'])
+                is_video_sticker = file_path.endswith('.webm')
+            except Exception:
+                return None, None
+
+    async with timings.stage("render_sticker"):
+        if is_video_sticker:
+            media = await card_media(key_sticker_video, InputMediaVideo, "sticker.mp4", "sticker_video", (sticker_bytes, sticker['count']), priority=priority)
+            return media, key_sticker_video
+        media = await card_media(key_sticker, InputMediaPhoto, "sticker.png", "sticker", (sticker_bytes, sticker['count']), priority=priority)
+        return media, key_sticker
+
+async def most_reacted_card(message, priority, timings):
+    args = (message['text'], message['full_name'], message['reaction_count'])
+    key = make_key("reactions", *args)
+    async with timings.stage("render_reactions"):
+        media = await card_media(key, InputMediaPhoto, "reactions.png", "reactions", args, priority=priority)
+    return media, key
+
+async def build_report(chat_id, priority=PRIORITY_BACKGROUND, window=None):
+    """Карточки отчета: чтение из БД, затем параллельно загрузка медиа и рендер каждой карточки"""
+    timings = ReportTimings()
+
+    async with timings.stage("flush"):
+        await stats_buffer.flush()
+    async with timings.stage("db"):
+        data = await fetch_report_data(chat_id, window)
+
+    cards = []
+    if data["user"] and data["user"]['msg_count'] > 0:
+        caption = f"Статистика чата {describe_window(window)}" if window else "Статистика чата"
+        cards.append(active_user_card(data["user"], priority, timings, caption))
+    if data["top_words"]:
+        cards.append(top_words_card(data["top_words"], priority, timings))
+    if data["sticker"]:
+        cards.append(top_sticker_card(data["sticker"], priority, timings))
+    if data["message"]:
+        cards.append(most_reacted_card(data["message"], priority, timings))
+
+    media_group = []
+    media_keys = []
+    for result in await asyncio.gather(*cards, return_exceptions=True):
+        if isinstance(result, Exception):
+            logger.error("Ошибка генерации карточки отчета: %s", result, extra=fields(chat_id=chat_id))
+            continue
+        media, key = result
+        if media:
+            media_group.append(media)
+            media_keys.append(key)
+
+    logger.info("Отчет построен", extra=sampled(chat_id=chat_id, **timings.summary()))
+    return media_group, media_keys
+
+async def send_scheduled_report(chat_id, interval):
+    with background_requests():
+        return await send_stats_auto(chat_id, timedelta(days=interval))
+
+async def enqueue_scheduled_report(chat_id, interval):
+    """Процесс без роли render передает отчет через очередь заданий; False, если задание не поставлено"""
+    return await job_queue.enqueue("report", {"chat_id": chat_id, "interval": interval}, dedupe_key=f"report:{chat_id}")
+
+async def run_report_job(payload):
+    if not await send_scheduled_report(payload["chat_id"], payload["interval"]):
+        raise RuntimeError(f"отчет в чат {payload['chat_id']} не отправлен")
+
+async def run_stats_job(payload):
+    """/stats, принятый процессом без роли render"""
+    window = timedelta(seconds=payload["window"]) if payload["window"] else None
+    if not await send_stats_auto(payload["chat_id"], window, PRIORITY_INTERACTIVE, empty_text="❌ Недостаточно данных для статистики."):
+        raise RuntimeError(f"статистика в чат {payload['chat_id']} не отправлена")
+
+def report_keyboard(chat_id):
     web_url = f"https://chatly1-iota.vercel.app/?id={chat_id}"
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+    return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="📊 Смотреть на сайте", url=web_url)]
     ])
 
+async def send_stats_auto(chat_id: int, window=None, priority=PRIORITY_BACKGROUND, empty_text=None):
+    """Автоматическая отправка статистики без message объекта; False, если отчет не отправлен"""
+    if not db_pool: 
+        return False
+
+    media_group, media_keys = await build_report(chat_id, priority, window)
+
     if media_group:
         try:
-            await bot.send_media_group(chat_id=chat_id, media=media_group)
-            await bot.send_message(chat_id=chat_id, text="👆 Полная статистика и анимация на сайте:", reply_markup=keyboard)
+            sent = await bot.send_media_group(chat_id=chat_id, media=media_group)
+            remember_sent_media(media_keys, sent)
+            await bot.send_message(chat_id=chat_id, text="👆 Полная статистика и анимация на сайте:", reply_markup=report_keyboard(chat_id))
             
-            try:
-                await update_active_user_title(chat_id)
-            except Exception as e:
-                print(f"⚠️ Ошибка обновления титула при авто-отчете: {e}")
+            await title_reconciler.reconcile(chat_id)
         except Exception as e:
-            print(f"⚠️ Ошибка отправки авто-отчета в чат {chat_id}: {e}")
+            forget_sent_media(media_keys)
+            logger.warning("Ошибка отправки авто-отчета: %s", e, extra=fields(chat_id=chat_id))
+            return False
+    elif empty_text:
+        await bot.send_message(chat_id=chat_id, text=empty_text)
+    return True
 
 @dp.message(Command("stats"))
-async def send_stats(message: types.Message):
+async def send_stats(message: types.Message, command: CommandObject):
     chat_id = message.chat.id
     if not db_pool: 
         await message.answer("⚠️ База данных не подключена.")
         return
 
-    user_name = "Никто"
-    user_id = None
-    msg_count = 0
-    avatar_bytes = None
-    top_words = [] 
-    sticker_file_id = None
-    sticker_count = 0
-    sticker_bytes = None
-    is_video_sticker = False
-
-    async with db_pool.acquire() as conn:
-        user_row = await conn.fetchrow('SELECT user_id, full_name, msg_count FROM user_stats WHERE chat_id=$1 ORDER BY msg_count DESC LIMIT 1', chat_id)
-        if user_row:
-            user_name = user_row['full_name']
-            msg_count = user_row['msg_count']
-            user_id = user_row['user_id']
-        
-        words_rows = await conn.fetch('SELECT word, count FROM word_stats WHERE chat_id=$1 ORDER BY count DESC LIMIT 3', chat_id)
-        top_words = [(r['word'], r['count']) for r in words_rows]
-
-        sticker_row = await conn.fetchrow('SELECT file_id, count FROM sticker_stats WHERE chat_id=$1 ORDER BY count DESC LIMIT 1', chat_id)
-        if sticker_row:
-            sticker_file_id = sticker_row['file_id']
-            sticker_count = sticker_row['count']
-
-    if user_id:
-        try:
-            photos = await bot.get_user_profile_photos(user_id)
-            if photos.total_count > 0:
-                file_id = photos.photos[0][-1].file_id 
-                file_info = await bot.get_file(file_id)
-                downloaded_file = await bot.download_file(file_info.file_path)
-                avatar_bytes = downloaded_file.read()
-        except Exception: pass
-            
-    if sticker_file_id:
-        try:
-            st_file_info = await bot.get_file(sticker_file_id)
-            file_path = st_file_info.file_path
-            
-            if file_path and file_path.endswith('.webm'):
-                st_downloaded = await bot.download_file(file_path)
-                sticker_bytes = st_downloaded.read()
-                is_video_sticker = True
-            elif file_path and file_path.endswith('.tgs'):
-                sticker_bytes = None
-            else:
-                st_downloaded = await bot.download_file(file_path)
-                sticker_bytes = st_downloaded.read()
-                is_video_sticker = False
-        except Exception: 
-            sticker_bytes = None
-            is_video_sticker = False
-
-    media_group = []
-    
-    if msg_count > 0:
-        try:
-            image_active = await asyncio.to_thread(create_active_user_image, avatar_bytes, msg_count, user_name)
-            if image_active:
-                file_active = BufferedInputFile(image_active.read(), filename="active.png")
-                media_group.append(InputMediaPhoto(media=file_active, caption="Статистика чата"))
-        except Exception as e:
-            print(f"Ошибка генерации картинки active: {e}")
-
-    if top_words:
-        try:
-            image_words = await asyncio.to_thread(create_top_words_image, top_words)
-            if image_words:
-                file_words = BufferedInputFile(image_words.read(), filename="words.png")
-                media_group.append(InputMediaPhoto(media=file_words))
-        except Exception as e:
-            print(f"Ошибка генерации картинки words: {e}")
+    try:
+        window = parse_window(command.args)
+    except ValueError as e:
+        await message.answer(f"❌ {e}\nНапример: /stats 24h, /stats 7d или /stats 30")
+        return
 
-    if sticker_bytes:
-        try:
-            if is_video_sticker:
-                video_sticker = await asyncio.to_thread(create_top_sticker_gif, sticker_bytes, sticker_count)
-                if video_sticker:
-                    file_sticker = BufferedInputFile(video_sticker.read(), filename="sticker.mp4")
-                    media_group.append(InputMediaVideo(media=file_sticker))
-            else:
-                image_sticker = await asyncio.to_thread(create_top_sticker_image, sticker_bytes, sticker_count)
-                if image_sticker:
-                    file_sticker = BufferedInputFile(image_sticker.read(), filename="sticker.png")
-                    media_group.append(InputMediaPhoto(media=file_sticker))
-        except Exception as e:
-            print(f"Ошибка генерации картинки sticker: {e}")
+    if not has_role("render"):
+        payload = {"chat_id": chat_id, "window": window.total_seconds() if window else None}
+        if not await job_queue.enqueue("stats", payload, PRIORITY_INTERACTIVE, dedupe_key=f"stats:{chat_id}:{payload['window']}"):
+            await message.answer("⏳ Статистика уже готовится, подождите немного.")
+        return
 
-    web_url = f"https://chatly1-iota.vercel.app/?id={chat_id}"
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="📊 Смотреть на сайте", url=web_url)]
-    ])
+    media_group, media_keys = await build_report(chat_id, PRIORITY_INTERACTIVE, window)
 
     if media_group:
-        await message.answer_media_group(media=media_group)
-        await message.answer("👆 Полная статистика и анимация на сайте:", reply_markup=keyboard)
-        
         try:
-            await update_active_user_title(chat_id)
-        except Exception as e:
-            print(f"⚠️ Ошибка обновления титула при /stats: {e}")
+            sent = await message.answer_media_group(media=media_group)
+        except TelegramBadRequest:
+            forget_sent_media(media_keys)
+            raise
+        remember_sent_media(media_keys, sent)
+        await message.answer("👆 Полная статистика и анимация на сайте:", reply_markup=report_keyboard(chat_id))
+        
+        await title_reconciler.reconcile(chat_id)
     else:
         await message.answer("❌ Недостаточно данных для статистики.")
 
@@ -553,9 +637,8 @@ async def cmd_settings(message: types.Message):
         return
     
     # Проверяем текущие настройки
-    async with db_pool.acquire() as conn:
-        settings = await conn.fetchrow('SELECT auto_report_interval FROM chat_settings WHERE chat_id=$1', chat_id)
-        current_interval = settings['auto_report_interval'] if settings else None
+    settings = await db_pool.fetchrow('SELECT auto_report_interval FROM chat_settings WHERE chat_id=$1', chat_id)
+    current_interval = settings['auto_report_interval'] if settings else None
     
     interval_text = "❌ Отключено"
     if current_interval == 1:
@@ -580,6 +663,16 @@ async def cmd_settings(message: types.Message):
         parse_mode="HTML"
     )
 
+async def schedule_reports(conn, chat_id, interval):
+    """Включает авто-отчеты раз в interval дней; первый отчет отправляется сразу"""
+    now = datetime.now()
+    await conn.execute('''
+        INSERT INTO chat_settings (chat_id, auto_report_interval, last_report_time, next_report_at) 
+        VALUES ($1, $2, NULL, $3) 
+        ON CONFLICT (chat_id) DO UPDATE SET auto_report_interval = $2, last_report_time = NULL, next_report_at = $3, report_attempts = 0
+    ''', chat_id, interval, now)
+    report_scheduler.reschedule(chat_id, now, interval)
+
 @dp.callback_query(F.data == "settings_custom")
 async def handle_settings_custom(callback: CallbackQuery):
     chat_id = callback.message.chat.id
@@ -627,15 +720,12 @@ async def handle_settings_interval(callback: CallbackQuery):
     
     async with db_pool.acquire() as conn:
         if interval == 0:
-            await conn.execute('UPDATE chat_settings SET auto_report_interval = NULL, last_report_time = NULL WHERE chat_id = $1', chat_id)
+            await conn.execute('UPDATE chat_settings SET auto_report_interval = NULL, last_report_time = NULL, next_report_at = NULL, report_attempts = 0 WHERE chat_id = $1', chat_id)
             await conn.execute('INSERT INTO chat_settings (chat_id, auto_report_interval, last_report_time) VALUES ($1, NULL, NULL) ON CONFLICT (chat_id) DO NOTHING', chat_id)
+            report_scheduler.reschedule(chat_id, None, None)
             text = "❌ Автоматические отчеты отключены"
         else:
-            await conn.execute('''
-                INSERT INTO chat_settings (chat_id, auto_report_interval, last_report_time) 
-                VALUES ($1, $2, NULL) 
-                ON CONFLICT (chat_id) DO UPDATE SET auto_report_interval = $2, last_report_time = NULL
-            ''', chat_id, interval)
+            await schedule_reports(conn, chat_id, interval)
             if interval == 1:
                 text = "✅ Автоматические отчеты включены: каждый день"
             elif interval == 7:
@@ -675,122 +765,68 @@ async def cmd_setdays(message: types.Message):
             return
         
         async with db_pool.acquire() as conn:
-            await conn.execute('''
-                INSERT INTO chat_settings (chat_id, auto_report_interval, last_report_time) 
-                VALUES ($1, $2, NULL) 
-                ON CONFLICT (chat_id) DO UPDATE SET auto_report_interval = $2, last_report_time = NULL
-            ''', chat_id, days)
+            await schedule_reports(conn, chat_id, days)
         
         await message.answer(f"✅ Автоматические отчеты настроены: каждые {days} дней")
     except (ValueError, IndexError):
         await message.answer("❌ Используйте формат: /setdays <число>\nНапример: /setdays 3")
 
-async def auto_reports_task():
-    """Задача для автоматической отправки отчетов"""
-    if not db_pool:
-        return
-    
-    while True:
-        await asyncio.sleep(3600)  # Проверяем каждый час
-        try:
-            async with db_pool.acquire() as conn:
-                # Получаем все чаты с включенными автоматическими отчетами
-                settings_rows = await conn.fetch('''
-                    SELECT chat_id, auto_report_interval, last_report_time 
-                    FROM chat_settings 
-                    WHERE auto_report_interval IS NOT NULL
-                ''')
-                
-                now = datetime.now()
-                
-                for row in settings_rows:
-                    chat_id = row['chat_id']
-                    interval = row['auto_report_interval']
-                    last_report = row['last_report_time']
-                    
-                    # Проверяем, нужно ли отправить отчет
-                    should_send = False
-                    if last_report is None:
-                        # Первый отчет - отправляем сразу
-                        should_send = True
-                    else:
-                        # Проверяем, прошло ли достаточно времени
-                        next_report = last_report + timedelta(days=interval)
-                        if now >= next_report:
-                            should_send = True
-                    
-                    if should_send:
-                        try:
-                            print(f"📊 Отправка автоматического отчета в чат {chat_id}")
-                            await send_stats_auto(chat_id)
-                            
-                            # Обновляем время последнего отчета
-                            await conn.execute('''
-                                UPDATE chat_settings 
-                                SET last_report_time = $1 
-                                WHERE chat_id = $2
-                            ''', now, chat_id)
-                        except Exception as e:
-                            print(f"⚠️ Ошибка отправки авто-отчета в чат {chat_id}: {e}")
-        except Exception as e:
-            print(f"⚠️ Ошибка в auto_reports_task: {e}")
-
 @dp.message(Command("start"))
 async def cmd_start(message: types.Message):
     await message.answer("Я считаю статистику. Напиши /stats. (API работает)")
 
 @dp.my_chat_member()
 async def on_bot_status_change(event: types.ChatMemberUpdated):
+    if title_reconciler:
+        title_reconciler.on_bot_member(event)
     if event.new_chat_member.status in (ChatMemberStatus.LEFT, ChatMemberStatus.KICKED):
         await delete_chat_data(event.chat.id)
 
 @dp.message(F.sticker)
 async def count_stickers(message: types.Message):
-    if not db_pool: return
+    if not stats_buffer: return
     sticker = message.sticker
     file_id = sticker.file_id
     unique_id = sticker.file_unique_id
     
-    async with db_pool.acquire() as conn:
-        await conn.execute('''
-            INSERT INTO sticker_stats (chat_id, unique_id, file_id, count) VALUES ($1, $2, $3, 1)
-            ON CONFLICT (chat_id, unique_id) DO UPDATE SET count = sticker_stats.count + 1, file_id = EXCLUDED.file_id
-        ''', message.chat.id, unique_id, file_id)
+    stats_buffer.add_sticker(message.chat.id, unique_id, file_id)
 
 @dp.message_reaction()
 async def track_reactions(event: MessageReactionUpdated):
-    if not db_pool: return
-    chat_id = event.chat.id
-    message_id = event.message_id
-    count = len(event.new_reaction)
-    async with db_pool.acquire() as conn:
-        await conn.execute('UPDATE message_stats SET reaction_count = $1 WHERE chat_id = $2 AND message_id = $3', count, chat_id, message_id)
+    if not reaction_buffer: return
+    reaction_buffer.add_change(event.chat.id, event.message_id, len(event.old_reaction), len(event.new_reaction))
+
+@dp.message_reaction_count()
+async def track_reaction_counts(event: MessageReactionCountUpdated):
+    """Анонимные реакции: Telegram присылает итог по сообщению"""
+    if not reaction_buffer: return
+    reaction_buffer.set_total(event.chat.id, event.message_id, sum(r.total_count for r in event.reactions))
 
 @dp.message(F.text)
 async def process_text_message(message: types.Message):
     if message.text.startswith("/"): return
-    if not db_pool: return
+    if not stats_buffer: return
     chat_id = message.chat.id
+    if chat_id in stats_buffer.blocked_chats: return
     user_id = message.from_user.id
     name = message.from_user.full_name
     text = message.text
 
-    async with db_pool.acquire() as conn:
-        await conn.execute('''
-            INSERT INTO user_stats (chat_id, user_id, full_name, msg_count) VALUES ($1, $2, $3, 1)
-            ON CONFLICT (chat_id, user_id) DO UPDATE SET msg_count = user_stats.msg_count + 1, full_name = EXCLUDED.full_name
-        ''', chat_id, user_id, name)
-        
-        await conn.execute('INSERT INTO message_stats (chat_id, message_id, user_id, full_name, content, length, reaction_count) VALUES ($1, $2, $3, $4, $5, $6, 0)', 
-                           chat_id, message.message_id, user_id, name, text, len(text))
-        
-        for word in clean_and_split_text(text):
-            await conn.execute('''
-                INSERT INTO word_stats (chat_id, word, count) VALUES ($1, $2, 1)
-                ON CONFLICT (chat_id, word) DO UPDATE SET count = word_stats.count + 1
-            ''', chat_id, word)
+    words = await text_service.analyze(text)
+    stats_buffer.add_message(chat_id, message.message_id, user_id, name, text, words)
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--role", help="роли процесса через запятую: ingest, api, scheduler, render (по умолчанию все)")
+    args = parser.parse_args()
+    if args.role:
+        configure_roles(args.role)
+
     port = int(os.getenv("SERVER_PORT", os.getenv("PORT", 8000)))
-    print(f"🏁 Запуск сервера на порту {port}")
-    uvicorn.run(app, host="0.0.0.0", port=port)
\ No newline at end of file
+    workers = int(os.getenv("WEB_WORKERS", 1))
+    logger.info("Запуск сервера на порту %s", port)
+    if workers > 1:
+        # Несколько процессов имеет смысл только в режиме webhook: long polling может вести один процесс
+        uvicorn.run("bot:app", host="0.0.0.0", port=port, workers=workers)
+    else:
+        uvicorn.run(app, host="0.0.0.0", port=port)
\ No newline at end of file
@@ -0,0 +1,227 @@
+import asyncio
+import os
+import time
+
+from api_cache import BUMP_CHAT_VERSIONS
+from message_retention import ARCHIVE_PREFIX, rows_affected
+from log import get_logger, fields
+
+logger = get_logger(__name__)
+
+# Удаление данных чата, из которого удалили бота: фоновая очередь удаляет строки
+# небольшими пачками (каждая в своей транзакции вместе с прогрессом задания), чтобы
+# не держать соединение и блокировки, пока остальные чаты пишут статистику.
+# Задания хранятся в chat_purge_jobs и продолжаются после перезапуска. Удаление выполняет
+# только ведущий процесс (run), а процессы, принимающие апдейты (start), блокируют у себя
+# чаты с незавершенными заданиями и снимают блокировку, когда задание выполнено.
+
+CHAT_PURGE_BATCH = int(os.getenv("CHAT_PURGE_BATCH", 5000))
+CHAT_PURGE_PAUSE = float(os.getenv("CHAT_PURGE_PAUSE", 0.05))
+CHAT_PURGE_RETRY_DELAY = float(os.getenv("CHAT_PURGE_RETRY_DELAY", 60))
+CHAT_PURGE_POLL = float(os.getenv("CHAT_PURGE_POLL", 30))
+
+CHAT_PURGE_SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS chat_purge_jobs (chat_id BIGINT PRIMARY KEY, requested_at TIMESTAMP, started_at TIMESTAMP, finished_at TIMESTAMP, stage TEXT, rows_deleted BIGINT DEFAULT 0)''',
+]
+
+# Сначала настройки, чтобы сразу прекратились авто-отчеты, затем таблицы от больших к маленьким
+PURGE_TABLES = ["chat_settings", "message_stats", "word_stats", "word_sketches", "stats_rollup", "sticker_stats", "user_stats", "chat_leaderboard", "chat_titles"]
+
+DELETE_BATCH_SQL = 'DELETE FROM {table} WHERE ctid = ANY(ARRAY(SELECT ctid FROM {table} WHERE chat_id = $1 LIMIT $2))'
+
+
+class ChatPurger:
+    def __init__(self, pool, stats_buffer, batch_size=CHAT_PURGE_BATCH, pause=CHAT_PURGE_PAUSE,
+                 retry_delay=CHAT_PURGE_RETRY_DELAY, poll_interval=CHAT_PURGE_POLL):
+        self.pool = pool
+        self.stats_buffer = stats_buffer
+        self.batch_size = batch_size
+        self.pause = pause
+        self.retry_delay = retry_delay
+        self.poll_interval = poll_interval
+        # Обработчики, вызываемые с chat_id после удаления данных (сброс кэшей)
+        self.on_purged = []
+
+        self.queue = asyncio.Queue()
+        self.queued = set()
+        self._watcher = None
+        self._running = False
+
+        self.current = None
+        self.completed = 0
+        self.errors = 0
+        self.rows_deleted = 0
+        self.last_duration = 0.0
+        self.max_duration = 0.0
+
+    def _enqueue(self, chat_id):
+        if chat_id not in self.queued:
+            self.queued.add(chat_id)
+            self.queue.put_nowait(chat_id)
+
+    async def request(self, chat_id):
+        """Ставит удаление в очередь; прием статистики чата прекращается сразу"""
+        self.stats_buffer.block_chat(chat_id)
+        # Удалять может другой процесс: уже принятые дельты чата должны попасть в базу до задания
+        await self.stats_buffer.flush()
+        async with self.pool.acquire() as conn:
+            await conn.execute('''
+                INSERT INTO chat_purge_jobs (chat_id, requested_at, stage, rows_deleted)
+                VALUES ($1, now() AT TIME ZONE 'utc', 'queued', 0)
+                ON CONFLICT (chat_id) DO UPDATE
+                SET requested_at = EXCLUDED.requested_at, started_at = NULL, finished_at = NULL, stage = 'queued', rows_deleted = 0
+            ''', chat_id)
+        if self._running:
+            self._enqueue(chat_id)
+
+    async def _unfinished(self):
+        async with self.pool.acquire() as conn:
+            rows = await conn.fetch('SELECT chat_id FROM chat_purge_jobs WHERE finished_at IS NULL ORDER BY requested_at')
+        return [row['chat_id'] for row in rows]
+
+    async def start(self):
+        """Блокирует прием статистики чатов с незавершенными заданиями и следит за их выполнением"""
+        for chat_id in await self._unfinished():
+            self.stats_buffer.block_chat(chat_id)
+        self._watcher = asyncio.create_task(self._watch())
+
+    async def stop(self):
+        if self._watcher:
+            self._watcher.cancel()
+            try:
+                await self._watcher
+            except asyncio.CancelledError:
+                pass
+
+    async def _watch(self):
+        """Снимает блокировку с чатов, данные которых удалил другой процесс"""
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            blocked = list(self.stats_buffer.blocked_chats - self.queued)
+            if not blocked:
+                continue
+            try:
+                async with self.pool.acquire() as conn:
+                    rows = await conn.fetch(
+                        'SELECT chat_id FROM chat_purge_jobs WHERE chat_id = ANY($1::bigint[]) AND finished_at IS NOT NULL', blocked
+                    )
+            except Exception as e:
+                logger.warning("Ошибка проверки заданий удаления чатов: %s", e)
+                continue
+            for row in rows:
+                self._finish(row['chat_id'])
+
+    def _finish(self, chat_id):
+        self.stats_buffer.unblock_chat(chat_id)
+        for callback in self.on_purged:
+            try:
+                callback(chat_id)
+            except Exception:
+                logger.exception("Ошибка обработчика удаления чата", extra=fields(chat_id=chat_id))
+
+    async def run(self):
+        """Обработчик очереди (в ведущем процессе): незавершенные задания, в том числе поставленные
+        другими процессами, подхватываются раз в poll_interval"""
+        self._running = True
+        poller = asyncio.create_task(self._poll())
+        try:
+            await self._run()
+        finally:
+            poller.cancel()
+            self._running = False
+            self.queued.clear()
+            self.queue = asyncio.Queue()
+
+    async def _poll(self):
+        while True:
+            try:
+                chat_ids = [chat_id for chat_id in await self._unfinished() if chat_id not in self.queued]
+                for chat_id in chat_ids:
+                    self._enqueue(chat_id)
+                if chat_ids:
+                    logger.info("Подхвачено заданий удаления чатов: %d", len(chat_ids))
+            except Exception as e:
+                logger.warning("Ошибка загрузки заданий удаления чатов: %s", e)
+            await asyncio.sleep(self.poll_interval)
+
+    async def _run(self):
+        while True:
+            chat_id = await self.queue.get()
+            try:
+                await self._purge(chat_id)
+            except Exception as e:
+                self.errors += 1
+                logger.warning("Ошибка удаления данных чата, повтор через %.0f с: %s", self.retry_delay, e, extra=fields(chat_id=chat_id))
+                self.queued.discard(chat_id)
+                asyncio.get_running_loop().call_later(self.retry_delay, self._enqueue, chat_id)
+            finally:
+                self.current = None
+                self.queue.task_done()
+
+    async def _tables(self):
+        async with self.pool.acquire() as conn:
+            archives = await conn.fetch("SELECT tablename FROM pg_tables WHERE tablename LIKE $1", ARCHIVE_PREFIX + "%")
+        return PURGE_TABLES + [r['tablename'] for r in archives]
+
+    async def _purge(self, chat_id):
+        started = time.monotonic()
+        self.current = {"chat_id": chat_id, "table": None, "rows_deleted": 0}
+
+        # Дожидаемся сброса, который мог забрать дельты чата до блокировки
+        await self.stats_buffer.flush()
+        async with self.pool.acquire() as conn:
+            await conn.execute(
+                "UPDATE chat_purge_jobs SET started_at = COALESCE(started_at, now() AT TIME ZONE 'utc') WHERE chat_id = $1", chat_id
+            )
+
+        for table in await self._tables():
+            self.current["table"] = table
+            sql = DELETE_BATCH_SQL.format(table=table)
+            while True:
+                async with self.pool.acquire() as conn:
+                    async with conn.transaction():
+                        deleted = rows_affected(await conn.execute(sql, chat_id, self.batch_size))
+                        await conn.execute(
+                            'UPDATE chat_purge_jobs SET stage = $2, rows_deleted = rows_deleted + $3 WHERE chat_id = $1',
+                            chat_id, table, deleted,
+                        )
+                self.current["rows_deleted"] += deleted
+                self.rows_deleted += deleted
+                if deleted < self.batch_size:
+                    break
+                await asyncio.sleep(self.pause)
+
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                # Строка версии остается: иначе ETag и Last-Modified откатились бы к нулю
+                # и клиент получил бы 304 со старой статистикой вместо пустой
+                await BUMP_CHAT_VERSIONS.execute(conn, [chat_id])
+                await conn.execute(
+                    "UPDATE chat_purge_jobs SET stage = 'done', finished_at = now() AT TIME ZONE 'utc' WHERE chat_id = $1", chat_id
+                )
+
+        self.queued.discard(chat_id)
+        self._finish(chat_id)
+
+        duration = time.monotonic() - started
+        self.completed += 1
+        self.last_duration = duration
+        self.max_duration = max(self.max_duration, duration)
+        logger.info("Данные чата удалены", extra=fields(chat_id=chat_id, rows=self.current['rows_deleted'], seconds=round(duration, 1)))
+
+    def collect(self):
+        yield "chat_purges_total", "counter", "Выполненные удаления данных чатов", [({}, self.completed)]
+        yield "chat_purge_errors_total", "counter", "Ошибки удаления данных чатов", [({}, self.errors)]
+        yield "chat_purge_rows_total", "counter", "Удаленные строки", [({}, self.rows_deleted)]
+        yield "chat_purge_queued", "gauge", "Чаты в очереди на удаление", [({}, len(self.queued))]
+
+    def stats(self):
+        return {
+            "queued": len(self.queued),
+            "current": dict(self.current) if self.current else None,
+            "completed": self.completed,
+            "errors": self.errors,
+            "rows_deleted": self.rows_deleted,
+            "last_duration_seconds": round(self.last_duration, 3),
+            "max_duration_seconds": round(self.max_duration, 3),
+        }
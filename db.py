@@ -0,0 +1,147 @@
+import asyncio
+import os
+import time
+
+import asyncpg
+
+from instrumentation import POOL_ACQUIRE_SECONDS, POOL_ACQUIRE_TIMEOUTS, QUERY_NAMES, init_connection
+from log import get_logger
+
+logger = get_logger(__name__)
+
+# Доступ к базе: пул asyncpg с настраиваемыми размерами и временем жизни соединений,
+# ограничение ожидания свободного соединения и реестр горячих запросов (сброс счетчиков,
+# лидерборды). Подготовкой занимается кэш запросов asyncpg: запрос готовится один раз
+# на соединение и переподготавливается самим asyncpg, если схема поменялась. Кэш
+# больше числа объявленных Query, поэтому разовые запросы не вытесняют горячие.
+#
+# За pgbouncer в режиме transaction подготовленные запросы не работают: там нужен
+# DB_STATEMENT_CACHE_SIZE=0, и запросы выполняются без подготовки.
+
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", 2))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", 10))
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", 100))
+# Соединение пересоздается после стольких запросов и после простоя дольше стольких секунд
+DB_MAX_QUERIES = int(os.getenv("DB_MAX_QUERIES", 50000))
+DB_MAX_INACTIVE_LIFETIME = float(os.getenv("DB_MAX_INACTIVE_LIFETIME", 300))
+DB_ACQUIRE_TIMEOUT = float(os.getenv("DB_ACQUIRE_TIMEOUT", 10))
+DB_COMMAND_TIMEOUT = float(os.getenv("DB_COMMAND_TIMEOUT", 60))
+
+
+
+class PoolExhausted(Exception):
+    """Свободное соединение не появилось за DB_ACQUIRE_TIMEOUT"""
+
+
+class Query:
+    """Горячий запрос: в метриках db_query_seconds помечается своим именем"""
+
+    names = set()
+
+    def __init__(self, name, sql):
+        if name in Query.names:
+            raise ValueError(f"Запрос {name} уже объявлен")
+        Query.names.add(name)
+        self.name = name
+        self.sql = sql
+        QUERY_NAMES[sql] = name
+
+    async def fetch(self, conn, *args):
+        return await conn.fetch(self.sql, *args)
+
+    async def fetchrow(self, conn, *args):
+        return await conn.fetchrow(self.sql, *args)
+
+    async def fetchval(self, conn, *args):
+        return await conn.fetchval(self.sql, *args)
+
+    async def execute(self, conn, *args):
+        return await conn.execute(self.sql, *args)
+
+
+class _Acquire:
+    def __init__(self, pool, timeout):
+        self.pool = pool
+        self.context = pool.pool.acquire(timeout=timeout)
+        self.timeout = timeout
+
+    async def __aenter__(self):
+        started = time.perf_counter()
+        self.pool.waiting += 1
+        try:
+            conn = await self.context.__aenter__()
+        except asyncio.TimeoutError:
+            POOL_ACQUIRE_TIMEOUTS.inc()
+            logger.warning("Нет свободного соединения за %.1f с", self.timeout)
+            raise PoolExhausted(f"Нет свободного соединения за {self.timeout:.1f} с") from None
+        finally:
+            self.pool.waiting -= 1
+            POOL_ACQUIRE_SECONDS.observe(time.perf_counter() - started)
+        return conn
+
+    async def __aexit__(self, *exc):
+        return await self.context.__aexit__(*exc)
+
+
+class Pool:
+    """Обертка пула asyncpg: ожидание соединения ограничено и измеряется"""
+
+    def __init__(self, pool, acquire_timeout=DB_ACQUIRE_TIMEOUT):
+        self.pool = pool
+        self.acquire_timeout = acquire_timeout
+        self.waiting = 0
+
+    def acquire(self, *, timeout=None):
+        return _Acquire(self, timeout or self.acquire_timeout)
+
+    # Запросы в одно действие: соединение берется только на время запроса
+
+    async def fetch(self, sql, *args):
+        async with self.acquire() as conn:
+            return await conn.fetch(sql, *args)
+
+    async def fetchrow(self, sql, *args):
+        async with self.acquire() as conn:
+            return await conn.fetchrow(sql, *args)
+
+    async def fetchval(self, sql, *args):
+        async with self.acquire() as conn:
+            return await conn.fetchval(sql, *args)
+
+    async def execute(self, sql, *args):
+        async with self.acquire() as conn:
+            return await conn.execute(sql, *args)
+
+    def __getattr__(self, name):
+        return getattr(self.pool, name)
+
+    def collect(self):
+        yield "db_pool_connections", "gauge", "Соединения пула", [
+            ({"state": "open"}, self.pool.get_size()), ({"state": "idle"}, self.pool.get_idle_size()),
+            ({"state": "max"}, self.pool.get_max_size()),
+        ]
+        yield "db_pool_waiting", "gauge", "Ожидающие свободного соединения", [({}, self.waiting)]
+
+    def stats(self):
+        return {
+            "size": self.pool.get_size(),
+            "idle": self.pool.get_idle_size(),
+            "min_size": self.pool.get_min_size(),
+            "max_size": self.pool.get_max_size(),
+            "waiting": self.waiting,
+        }
+
+
+async def create_pool(dsn, min_size=DB_POOL_MIN_SIZE, max_size=DB_POOL_MAX_SIZE, **kwargs):
+    pool = await asyncpg.create_pool(
+        dsn=dsn,
+        min_size=min_size,
+        max_size=max_size,
+        statement_cache_size=max(DB_STATEMENT_CACHE_SIZE, 2 * len(Query.names)) if DB_STATEMENT_CACHE_SIZE else 0,
+        max_queries=DB_MAX_QUERIES,
+        max_inactive_connection_lifetime=DB_MAX_INACTIVE_LIFETIME,
+        command_timeout=DB_COMMAND_TIMEOUT,
+        init=init_connection,
+        **kwargs,
+    )
+    return Pool(pool)
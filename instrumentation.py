@@ -0,0 +1,75 @@
+import re
+import time
+from functools import lru_cache
+
+from aiogram import BaseMiddleware
+from aiogram.dispatcher.event.bases import UNHANDLED
+
+from metrics import REGISTRY
+
+# Метрики горячих путей: обработка апдейтов, ожидание соединения из пула и время
+# SQL-запросов (пул и подготовленные запросы - в db.py). Остальные модули отдают
+# свои счетчики через сборщики REGISTRY.
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+UPDATE_SECONDS = REGISTRY.histogram(
+    "update_handler_seconds", "Время обработки апдейта Telegram", ("update_type", "status"), LATENCY_BUCKETS,
+)
+POOL_ACQUIRE_SECONDS = REGISTRY.histogram(
+    "db_pool_acquire_seconds", "Ожидание свободного соединения из пула", (), LATENCY_BUCKETS,
+)
+POOL_ACQUIRE_TIMEOUTS = REGISTRY.counter("db_pool_acquire_timeouts_total", "Соединение из пула не получено за отведенное время")
+SQL_SECONDS = REGISTRY.histogram(
+    "db_query_seconds", "Время выполнения SQL-запроса по виду запроса", ("statement",), LATENCY_BUCKETS,
+)
+SQL_ERRORS = REGISTRY.counter("db_query_errors_total", "Ошибки SQL-запросов по виду запроса", ("statement",))
+
+_CTE_RE = re.compile(r'^\s*WITH\b.*?\)\s*(SELECT|INSERT|UPDATE|DELETE)\b', re.I | re.S)
+_TABLE_RE = re.compile(r'\b(?:FROM|INTO|UPDATE|JOIN|TABLE(?:\s+IF\s+(?:NOT\s+)?EXISTS)?|ON)\s+([a-z_][\w.]*)', re.I)
+
+
+# Текст запроса -> имя горячего запроса (db.Query): такие запросы помечаются своим именем
+QUERY_NAMES = {}
+
+
+@lru_cache(maxsize=1024)
+def statement_name(query):
+    """Вид запроса для меток: 'insert user_stats', 'with/delete message_stats_archive_N'"""
+    words = query.split(None, 1)
+    if not words:
+        return "empty"
+    verb = words[0].lower()
+    cte = _CTE_RE.match(query) if verb == "with" else None
+    if cte:
+        verb = f"with/{cte.group(1).lower()}"
+    table = _TABLE_RE.search(query)
+    name = f"{verb} {table.group(1).lower()}" if table else verb
+    # Помесячные архивные таблицы не должны плодить новые ряды метрик
+    return re.sub(r'\d+', 'N', name)
+
+
+def _log_query(record):
+    name = QUERY_NAMES.get(record.query) or statement_name(record.query)
+    SQL_SECONDS.labels(name).observe(record.elapsed)
+    if record.exception is not None:
+        SQL_ERRORS.labels(name).inc()
+
+
+async def init_connection(conn):
+    """init= для asyncpg.create_pool: время каждого запроса соединения попадает в метрики"""
+    conn.add_query_logger(_log_query)
+
+
+class UpdateMetricsMiddleware(BaseMiddleware):
+    """Внешний middleware dp.update: время обработки по типу апдейта и результату"""
+
+    async def __call__(self, handler, event, data):
+        started = time.perf_counter()
+        status = "error"
+        try:
+            result = await handler(event, data)
+            status = "unhandled" if result is UNHANDLED else "ok"
+            return result
+        finally:
+            UPDATE_SECONDS.labels(event.event_type, status).observe(time.perf_counter() - started)
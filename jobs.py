@@ -0,0 +1,200 @@
+import asyncio
+import json
+import os
+import socket
+import time
+from datetime import datetime, timezone
+
+from metrics import Histogram
+from log import get_logger, fields
+
+logger = get_logger(__name__)
+
+# Очередь заданий в Postgres для передачи работы между процессами (см. roles.py):
+# планировщик и прием апдейтов ставят задания, процессы с ролью render их выполняют.
+# Задание забирается через FOR UPDATE SKIP LOCKED и аренду locked_until: если процесс
+# упал посреди работы, после окончания аренды задание заберет другой. Выполненные
+# задания удаляются, исчерпавшие попытки остаются в таблице с failed_at и без
+# dedupe_key, чтобы не блокировать следующие такие же задания.
+
+JOBS_CONCURRENCY = int(os.getenv("JOBS_CONCURRENCY", 4))
+JOBS_POLL_INTERVAL = float(os.getenv("JOBS_POLL_INTERVAL", 1))
+JOBS_LEASE = float(os.getenv("JOBS_LEASE", 300))
+JOBS_MAX_ATTEMPTS = int(os.getenv("JOBS_MAX_ATTEMPTS", 3))
+JOBS_RETRY_DELAY = float(os.getenv("JOBS_RETRY_DELAY", 30))
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 10
+
+JOBS_SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS jobs (id BIGSERIAL PRIMARY KEY, kind TEXT NOT NULL, payload JSONB NOT NULL DEFAULT '{}', priority INTEGER NOT NULL DEFAULT 10, dedupe_key TEXT, run_at TIMESTAMP NOT NULL DEFAULT (now() AT TIME ZONE 'utc'), attempts INTEGER NOT NULL DEFAULT 0, locked_until TIMESTAMP, locked_by TEXT, last_error TEXT, failed_at TIMESTAMP, created_at TIMESTAMP DEFAULT (now() AT TIME ZONE 'utc'))''',
+    # Одно и то же задание (отчет в чат) не ставится повторно, пока предыдущее не выполнено
+    '''CREATE UNIQUE INDEX IF NOT EXISTS jobs_dedupe_idx ON jobs (dedupe_key) WHERE dedupe_key IS NOT NULL''',
+    '''CREATE INDEX IF NOT EXISTS jobs_ready_idx ON jobs (priority, run_at) WHERE failed_at IS NULL''',
+]
+
+# Проваленные до этого задания держали dedupe_key и навсегда блокировали повторы
+JOBS_RELEASE_FAILED_SCHEMA = [
+    '''UPDATE jobs SET dedupe_key = NULL WHERE failed_at IS NOT NULL AND dedupe_key IS NOT NULL''',
+]
+
+ENQUEUE_SQL = '''
+    INSERT INTO jobs (kind, payload, priority, dedupe_key) VALUES ($1, $2::jsonb, $3, $4)
+    ON CONFLICT (dedupe_key) WHERE dedupe_key IS NOT NULL DO NOTHING
+    RETURNING id
+'''
+
+CLAIM_SQL = '''
+    UPDATE jobs SET attempts = attempts + 1, locked_by = $3,
+                    locked_until = (now() AT TIME ZONE 'utc') + make_interval(secs => $4)
+    WHERE id IN (
+        SELECT id FROM jobs
+        WHERE failed_at IS NULL AND kind = ANY($1::text[])
+          AND run_at <= (now() AT TIME ZONE 'utc')
+          AND (locked_until IS NULL OR locked_until < (now() AT TIME ZONE 'utc'))
+        ORDER BY priority, run_at
+        LIMIT $2 FOR UPDATE SKIP LOCKED
+    )
+    RETURNING id, kind, payload, attempts, created_at
+'''
+
+RETRY_SQL = '''
+    UPDATE jobs SET locked_until = NULL, locked_by = NULL, last_error = $2,
+                    run_at = (now() AT TIME ZONE 'utc') + make_interval(secs => $3)
+    WHERE id = $1
+'''
+
+FAIL_SQL = '''
+    UPDATE jobs SET locked_until = NULL, locked_by = NULL, last_error = $2, failed_at = now() AT TIME ZONE 'utc',
+                    dedupe_key = NULL
+    WHERE id = $1
+'''
+
+
+class JobQueue:
+    def __init__(self, pool, concurrency=JOBS_CONCURRENCY, poll_interval=JOBS_POLL_INTERVAL, lease=JOBS_LEASE,
+                 max_attempts=JOBS_MAX_ATTEMPTS, retry_delay=JOBS_RETRY_DELAY):
+        self.pool = pool
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self.handlers = {}  # вид задания -> async handler(payload)
+
+        self.running = set()
+        self._wakeup = asyncio.Event()
+
+        self.enqueued = 0
+        self.deduplicated = 0
+        self.completed = 0
+        self.retried = 0
+        self.failed = 0
+        self.queue_wait = Histogram((0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0))
+        self.run_time = {}
+
+    def register(self, kind, handler):
+        self.handlers[kind] = handler
+        self.run_time[kind] = Histogram((0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0))
+
+    async def enqueue(self, kind, payload, priority=PRIORITY_BACKGROUND, dedupe_key=None):
+        """Ставит задание; False, если такое задание (dedupe_key) уже ждет выполнения"""
+        async with self.pool.acquire() as conn:
+            job_id = await conn.fetchval(ENQUEUE_SQL, kind, json.dumps(payload), priority, dedupe_key)
+        if job_id is None:
+            self.deduplicated += 1
+            return False
+        self.enqueued += 1
+        # Задание мог поставить этот же процесс - не ждем следующего опроса
+        self._wakeup.set()
+        return True
+
+    async def run(self):
+        """Забирает и выполняет задания зарегистрированных видов, не больше concurrency одновременно"""
+        kinds = list(self.handlers)
+        while True:
+            free = self.concurrency - len(self.running)
+            rows = []
+            if free > 0:
+                try:
+                    async with self.pool.acquire() as conn:
+                        rows = await conn.fetch(CLAIM_SQL, kinds, free, self.worker_id, self.lease)
+                except Exception as e:
+                    logger.warning("Ошибка получения заданий: %s", e)
+            for row in rows:
+                task = asyncio.create_task(self._execute(row))
+                self.running.add(task)
+                task.add_done_callback(self._finished)
+            if rows and len(rows) == free:
+                # Заданий могло остаться больше - ждем только освобождения места
+                await self._wait(None)
+            elif not rows:
+                await self._wait(self.poll_interval)
+
+    def _finished(self, task):
+        self.running.discard(task)
+        self._wakeup.set()
+
+    async def _wait(self, timeout):
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+        self._wakeup.clear()
+
+    async def _execute(self, row):
+        kind = row['kind']
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        self.queue_wait.observe(max(0.0, (now - row['created_at']).total_seconds()))
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(self.handlers[kind](json.loads(row['payload'])), self.lease)
+            async with self.pool.acquire() as conn:
+                await conn.execute('DELETE FROM jobs WHERE id = $1', row['id'])
+            self.completed += 1
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            try:
+                async with self.pool.acquire() as conn:
+                    if row['attempts'] >= self.max_attempts:
+                        self.failed += 1
+                        await conn.execute(FAIL_SQL, row['id'], error)
+                        logger.error("Задание не выполнено после %d попыток: %s", row['attempts'], error, extra=fields(kind=kind, job_id=row['id']))
+                    else:
+                        self.retried += 1
+                        await conn.execute(RETRY_SQL, row['id'], error, self.retry_delay * 2 ** (row['attempts'] - 1))
+                        logger.warning("Задание будет повторено: %s", error, extra=fields(kind=kind, job_id=row['id']))
+            except Exception as db_error:
+                # Аренда истечет, и задание заберут снова
+                logger.warning("Не удалось записать результат задания: %s", db_error, extra=fields(job_id=row['id']))
+        finally:
+            self.run_time[kind].observe(time.perf_counter() - started)
+
+    async def stop(self):
+        for task in list(self.running):
+            task.cancel()
+        await asyncio.gather(*self.running, return_exceptions=True)
+
+    def collect(self):
+        yield "jobs_total", "counter", "Задания по результату", [
+            ({"result": "completed"}, self.completed), ({"result": "retried"}, self.retried), ({"result": "failed"}, self.failed),
+        ]
+        yield "jobs_enqueued_total", "counter", "Поставленные этим процессом задания", [({}, self.enqueued)]
+        yield "jobs_running", "gauge", "Задания, выполняемые сейчас", [({}, len(self.running))]
+        yield "job_queue_wait_seconds", "histogram", "Время от постановки до начала выполнения", [({}, self.queue_wait)]
+        yield "job_run_seconds", "histogram", "Время выполнения задания", [({"kind": k}, h) for k, h in self.run_time.items()]
+
+    def stats(self):
+        return {
+            "worker": self.worker_id,
+            "kinds": list(self.handlers),
+            "running": len(self.running),
+            "enqueued": self.enqueued,
+            "deduplicated": self.deduplicated,
+            "completed": self.completed,
+            "retried": self.retried,
+            "failed": self.failed,
+            "queue_wait": self.queue_wait.snapshot(),
+            "run_time": {kind: h.snapshot() for kind, h in self.run_time.items()},
+        }
@@ -0,0 +1,91 @@
+import asyncio
+import hashlib
+import os
+import time
+from log import get_logger, fields
+
+logger = get_logger(__name__)
+
+# Выбор ведущего процесса через advisory lock Postgres: задачи, которые должны работать
+# в единственном экземпляре (планировщик отчетов, титулы, обслуживание базы, long polling),
+# запускаются только в процессе, взявшем блокировку. Блокировка держится соединением из
+# пула; если оно оборвалось, задачи останавливаются, а блокировку забирает другой процесс.
+
+LEADER_RETRY = float(os.getenv("LEADER_RETRY", 15))
+LEADER_CHECK_INTERVAL = float(os.getenv("LEADER_CHECK_INTERVAL", 10))
+LEADER_CHECK_TIMEOUT = float(os.getenv("LEADER_CHECK_TIMEOUT", 5))
+
+
+def lock_key(name):
+    """Стабильный 64-битный ключ advisory lock по имени"""
+    return int.from_bytes(hashlib.sha256(f"chatly:{name}".encode()).digest()[:8], "big", signed=True)
+
+
+class LeaderElection:
+    def __init__(self, pool, name, retry=LEADER_RETRY, check_interval=LEADER_CHECK_INTERVAL,
+                 check_timeout=LEADER_CHECK_TIMEOUT):
+        self.pool = pool
+        self.name = name
+        self.key = lock_key(name)
+        self.retry = retry
+        self.check_interval = check_interval
+        self.check_timeout = check_timeout
+
+        self.is_leader = False
+        self.elected = 0
+        self.lost = 0
+        self.leader_since = None
+
+    async def run(self, *factories):
+        """Пытается стать ведущим и, пока блокировка держится, выполняет задачи factories()"""
+        while True:
+            try:
+                async with self.pool.acquire() as conn:
+                    if await conn.fetchval('SELECT pg_try_advisory_lock($1)', self.key):
+                        try:
+                            await self._lead(conn, factories)
+                        finally:
+                            # При возврате в пул соединение сбрасывается и снимает все свои блокировки
+                            self.is_leader = False
+                            self.leader_since = None
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("Ошибка выбора ведущего: %s", e, extra=fields(election=self.name))
+            await asyncio.sleep(self.retry)
+
+    async def _lead(self, conn, factories):
+        self.is_leader = True
+        self.elected += 1
+        self.leader_since = time.time()
+        logger.info("Процесс стал ведущим", extra=fields(election=self.name))
+        tasks = [asyncio.create_task(factory()) for factory in factories]
+        pending = set(tasks)
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, timeout=self.check_interval, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if not task.cancelled() and task.exception():
+                        # Блокировка отпускается, задачи перезапустит следующий ведущий
+                        raise task.exception()
+                if not pending:
+                    return
+                # Соединение с блокировкой живо - значит, блокировка все еще наша
+                try:
+                    await asyncio.wait_for(conn.fetchval('SELECT 1'), self.check_timeout)
+                except Exception as e:
+                    self.lost += 1
+                    logger.warning("Процесс перестал быть ведущим: %r", e, extra=fields(election=self.name))
+                    return
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stats(self):
+        return {
+            "is_leader": self.is_leader,
+            "elected": self.elected,
+            "lost": self.lost,
+            "leader_for_seconds": round(time.time() - self.leader_since, 1) if self.leader_since else None,
+        }
@@ -0,0 +1,309 @@
+import asyncio
+import os
+import sys
+import time
+from collections import OrderedDict
+
+from db import Query
+
+# Топ-N пользователей, слов и стикеров по каждому чату. Держится в памяти и
+# обновляется при каждом сбросе счетчиков (значения берутся из RETURNING, поэтому
+# обновление идемпотентно), копия хранится в небольшой таблице chat_leaderboard.
+# В таблицу пишутся только изменившиеся ключи (upsert с GREATEST), а лишние строки
+# обрезаются по рангу: несколько ingest-процессов не затирают топы друг друга.
+
+LEADERBOARD_SIZE = int(os.getenv("LEADERBOARD_SIZE", 10))
+LEADERBOARD_MAX_CHATS = int(os.getenv("LEADERBOARD_MAX_CHATS", 50000))
+# Процесс видит только свои сбросы счетчиков и перечитывает топ из chat_leaderboard
+# не реже раза в ttl секунд; 0 - не перечитывать (единственный процесс с приемом апдейтов)
+LEADERBOARD_TTL = float(os.getenv("LEADERBOARD_TTL", 30))
+
+# вид -> (таблица, ключ, подпись, счетчик, условие)
+KINDS = {
+    "user": ("user_stats", "user_id::text", "full_name", "msg_count", "TRUE"),
+    "word": ("word_stats", "word", "NULL", "count", "TRUE"),
+    "sticker": ("sticker_stats", "unique_id", "file_id", "count", "TRUE"),
+    # Сообщения по реакциям (частичный индекс из reactions.py); счетчик может уменьшаться
+    "message": ("message_stats", "message_id::text", "full_name", "reaction_count", "reaction_count > 0"),
+}
+# Виды, счетчик которых может уменьшаться: в таблице побеждает последнее значение, а не большее
+DECREASING_KINDS = {"message"}
+
+LEADERBOARD_SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS chat_leaderboard (chat_id BIGINT, kind TEXT, key TEXT, label TEXT, count INTEGER, PRIMARY KEY (chat_id, kind, key))''',
+    '''CREATE INDEX CONCURRENTLY IF NOT EXISTS user_stats_chat_count_idx ON user_stats (chat_id, msg_count DESC) INCLUDE (user_id, full_name)''',
+    '''CREATE INDEX CONCURRENTLY IF NOT EXISTS word_stats_chat_count_idx ON word_stats (chat_id, count DESC) INCLUDE (word)''',
+    '''CREATE INDEX CONCURRENTLY IF NOT EXISTS sticker_stats_chat_count_idx ON sticker_stats (chat_id, count DESC) INCLUDE (unique_id, file_id)''',
+]
+
+LOAD_BOARD = Query("leaderboard_load", 'SELECT kind, key, label, count FROM chat_leaderboard WHERE chat_id=$1')
+# Топ чата одного вида из основной таблицы
+TOP_FROM_TABLE = {
+    kind: Query(
+        f"leaderboard_top_{kind}",
+        f'SELECT $2::text AS kind, {key} AS key, {label} AS label, {count} AS count '
+        f'FROM {table} WHERE chat_id=$1 AND {where} ORDER BY {count} DESC LIMIT $3',
+    )
+    for kind, (table, key, label, count, where) in KINDS.items()
+}
+UPSERT_BOARDS = Query("leaderboard_upsert", '''
+    INSERT INTO chat_leaderboard (chat_id, kind, key, label, count)
+    SELECT * FROM unnest($1::bigint[], $2::text[], $3::text[], $4::text[], $5::int[])
+    ON CONFLICT (chat_id, kind, key) DO UPDATE SET
+        count = CASE WHEN EXCLUDED.kind = ANY($6::text[]) THEN EXCLUDED.count ELSE GREATEST(chat_leaderboard.count, EXCLUDED.count) END,
+        label = COALESCE(EXCLUDED.label, chat_leaderboard.label)
+''')
+# Оставляет в затронутых топах size лучших строк с положительным счетчиком
+TRIM_BOARDS = Query("leaderboard_trim", '''
+    DELETE FROM chat_leaderboard l USING (
+        SELECT chat_id, kind, key, count, row_number() OVER (PARTITION BY chat_id, kind ORDER BY count DESC, key) AS rn
+        FROM chat_leaderboard WHERE (chat_id, kind) IN (SELECT * FROM unnest($1::bigint[], $2::text[]))
+    ) r
+    WHERE l.chat_id = r.chat_id AND l.kind = r.kind AND l.key = r.key AND (r.rn > $3 OR r.count <= 0)
+''')
+INSERT_BOARDS = Query(
+    "leaderboard_insert",
+    'INSERT INTO chat_leaderboard (chat_id, kind, key, label, count) '
+    'SELECT * FROM unnest($1::bigint[], $2::text[], $3::text[], $4::text[], $5::int[])',
+)
+
+
+class Leaderboards:
+    def __init__(self, pool, size=LEADERBOARD_SIZE, max_chats=LEADERBOARD_MAX_CHATS, ttl=0, sources=None):
+        self.pool = pool
+        # вид -> источник топа вместо основной таблицы для части чатов (сводки слов больших чатов)
+        self.sources = sources or {}
+        self.size = size
+        self.max_chats = max_chats
+        self.ttl = ttl
+        self.boards = {}              # (chat_id, вид) -> {ключ: [счетчик, подпись]}
+        self.loaded = OrderedDict()   # chat_id -> время загрузки, в порядке использования
+        self._loading = {}            # chat_id -> future загрузки
+        self.stale = set()            # чаты, которые при следующей загрузке пересчитываются из основных таблиц
+
+        self.loads = 0
+        self.rebuilds = 0
+        self.updates = 0
+
+    # --- загрузка ---
+
+    async def _ensure_loaded(self, chat_ids):
+        expired = time.monotonic() - self.ttl
+        missing = [
+            chat_id for chat_id in chat_ids
+            if chat_id not in self.loaded or (self.ttl and self.loaded[chat_id] < expired)
+        ]
+        if missing:
+            await asyncio.gather(*(self._load(chat_id) for chat_id in missing))
+        for chat_id in chat_ids:
+            # Чат мог быть забыт или сброшен, пока шла загрузка
+            if chat_id in self.loaded:
+                self.loaded.move_to_end(chat_id)
+        while len(self.loaded) > self.max_chats:
+            old_chat, _ = self.loaded.popitem(last=False)
+            self._drop_memory(old_chat)
+
+    async def _load(self, chat_id):
+        future = self._loading.get(chat_id)
+        if future is not None:
+            return await asyncio.shield(future)
+
+        future = asyncio.get_running_loop().create_future()
+        self._loading[chat_id] = future
+        try:
+            async with self.pool.acquire() as conn:
+                rows = None
+                if chat_id not in self.stale:
+                    rows = await LOAD_BOARD.fetch(conn, chat_id)
+                if not rows:
+                    rows = await self._rebuild_chat(conn, chat_id)
+                    self.stale.discard(chat_id)
+            self._drop_memory(chat_id)
+            for row in rows:
+                self.boards.setdefault((chat_id, row['kind']), {})[row['key']] = [row['count'], row['label']]
+            self.loaded[chat_id] = time.monotonic()
+            self.loads += 1
+            future.set_result(None)
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()
+            raise
+        finally:
+            self._loading.pop(chat_id, None)
+
+    async def _rebuild_chat(self, conn, chat_id):
+        """Топ чата из основных таблиц (по индексам chat_id, count DESC) с записью в chat_leaderboard"""
+        rows = []
+        for kind, query in TOP_FROM_TABLE.items():
+            source = self.sources.get(kind)
+            source_rows = await source.top_rows(conn, chat_id, kind, self.size) if source is not None else None
+            rows += source_rows if source_rows is not None else await query.fetch(conn, chat_id, kind, self.size)
+        async with conn.transaction():
+            await conn.execute('DELETE FROM chat_leaderboard WHERE chat_id=$1', chat_id)
+            if rows:
+                await INSERT_BOARDS.execute(
+                    conn, *map(list, zip(*[(chat_id, r['kind'], r['key'], r['label'], r['count']) for r in rows])),
+                )
+        self.rebuilds += 1
+        return rows
+
+    # --- обновление ---
+
+    def _offer(self, chat_id, kind, key, label, count):
+        """True - топ изменился, None - счетчик в полном топе уменьшился и топ надо пересчитать"""
+        board = self.boards.setdefault((chat_id, kind), {})
+        entry = board.get(key)
+        if entry is not None and count < entry[0]:
+            # Неполный топ содержит все ключи, а в полном место могло перейти к ключу вне топа
+            if len(board) >= self.size:
+                return None
+            if count <= 0:
+                del board[key]
+                return True
+        if entry is not None:
+            entry[0] = count
+            if label is not None:
+                entry[1] = label
+            return True
+        if count <= 0:
+            return False
+        if len(board) < self.size:
+            board[key] = [count, label]
+            return True
+        min_key = min(board, key=lambda k: board[k][0])
+        if count > board[min_key][0]:
+            del board[min_key]
+            board[key] = [count, label]
+            return True
+        return False
+
+    async def apply(self, updates):
+        """updates: (chat_id, вид, ключ, подпись, итоговое значение счетчика)"""
+        if not updates:
+            return
+        chat_ids = {u[0] for u in updates}
+        try:
+            await self._ensure_loaded(chat_ids)
+
+            changed = {}  # (chat_id, вид, ключ) -> (подпись, счетчик)
+            shrunk = set()
+            for chat_id, kind, key, label, count in updates:
+                if chat_id in shrunk:
+                    continue
+                offered = self._offer(chat_id, kind, key, label, count)
+                if offered is None:
+                    shrunk.add(chat_id)
+                elif offered:
+                    changed[(chat_id, kind, key)] = (label, count)
+            self.updates += len(updates)
+            for chat_id in shrunk:
+                self._invalidate(chat_id)
+            rows = [(*k, label, count) for k, (label, count) in changed.items() if k[0] not in shrunk]
+            if rows:
+                await self._persist(rows)
+        except Exception:
+            # Обновление потеряно: эти чаты будут пересчитаны при следующем обращении
+            for chat_id in chat_ids:
+                self._invalidate(chat_id)
+            raise
+
+    async def _persist(self, rows):
+        """rows: (chat_id, вид, ключ, подпись, счетчик) изменившихся ключей"""
+        boards = sorted({(r[0], r[1]) for r in rows})
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                await UPSERT_BOARDS.execute(conn, *map(list, zip(*rows)), sorted(DECREASING_KINDS))
+                await TRIM_BOARDS.execute(conn, [b[0] for b in boards], [b[1] for b in boards], self.size)
+
+    # --- чтение ---
+
+    async def top(self, chat_id, kind, limit):
+        """[(ключ, подпись, счетчик), ...] по убыванию счетчика"""
+        await self._ensure_loaded([chat_id])
+        board = self.boards.get((chat_id, kind), {})
+        ranked = sorted(board.items(), key=lambda item: item[1][0], reverse=True)
+        return [(key, label, count) for key, (count, label) in ranked[:limit]]
+
+    # --- обслуживание ---
+
+    def _drop_memory(self, chat_id):
+        for kind in KINDS:
+            self.boards.pop((chat_id, kind), None)
+
+    def _invalidate(self, chat_id):
+        """Топ чата будет пересчитан из основных таблиц при следующем обращении"""
+        self.stale.add(chat_id)
+        self._drop_memory(chat_id)
+        self.loaded.pop(chat_id, None)
+
+    def forget(self, chat_id):
+        """Забывает топ чата в памяти (строки chat_leaderboard удаляются вместе с данными чата)"""
+        self._drop_memory(chat_id)
+        self.loaded.pop(chat_id, None)
+        self.stale.discard(chat_id)
+
+    async def rebuild(self, chat_id=None):
+        """Пересчет из основных таблиц после рассинхронизации: одного чата или всех"""
+        async with self.pool.acquire() as conn:
+            if chat_id is not None:
+                await self._rebuild_chat(conn, chat_id)
+            else:
+                async with conn.transaction():
+                    await conn.execute('DELETE FROM chat_leaderboard')
+                    for kind, (table, key, label, count, where) in KINDS.items():
+                        await conn.execute(
+                            f'INSERT INTO chat_leaderboard (chat_id, kind, key, label, count) '
+                            f'SELECT chat_id, $1, key, label, count FROM ('
+                            f'  SELECT chat_id, {key} AS key, {label} AS label, {count} AS count,'
+                            f'         row_number() OVER (PARTITION BY chat_id ORDER BY {count} DESC) AS rn'
+                            f'  FROM {table} WHERE {where}) ranked WHERE rn <= $2',
+                            kind, self.size,
+                        )
+                        source = self.sources.get(kind)
+                        if source is not None:
+                            rows = await source.all_top_rows(conn, kind, self.size)
+                            if rows:
+                                await INSERT_BOARDS.execute(conn, *map(list, zip(*rows)))
+                self.rebuilds += 1
+        if chat_id is not None:
+            self._drop_memory(chat_id)
+            self.loaded.pop(chat_id, None)
+            self.stale.discard(chat_id)
+        else:
+            self.boards.clear()
+            self.loaded.clear()
+            self.stale.clear()
+
+    def stats(self):
+        return {
+            "size": self.size,
+            "chats_loaded": len(self.loaded),
+            "loads": self.loads,
+            "rebuilds": self.rebuilds,
+            "updates": self.updates,
+            "stale_chats": len(self.stale),
+        }
+
+
+async def _main(argv):
+    import dotenv
+    from db import create_pool
+    from word_sketches import WordSketches
+
+    dotenv.load_dotenv()
+    if len(argv) < 2 or argv[1] != "rebuild":
+        print("Использование: python leaderboard.py rebuild [chat_id]")
+        return 1
+
+    pool = await create_pool(os.getenv("DATABASE_URL"), min_size=1, max_size=2)
+    try:
+        chat_id = int(argv[2]) if len(argv) > 2 else None
+        await Leaderboards(pool, sources={"word": WordSketches(pool)}).rebuild(chat_id)
+        print(f"✅ Лидерборды пересчитаны: {'чат ' + str(chat_id) if chat_id is not None else 'все чаты'}")
+    finally:
+        await pool.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(_main(sys.argv)))
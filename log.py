@@ -0,0 +1,84 @@
+import json
+import logging
+import os
+import random
+import sys
+import time
+
+# Логирование вместо print: уровни, поля записи (chat_id, длительности и т.п.) и выборка
+# для частых записей на горячих путях.
+#   logger = get_logger(__name__)
+#   logger.warning("Ошибка отправки отчета: %s", e, extra=fields(chat_id=chat_id))
+#   logger.info("Отчет построен", extra=sampled(chat_id=chat_id, total=0.8))
+# LOG_FORMAT=json пишет по JSON-объекту на строку для сборщиков логов.
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")  # text | json
+# Доля записей, помеченных sampled(), которые попадают в лог
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", 0.1))
+
+_RESERVED = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+
+def fields(**values):
+    return {"fields": values}
+
+
+def sampled(rate=None, **values):
+    """Поля записи, которая пишется только с вероятностью rate (по умолчанию LOG_SAMPLE_RATE)"""
+    return {"fields": values, "sample_rate": LOG_SAMPLE_RATE if rate is None else rate}
+
+
+class SamplingFilter(logging.Filter):
+    def filter(self, record):
+        rate = getattr(record, "sample_rate", None)
+        return rate is None or random.random() < rate
+
+
+def _record_fields(record):
+    values = dict(getattr(record, "fields", None) or {})
+    for key, value in vars(record).items():
+        if key not in _RESERVED and key not in ("fields", "sample_rate"):
+            values[key] = value
+    return values
+
+
+class TextFormatter(logging.Formatter):
+    def format(self, record):
+        line = f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(record.created))} {record.levelname:<7} {record.name}: {record.getMessage()}"
+        values = _record_fields(record)
+        if values:
+            line += " " + " ".join(f"{key}={value}" for key, value in values.items())
+        if record.exc_info:
+            line += "\n" + self.formatException(record.exc_info)
+        return line
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        entry.update(_record_fields(record))
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def setup_logging(level=LOG_LEVEL, fmt=LOG_FORMAT):
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(JsonFormatter() if fmt == "json" else TextFormatter())
+    handler.addFilter(SamplingFilter())
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(level)
+    # Сообщения aiogram о каждом обработанном апдейте - только на DEBUG
+    if logging.getLevelName(level) > logging.DEBUG:
+        logging.getLogger("aiogram.event").setLevel(logging.WARNING)
+
+
+def get_logger(name):
+    return logging.getLogger(name)
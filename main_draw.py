@@ -1,110 +1,310 @@
 from PIL import Image, ImageDraw, ImageFont
 import io
 import imageio
+import imageio_ffmpeg
 import numpy as np
-import tempfile
 import os
+import subprocess
+import threading
+import time
+import weakref
+from log import get_logger
+
+logger = get_logger(__name__)
+
+# --- ШАБЛОНЫ И ШРИФТЫ ---
+
+ASSETS_DIR = os.getenv("ASSETS_DIR", os.path.dirname(os.path.abspath(__file__)))
+ASSETS_RELOAD_INTERVAL = float(os.getenv("ASSETS_RELOAD_INTERVAL", 5))
+
+FONT_FILE = "stolzl_bold.otf"
+FONT_SIZES = (250, 150, 145, 135, 54, 48)
+AVATAR_SIZE = (910, 910)
+
+# имя -> (файл, цвет заглушки, если файла нет)
+TEMPLATES = {
+    "bg_active": ("bg_active.png", (235, 87, 87)),
+    "bg_words": ("bg_words.png", (235, 87, 87)),
+    "bg_sticker": ("bg_sticker.png", (240, 240, 240)),
+    "bg_reactions": ("bg_reactions.png", (110, 146, 232)),
+    "ramka": ("ramka.png", None),
+}
+
+
+class AssetRegistry:
+    """Фоны, рамка, маски и шрифты загружаются один раз; рендер берет copy() фона"""
+
+    def __init__(self, base_dir=ASSETS_DIR, reload_interval=ASSETS_RELOAD_INTERVAL):
+        self.base_dir = base_dir
+        self.reload_interval = reload_interval
+        self._lock = threading.Lock()
+        self._images = {}   # имя -> RGBA Image или None
+        self._fonts = {}    # размер -> шрифт
+        self._masks = {}    # размер -> маска-круг
+        self._mtimes = {}   # путь -> mtime при загрузке
+        self._checked_at = 0.0
+        self.reloads = 0
+
+    def _path(self, filename):
+        return os.path.join(self.base_dir, filename)
+
+    def _mtime(self, path):
+        try:
+            return os.path.getmtime(path)
+        except OSError:
+            return None
+
+    def _check_reload(self):
+        now = time.monotonic()
+        if self.reload_interval <= 0 or now - self._checked_at < self.reload_interval:
+            return
+        self._checked_at = now
+        changed = [path for path, mtime in self._mtimes.items() if self._mtime(path) != mtime]
+        if not changed:
+            return
+        with self._lock:
+            for path in changed:
+                self._mtimes.pop(path, None)
+                filename = os.path.basename(path)
+                if filename == FONT_FILE:
+                    self._fonts.clear()
+                for name, (template_file, _) in TEMPLATES.items():
+                    if template_file == filename:
+                        self._images.pop(name, None)
+            self.reloads += 1
+
+    def image(self, name):
+        """Общий экземпляр шаблона: не изменять, для рисования использовать background()"""
+        self._check_reload()
+        if name not in self._images:
+            filename, fallback_color = TEMPLATES[name]
+            path = self._path(filename)
+            with self._lock:
+                if name not in self._images:
+                    try:
+                        img = Image.open(path).convert("RGBA")
+                        self._mtimes[path] = self._mtime(path)
+                    except FileNotFoundError:
+                        img = Image.new("RGBA", (2000, 2000), fallback_color) if fallback_color else None
+                    self._images[name] = img
+        return self._images[name]
+
+    def background(self, name):
+        return self.image(name).copy()
+
+    def font(self, size):
+        self._check_reload()
+        font = self._fonts.get(size)
+        if font is None:
+            path = self._path(FONT_FILE)
+            with self._lock:
+                try:
+                    font = ImageFont.truetype(path, size)
+                    self._mtimes[path] = self._mtime(path)
+                except IOError:
+                    font = ImageFont.load_default()
+                self._fonts[size] = font
+        return font
+
+    def circle_mask(self, size):
+        mask = self._masks.get(size)
+        if mask is None:
+            mask = Image.new("L", size, 0)
+            ImageDraw.Draw(mask).ellipse((0, 0) + size, fill=255)
+            self._masks[size] = mask
+        return mask
+
+    def preload(self):
+        for name in TEMPLATES:
+            self.image(name)
+        for size in FONT_SIZES:
+            self.font(size)
+        self.circle_mask(AVATAR_SIZE)
+
+    def memory_usage(self):
+        images = {name: len(img.getbands()) * img.width * img.height for name, img in self._images.items() if img}
+        masks = sum(m.width * m.height for m in self._masks.values())
+        return {
+            "images": images,
+            "masks_bytes": masks,
+            "fonts_loaded": len(self._fonts),
+            "total_bytes": sum(images.values()) + masks,
+            "reloads": self.reloads,
+        }
+
+
+assets = AssetRegistry()
+
+# --- ВЕРСТКА ТЕКСТА ---
+
+LETTER_SPACING = -0.04
+ELLIPSIS = "..."
+
+
+class GlyphCache:
+    """Ширины, кернинг и маски глифов одного шрифта"""
+
+    def __init__(self, font):
+        self.font = font
+        self.advances = {}
+        self.kerning = {}
+        self.masks = {}
+
+    def advance(self, char):
+        width = self.advances.get(char)
+        if width is None:
+            width = self.advances[char] = self.font.getlength(char)
+        return width
+
+    def kern(self, left, right):
+        pair = left + right
+        adjust = self.kerning.get(pair)
+        if adjust is None:
+            adjust = self.kerning[pair] = self.font.getlength(pair) - self.advance(left) - self.advance(right)
+        return adjust
+
+    def offsets(self, text, spacing_px):
+        """Позиции символов по X и итоговая ширина строки с межбуквенным интервалом"""
+        offsets = []
+        x = 0.0
+        prev = None
+        for char in text:
+            if prev is not None:
+                x += self.kern(prev, char)
+            offsets.append(x)
+            x += self.advance(char) + spacing_px
+            prev = char
+        return offsets, x
+
+    def mask(self, char):
+        """Маска глифа и ее смещение относительно точки рисования"""
+        if char not in self.masks:
+            left, top, right, bottom = self.font.getbbox(char)
+            if right <= left or bottom <= top:
+                self.masks[char] = None
+            else:
+                glyph = Image.new("L", (right - left, bottom - top), 0)
+                ImageDraw.Draw(glyph).text((-left, -top), char, font=self.font, fill=255)
+                self.masks[char] = (glyph, left, top)
+        return self.masks[char]
+
+
+_glyph_caches = weakref.WeakKeyDictionary()
+
+
+def glyphs(font):
+    cache = _glyph_caches.get(font)
+    if cache is None:
+        cache = _glyph_caches[font] = GlyphCache(font)
+    return cache
+
+
+def text_width(text, font, spacing_percent=LETTER_SPACING):
+    return glyphs(font).offsets(text, font.size * spacing_percent)[1]
 
-# --- ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ---
 
 def draw_text_with_spacing(draw, text, position, font, fill, spacing_percent):
+    """Рисует строку с межбуквенным интервалом за один проход через общую маску"""
+    cache = glyphs(font)
+    offsets, _ = cache.offsets(text, font.size * spacing_percent)
+
+    placed = []
+    for char, offset in zip(text, offsets):
+        glyph = cache.mask(char)
+        if glyph:
+            mask, left, top = glyph
+            placed.append((mask, round(offset) + left, top))
+    if not placed:
+        return
+
+    min_x = min(x for _, x, _ in placed)
+    min_y = min(y for _, _, y in placed)
+    max_x = max(x + m.width for m, x, _ in placed)
+    max_y = max(y + m.height for m, _, y in placed)
+
+    line = Image.new("L", (max_x - min_x, max_y - min_y), 0)
+    for mask, x, y in placed:
+        line.paste(mask, (x - min_x, y - min_y), mask)
+
     x, y = position
-    spacing_px = font.size * spacing_percent
-    
-    for char in text:
-        draw.text((x, y), char, font=font, fill=fill)
-        char_width = draw.textlength(char, font=font)
-        x += char_width + spacing_px
+    draw.bitmap((round(x) + min_x, round(y) + min_y), line, fill=fill)
+
 
 def fit_text_to_width(draw, text, font, max_width, spacing_percent):
-    current_width = 0
+    """Обрезает строку с многоточием; длина подбирается бинарным поиском"""
+    cache = glyphs(font)
     spacing_px = font.size * spacing_percent
-    
-    for char in text:
-        current_width += draw.textlength(char, font=font) + spacing_px
-        
-    if current_width <= max_width:
+    offsets, total = cache.offsets(text, spacing_px)
+    if total <= max_width:
         return text
 
-    temp_text = text
-    while current_width > max_width and len(temp_text) > 0:
-        temp_text = temp_text[:-1]
-        check_text = temp_text + "..."
-        current_width = 0
-        for char in check_text:
-            current_width += draw.textlength(char, font=font) + spacing_px
-            
-    return temp_text + "..."
+    ellipsis_width = cache.offsets(ELLIPSIS, spacing_px)[1]
+
+    def fits(length):
+        if length == 0:
+            return True
+        width = offsets[length - 1] + cache.advance(text[length - 1]) + spacing_px
+        return width + cache.kern(text[length - 1], ELLIPSIS[0]) + ellipsis_width <= max_width
+
+    low, high = 0, len(text) - 1
+    while low < high:
+        middle = (low + high + 1) // 2
+        if fits(middle):
+            low = middle
+        else:
+            high = middle - 1
+    return text[:low] + ELLIPSIS
+
+
+def wrap_text(text, font, max_width):
+    """Разбивает текст на строки по словам, не шире max_width"""
+    lines = []
+    current_line = []
+    for word in text.split():
+        test_line = ' '.join(current_line + [word])
+        if not current_line or font.getlength(test_line) <= max_width:
+            current_line.append(word)
+        else:
+            lines.append(' '.join(current_line))
+            current_line = [word]
+    lines.append(' '.join(current_line))
+    return lines
+
+
+def draw_text_block(draw, lines, font, fill, x_pos, target_bottom_y, line_height, spacing_percent=LETTER_SPACING):
+    """Рисует строки так, чтобы последняя заканчивалась на target_bottom_y"""
+    current_y = target_bottom_y - len(lines) * line_height
+    for line in lines:
+        draw_text_with_spacing(draw, line, (x_pos, current_y), font, fill, spacing_percent)
+        current_y += line_height
 
 # --- 1. АКТИВНЫЙ ПОЛЬЗОВАТЕЛЬ ---
 def create_active_user_image(avatar_bytes, msg_count, user_name):
-    try:
-        img = Image.open("bg_active.png").convert("RGBA")
-    except FileNotFoundError:
-        img = Image.new("RGBA", (2000, 2000), (235, 87, 87))
+    img = assets.background("bg_active")
 
     if avatar_bytes:
         try:
-            avatar_size = (910, 910)
             avatar = Image.open(io.BytesIO(avatar_bytes)).convert("RGBA")
-            avatar = avatar.resize(avatar_size, Image.Resampling.LANCZOS)
-            
-            mask = Image.new("L", avatar_size, 0)
-            mask_draw = ImageDraw.Draw(mask)
-            mask_draw.ellipse((0, 0) + avatar_size, fill=255)
-            
-            img.paste(avatar, (555, 471), mask)
+            avatar = avatar.resize(AVATAR_SIZE, Image.Resampling.LANCZOS)
+            img.paste(avatar, (555, 471), assets.circle_mask(AVATAR_SIZE))
         except Exception:
             pass
 
-    try:
-        overlay = Image.open("ramka.png").convert("RGBA")
+    overlay = assets.image("ramka")
+    if overlay:
         img.paste(overlay, (0, 0), overlay)
-    except FileNotFoundError:
-        pass
 
     draw = ImageDraw.Draw(img)
 
-    try:
-        font_big = ImageFont.truetype("stolzl_bold.otf", 250)
-    except IOError:
-        font_big = ImageFont.load_default()
-    
+    font_big = assets.font(250)
     draw.text((159, 720), str(msg_count), font=font_big, fill=(255, 255, 255))
 
-    try:
-        font_desc = ImageFont.truetype("stolzl_bold.otf", 54)
-    except IOError:
-        font_desc = ImageFont.load_default()
+    font_desc = assets.font(54)
 
     full_text = f"{user_name} написал больше всего сообщений в чате ({msg_count}) !"
     
-    x_pos = 159
-    max_width = 640
-    line_height = 54
-    text_color = "#52546F"
-    target_bottom_y = 1649 
-
-    words = full_text.split()
-    lines = []
-    current_line = []
-    
-    for word in words:
-        test_line = ' '.join(current_line + [word])
-        w = draw.textlength(test_line, font=font_desc)
-        if w <= max_width:
-            current_line.append(word)
-        else:
-            lines.append(' '.join(current_line))
-            current_line = [word]
-    lines.append(' '.join(current_line))
-
-    total_height = len(lines) * line_height
-    start_y = target_bottom_y - total_height
-    current_y = start_y
-    for line in lines:
-        draw_text_with_spacing(draw, line, (x_pos, current_y), font_desc, text_color, -0.04)
-        current_y += line_height
+    lines = wrap_text(full_text, font_desc, 640)
+    draw_text_block(draw, lines, font_desc, "#52546F", 159, 1649, 54)
 
     bio = io.BytesIO()
     img.save(bio, 'PNG')
@@ -113,10 +313,7 @@ def create_active_user_image(avatar_bytes, msg_count, user_name):
 
 # --- 2. ТОП СЛОВ ---
 def create_top_words_image(top_words):
-    try:
-        img = Image.open("bg_words.png").convert("RGBA")
-    except FileNotFoundError:
-        img = Image.new("RGBA", (2000, 2000), (235, 87, 87))
+    img = assets.background("bg_words")
 
     draw = ImageDraw.Draw(img)
     
@@ -126,53 +323,24 @@ def create_top_words_image(top_words):
     gap = 30
     max_width_list = 1600
     
-    try:
-        font_desc = ImageFont.truetype("stolzl_bold.otf", 48)
-    except IOError:
-        font_desc = ImageFont.load_default()
+    font_desc = assets.font(48)
 
     for i in range(3):
         if i >= len(top_words): break
         word, count = top_words[i]
-        try:
-            font = ImageFont.truetype("stolzl_bold.otf", font_sizes[i])
-        except IOError:
-            font = ImageFont.load_default()
-            
+        font = assets.font(font_sizes[i])
+
         text_line = f"{i+1}. {word}"
-        final_text = fit_text_to_width(draw, text_line, font, max_width_list, -0.04)
-        draw_text_with_spacing(draw, final_text, (start_x, current_y), font, (255, 255, 255), -0.04)
+        final_text = fit_text_to_width(draw, text_line, font, max_width_list, LETTER_SPACING)
+        draw_text_with_spacing(draw, final_text, (start_x, current_y), font, (255, 255, 255), LETTER_SPACING)
         current_y += font_sizes[i] + gap
 
     if top_words:
         best_word, best_count = top_words[0]
         text_content = f"Было использовано ровно {best_count} слов “{best_word}” !"
         
-        x_pos = 159
-        max_width_desc = 640
-        line_height = 48
-        desc_color = "#3D5258"
-        target_bottom_y = 1649
-
-        words = text_content.split()
-        lines = []
-        current_line = []
-        for word in words:
-            test_line = ' '.join(current_line + [word])
-            w = draw.textlength(test_line, font=font_desc)
-            if w <= max_width_desc:
-                current_line.append(word)
-            else:
-                lines.append(' '.join(current_line))
-                current_line = [word]
-        lines.append(' '.join(current_line))
-
-        total_height = len(lines) * line_height
-        start_y = target_bottom_y - total_height
-        current_y = start_y
-        for line in lines:
-            draw_text_with_spacing(draw, line, (x_pos, current_y), font_desc, desc_color, -0.04)
-            current_y += line_height
+        lines = wrap_text(text_content, font_desc, 640)
+        draw_text_block(draw, lines, font_desc, "#3D5258", 159, 1649, 48)
 
     bio = io.BytesIO()
     img.save(bio, 'PNG')
@@ -182,10 +350,7 @@ def create_top_words_image(top_words):
 # --- 3. ТОП СТИКЕР (ФИНАЛЬНЫЙ) ---
 def create_top_sticker_image(sticker_bytes, count):
     # 1. Фон
-    try:
-        img = Image.open("bg_sticker.png").convert("RGBA")
-    except FileNotFoundError:
-        img = Image.new("RGBA", (2000, 2000), (240, 240, 240))
+    img = assets.background("bg_sticker")
 
     # --- НАСТРОЙКИ ---
     max_sticker_size = 800  # Максимальный размер (как на шаблоне)
@@ -210,202 +375,212 @@ def create_top_sticker_image(sticker_bytes, count):
             
             img.paste(sticker, (paste_x, paste_y), sticker)
         except Exception as e:
-            print(f"Ошибка стикера: {e}")
+            logger.warning("Ошибка стикера: %s", e)
 
     # 3. Текст
     draw = ImageDraw.Draw(img)
-    try:
-        font_desc = ImageFont.truetype("stolzl_bold.otf", 54)
-    except IOError:
-        font_desc = ImageFont.load_default()
+    font_desc = assets.font(54)
 
     full_text = f"Было использовано ровно {count} этих стикеров"
     
-    x_pos = 159
-    max_width = 640 
-    line_height = 55
-    text_color = "#A35F5F"
-    target_bottom_y = 1649 
-
-    words = full_text.split()
-    lines = []
-    current_line = []
-    
-    for word in words:
-        test_line = ' '.join(current_line + [word])
-        w = draw.textlength(test_line, font=font_desc)
-        if w <= max_width:
-            current_line.append(word)
-        else:
-            lines.append(' '.join(current_line))
-            current_line = [word]
-    lines.append(' '.join(current_line))
-
-    total_height = len(lines) * line_height
-    start_y = target_bottom_y - total_height
-    current_y = start_y
-    for line in lines:
-        draw_text_with_spacing(draw, line, (x_pos, current_y), font_desc, text_color, -0.04)
-        current_y += line_height
+    lines = wrap_text(full_text, font_desc, 640)
+    draw_text_block(draw, lines, font_desc, "#A35F5F", 159, 1649, 55)
 
     bio = io.BytesIO()
     img.save(bio, 'PNG')
     bio.seek(0)
     return bio
 
-def create_top_sticker_gif(video_bytes, count):
-    # Оптимизированная версия для Render (ffmpeg без pyav)
-    temp_video = None
-    reader = None
+# --- 4. ТОП ВИДЕО-СТИКЕР ---
+
+VIDEO_SIZE = 512        # большая сторона итогового ролика
+VIDEO_FPS = 10
+VIDEO_MIN_FRAMES = 50   # короткие стикеры зацикливаем до 5 секунд
+VIDEO_MAX_FRAMES = 51
+STICKER_BOX = (218, 551, 800)  # x, y и размер области стикера на шаблоне
+
+
+def _even(value):
+    return max(2, int(round(value / 2)) * 2)
+
+
+def _drain(stream, sink):
+    for chunk in iter(lambda: stream.read(65536), b""):
+        sink.write(chunk)
+    stream.close()
+
+
+def _feed(stream, data):
     try:
-        bg_img_path = "bg_sticker.png"
-        if not os.path.exists(bg_img_path):
-            base_bg = Image.new("RGBA", (2000, 2000), (240, 240, 240))
-        else:
-            base_bg = Image.open(bg_img_path).convert("RGBA")
-        
-        max_sticker_size = 800
-        box_x = 218
-        box_y = 551
-        
-        # Записываем видео
-        temp_video = tempfile.NamedTemporaryFile(delete=False, suffix='.webm')
-        temp_video.write(video_bytes)
-        temp_video.close()
-        
-        frames = []
-        
-        # --- ГЛАВНОЕ ИЗМЕНЕНИЕ ---
-        # Используем imageio.get_reader (v2 API), который использует imageio-ffmpeg
-        # Это надежнее всего и не требует установки 'av'
-        try:
-            reader = imageio.get_reader(temp_video.name, 'ffmpeg')
-        except Exception as e:
-            print(f"Ошибка открытия видео: {e}")
-            return None
-        
+        stream.write(data)
+    except (BrokenPipeError, OSError):
+        pass
+    finally:
         try:
-            font_desc = ImageFont.truetype("stolzl_bold.otf", 54)
-        except IOError:
-            font_desc = ImageFont.load_default()
-
-        full_text = f"Было использовано ровно {count} этих стикеров"
-        x_pos = 159
-        max_width = 640
-        line_height = 55
-        text_color = "#A35F5F"
-        target_bottom_y = 1649
-        
-        tmp_draw = ImageDraw.Draw(base_bg)
-        words = full_text.split()
-        lines = []
-        current_line = []
-        for word in words:
-            test_line = ' '.join(current_line + [word])
-            w = tmp_draw.textlength(test_line, font=font_desc)
-            if w <= max_width:
-                current_line.append(word)
-            else:
-                lines.append(' '.join(current_line))
-                current_line = [word]
-        lines.append(' '.join(current_line))
-        total_height = len(lines) * line_height
-        start_y = target_bottom_y - total_height
-
-        # Читаем кадры через итератор reader
-        for i, frame in enumerate(reader):
+            stream.close()
+        except OSError:
+            pass
+
+
+def _sticker_video_base(count):
+    """Фон с подписью, один раз уменьшенный до размера ролика, и бокс стикера в его координатах"""
+    img = assets.background("bg_sticker")
+    draw = ImageDraw.Draw(img)
+    font_desc = assets.font(54)
+    lines = wrap_text(f"Было использовано ровно {count} этих стикеров", font_desc, 640)
+    draw_text_block(draw, lines, font_desc, "#A35F5F", 159, 1649, 55)
+
+    scale = VIDEO_SIZE / max(img.size)
+    size = (_even(img.width * scale), _even(img.height * scale))
+    base = img.resize(size, Image.Resampling.LANCZOS).convert("RGB")
+
+    box_x, box_y, box_size = STICKER_BOX
+    box = (round(box_x * size[0] / img.width), round(box_y * size[1] / img.height), max(1, round(box_size * size[0] / img.width)))
+    return base, box
+
+
+def _decode_sticker_frames(video_bytes, box_size):
+    """Кадры стикера по одному: ffmpeg сам вписывает их в квадрат box_size с прозрачными полями"""
+    vf = (f"scale={box_size}:{box_size}:force_original_aspect_ratio=decrease:flags=lanczos,"
+          f"format=rgba,pad={box_size}:{box_size}:-1:-1:color=black@0")
+    cmd = [imageio_ffmpeg.get_ffmpeg_exe(), "-hide_banner", "-loglevel", "error",
+           "-i", "pipe:0", "-vf", vf, "-f", "rawvideo", "-pix_fmt", "rgba", "pipe:1"]
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    feeder = threading.Thread(target=_feed, args=(proc.stdin, video_bytes), daemon=True)
+    feeder.start()
+
+    frame_size = box_size * box_size * 4
+    try:
+        while True:
+            data = proc.stdout.read(frame_size)
+            if len(data) < frame_size:
+                break
+            yield Image.frombuffer("RGBA", (box_size, box_size), data, "raw", "RGBA", 0, 1)
+    finally:
+        proc.stdout.close()
+        if proc.poll() is None:
+            proc.kill()
+        proc.wait()
+        feeder.join()
+
+
+def _sticker_video_frames(video_bytes, base, box):
+    """Готовые кадры ролика; в памяти одновременно только текущий кадр"""
+    box_x, box_y, box_size = box
+    written = 0
+    target = VIDEO_MAX_FRAMES
+    while True:
+        produced = 0
+        for i, frame in enumerate(_decode_sticker_frames(video_bytes, box_size)):
             # Пропуск кадров (экономия ресурсов)
             if i % 2 != 0:
                 continue
-                
-            frame_img = Image.fromarray(frame).convert("RGBA")
-            
-            old_w, old_h = frame_img.size
-            ratio = min(max_sticker_size / old_w, max_sticker_size / old_h)
-            new_w = int(old_w * ratio)
-            new_h = int(old_h * ratio)
-            frame_img = frame_img.resize((new_w, new_h), Image.Resampling.LANCZOS)
-            
-            final_w, final_h = frame_img.size
-            paste_x = box_x + (max_sticker_size - final_w) // 2
-            paste_y = box_y + (max_sticker_size - final_h) // 2
-            
-            frame_with_bg = base_bg.copy()
-            frame_with_bg.paste(frame_img, (paste_x, paste_y), frame_img)
-            
-            draw = ImageDraw.Draw(frame_with_bg)
-            current_y = start_y
-            for line in lines:
-                draw_text_with_spacing(draw, line, (x_pos, current_y), font_desc, text_color, -0.04)
-                current_y += line_height
-            
-            # Уменьшаем размер кадра для оптимизации размера файла
-            frame_with_bg.thumbnail((512, 512), Image.Resampling.LANCZOS)
-            
-            frames.append(np.array(frame_with_bg.convert("RGB")))
-            
-            # Ограничитель, чтобы не зависнуть
-            if len(frames) > 50:
-                break
-        
-        reader.close()
-
-        if os.path.exists(temp_video.name):
-            os.unlink(temp_video.name)
+            out = base.copy()
+            out.paste(frame, (box_x, box_y), frame)
+            yield out
+            produced += 1
+            written += 1
+            if written >= target:
+                return
+        if produced == 0:
+            return
+        # Стикер закончился раньше: повторяем его до минимальной длины
+        target = VIDEO_MIN_FRAMES
+        if written >= target:
+            return
+
+
+def _encode_mp4(frames, size):
+    """Кадры уходят в ffmpeg через pipe, MP4 (fragmented) читается из stdout"""
+    cmd = [imageio_ffmpeg.get_ffmpeg_exe(), "-hide_banner", "-loglevel", "error",
+           "-f", "rawvideo", "-pix_fmt", "rgb24", "-s", f"{size[0]}x{size[1]}", "-r", str(VIDEO_FPS), "-i", "pipe:0",
+           "-c:v", "libx264", "-pix_fmt", "yuv420p",
+           "-movflags", "frag_keyframe+empty_moov+default_base_moof", "-f", "mp4", "pipe:1"]
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    output_io = io.BytesIO()
+    errors = io.BytesIO()
+    readers = [threading.Thread(target=_drain, args=(proc.stdout, output_io), daemon=True),
+               threading.Thread(target=_drain, args=(proc.stderr, errors), daemon=True)]
+    for reader in readers:
+        reader.start()
+
+    written = 0
+    try:
+        for frame in frames:
+            proc.stdin.write(frame.tobytes())
+            written += 1
+    finally:
+        try:
+            proc.stdin.close()
+        except OSError:
+            pass
+        proc.wait()
+        for reader in readers:
+            reader.join()
+
+    if proc.returncode != 0:
+        raise RuntimeError(errors.getvalue().decode("utf-8", "replace").strip() or f"ffmpeg exited with {proc.returncode}")
+    if not written:
+        return None
+    output_io.seek(0)
+    return output_io
+
+
+def _encode_gif(frames):
+    output_io = io.BytesIO()
+    written = 0
+    with imageio.get_writer(output_io, format='GIF', mode='I', loop=0, duration=1 / VIDEO_FPS) as writer:
+        for frame in frames:
+            writer.append_data(np.asarray(frame))
+            written += 1
+    if not written:
+        return None
+    output_io.seek(0)
+    return output_io
 
-        if not frames:
-            return None
 
-        # Зацикливаем кадры, если стикер слишком короткий
-        # Минимальная длина: 5 секунд при 10 fps = 50 кадров
-        min_frames = 50
-        if len(frames) < min_frames:
-            original_frames = frames.copy()
-            while len(frames) < min_frames:
-                frames.extend(original_frames)
-            # Обрезаем до нужной длины
-            frames = frames[:min_frames]
-
-        # Сохраняем как MP4 используя временный файл (ffmpeg не может писать в BytesIO)
-        temp_output = None
+def create_top_sticker_gif(video_bytes, count):
+    # Потоковая обработка: без временных файлов и без буфера всех кадров
+    try:
+        base, box = _sticker_video_base(count)
         try:
-            temp_output = tempfile.NamedTemporaryFile(delete=False, suffix='.mp4')
-            temp_output.close()
-            
-            writer = imageio.get_writer(temp_output.name, format='ffmpeg', codec='libx264', fps=10, pixelformat='yuv420p')
-            for frame in frames:
-                writer.append_data(frame)
-            writer.close()
-            
-            # Читаем готовый MP4 в BytesIO
-            with open(temp_output.name, 'rb') as f:
-                output_io = io.BytesIO(f.read())
-            
-            # Удаляем временный файл
-            if os.path.exists(temp_output.name):
-                os.unlink(temp_output.name)
-            
-            output_io.seek(0)
-            return output_io
+            return _encode_mp4(_sticker_video_frames(video_bytes, base, box), base.size)
         except Exception as e:
-            print(f"Ошибка создания MP4: {e}")
-            # Очищаем временный файл при ошибке
-            if temp_output and os.path.exists(temp_output.name):
-                try:
-                    os.unlink(temp_output.name)
-                except:
-                    pass
+            logger.warning("Ошибка создания MP4, пробуем GIF: %s", e)
             # Fallback на GIF если MP4 не получился
-            output_io = io.BytesIO()
-            imageio.mimsave(output_io, frames, format='GIF', loop=0, duration=0.1)
-            output_io.seek(0)
-            return output_io
-
+            return _encode_gif(_sticker_video_frames(video_bytes, base, box))
     except Exception as e:
-        print(f"Ошибка обработки видео-стикера: {e}")
-        if temp_video and os.path.exists(temp_video.name):
-            try: os.unlink(temp_video.name)
-            except: pass
-        if reader:
-            reader.close()
-        return None
\ No newline at end of file
+        logger.error("Ошибка обработки видео-стикера: %s", e)
+        return None
+
+# --- 5. САМОЕ ПОПУЛЯРНОЕ СООБЩЕНИЕ ---
+REACTED_TEXT_MAX_LINES = 8
+
+def create_most_reacted_image(text, user_name, reaction_count):
+    img = assets.background("bg_reactions")
+    draw = ImageDraw.Draw(img)
+
+    font_big = assets.font(250)
+    draw.text((159, 420), str(reaction_count), font=font_big, fill=(255, 255, 255))
+
+    # Текст сообщения мог быть удален политикой хранения: тогда карточка без цитаты
+    font_quote = assets.font(54)
+    if text:
+        lines = wrap_text(" ".join(text.split()), font_quote, 920)
+        if len(lines) > REACTED_TEXT_MAX_LINES:
+            rest = " ".join(lines[REACTED_TEXT_MAX_LINES - 1:])
+            lines = lines[:REACTED_TEXT_MAX_LINES - 1] + [fit_text_to_width(draw, rest, font_quote, 920, LETTER_SPACING)]
+        current_y = 760
+        for line in lines:
+            draw_text_with_spacing(draw, line, (159, current_y), font_quote, (255, 255, 255), LETTER_SPACING)
+            current_y += 64
+
+    font_desc = assets.font(48)
+    full_text = f"Сообщение от {user_name} собрало больше всего реакций ({reaction_count}) !"
+    lines = wrap_text(full_text, font_desc, 640)
+    draw_text_block(draw, lines, font_desc, "#E3E8FF", 159, 1649, 48)
+
+    bio = io.BytesIO()
+    img.save(bio, 'PNG')
+    bio.seek(0)
+    return bio
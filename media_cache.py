@@ -0,0 +1,131 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict
+
+from blob_cache import BlobCache
+
+# Кэш файлов Telegram (аватарки, стикеры) по file_unique_id, а также
+# результатов get_file и get_user_profile_photos, чтобы повторные отчеты
+# и запросы сайта не ходили в Bot API.
+
+MEDIA_CACHE_MEMORY_BYTES = int(os.getenv("MEDIA_CACHE_MEMORY_BYTES", 32 * 1024 * 1024))
+MEDIA_CACHE_DIR = os.getenv("MEDIA_CACHE_DIR")  # дисковый уровень выключен, если не задан
+MEDIA_CACHE_DISK_BYTES = int(os.getenv("MEDIA_CACHE_DISK_BYTES", 256 * 1024 * 1024))
+MEDIA_CACHE_TTL = float(os.getenv("MEDIA_CACHE_TTL", 7 * 24 * 3600))
+# Ссылка на файл гарантированно живет не меньше часа
+FILE_PATH_TTL = float(os.getenv("FILE_PATH_TTL", 50 * 60))
+PROFILE_PHOTOS_TTL = float(os.getenv("PROFILE_PHOTOS_TTL", 60 * 60))
+MEDIA_CACHE_MAX_LOOKUPS = int(os.getenv("MEDIA_CACHE_MAX_LOOKUPS", 50000))
+
+
+class MediaCache:
+    def __init__(self, bot, max_bytes=MEDIA_CACHE_MEMORY_BYTES, disk_dir=MEDIA_CACHE_DIR,
+                 disk_max_bytes=MEDIA_CACHE_DISK_BYTES, ttl=MEDIA_CACHE_TTL,
+                 file_path_ttl=FILE_PATH_TTL, profile_photos_ttl=PROFILE_PHOTOS_TTL):
+        self.bot = bot
+        self.files = BlobCache(max_bytes, disk_dir, disk_max_bytes, ttl)
+        self.file_path_ttl = file_path_ttl
+        self.profile_photos_ttl = profile_photos_ttl
+        # В порядке использования: при переполнении вытесняются давно не нужные
+        self.file_paths = OrderedDict()      # file_id -> (file_path, истекает)
+        self.profile_photos = OrderedDict()  # user_id -> (размеры первой фотографии, истекает)
+        self._pending = {}        # ключ запроса -> future для объединения одновременных запросов
+
+        self.api_calls = {"get_file": 0, "get_user_profile_photos": 0, "download_file": 0}
+        self.coalesced = 0
+
+    async def _single_flight(self, key, fetch):
+        future = self._pending.get(key)
+        if future is not None:
+            self.coalesced += 1
+            return await asyncio.shield(future)
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending[key] = future
+        try:
+            result = await fetch()
+        except Exception as e:
+            future.set_exception(e)
+            # исключение уже передано ожидающим, здесь оно не должно считаться необработанным
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            # Отмененный запрос не должен оставлять ожидающих висеть на future
+            if not future.done():
+                future.cancel()
+            self._pending.pop(key, None)
+
+    async def profile_photo_sizes(self, user_id):
+        """[(file_id, file_unique_id), ...] первой фотографии профиля от меньшей к большей или []"""
+        cached = self.profile_photos.get(user_id)
+        if cached and cached[1] > time.monotonic():
+            self.profile_photos.move_to_end(user_id)
+            return cached[0]
+
+        async def fetch():
+            self.api_calls["get_user_profile_photos"] += 1
+            photos = await self.bot.get_user_profile_photos(user_id, limit=1)
+            sizes = [(p.file_id, p.file_unique_id) for p in photos.photos[0]] if photos.total_count > 0 else []
+            self._remember(self.profile_photos, user_id, (sizes, time.monotonic() + self.profile_photos_ttl))
+            return sizes
+
+        return await self._single_flight(("photos", user_id), fetch)
+
+    async def file_path(self, file_id):
+        cached = self.file_paths.get(file_id)
+        if cached and cached[1] > time.monotonic():
+            self.file_paths.move_to_end(file_id)
+            return cached[0]
+
+        async def fetch():
+            self.api_calls["get_file"] += 1
+            file_info = await self.bot.get_file(file_id)
+            self._remember(self.file_paths, file_id, (file_info.file_path, time.monotonic() + self.file_path_ttl))
+            return file_info.file_path
+
+        return await self._single_flight(("path", file_id), fetch)
+
+    async def download(self, file_id, file_unique_id):
+        data = self.files.get(file_unique_id)
+        if data is not None:
+            return data
+
+        async def fetch():
+            file_path = await self.file_path(file_id)
+            self.api_calls["download_file"] += 1
+            downloaded = await self.bot.download_file(file_path)
+            content = downloaded.read()
+            self.files.put(file_unique_id, content)
+            return content
+
+        return await self._single_flight(("file", file_unique_id), fetch)
+
+    def _remember(self, lookups, key, value):
+        lookups[key] = value
+        lookups.move_to_end(key)
+        if len(lookups) > MEDIA_CACHE_MAX_LOOKUPS:
+            # Сначала выбрасываем истекшие, вытеснение по давности - только если их не хватило
+            self.prune()
+        while len(lookups) > MEDIA_CACHE_MAX_LOOKUPS:
+            lookups.popitem(last=False)
+
+    def prune(self):
+        """Удаляет истекшие ссылки и списки фотографий"""
+        now = time.monotonic()
+        for lookups in (self.file_paths, self.profile_photos):
+            for key in [k for k, v in lookups.items() if v[1] <= now]:
+                del lookups[key]
+
+    def stats(self):
+        stats = self.files.stats()
+        stats.update({
+            "file_paths": len(self.file_paths),
+            "profile_photos": len(self.profile_photos),
+            "api_calls": dict(self.api_calls),
+            "coalesced": self.coalesced,
+        })
+        return stats
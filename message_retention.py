@@ -0,0 +1,197 @@
+import asyncio
+import os
+import time
+from datetime import datetime, timedelta, timezone
+from log import get_logger
+
+logger = get_logger(__name__)
+
+# Политика хранения message_stats: текст старых сообщений удаляется или обрезается
+# (длина и реакции остаются), еще более старые строки переносятся в помесячные
+# архивные таблицы, а архивы старше срока хранения удаляются целиком через DROP TABLE.
+# Все изменения в горячей таблице идут небольшими пачками с паузами между ними.
+
+MESSAGE_CONTENT_RETENTION_DAYS = int(os.getenv("MESSAGE_CONTENT_RETENTION_DAYS", 30))  # 0 - хранить текст всегда
+MESSAGE_CONTENT_TRUNCATE = int(os.getenv("MESSAGE_CONTENT_TRUNCATE", 0))  # 0 - удалять текст, иначе оставлять N символов
+MESSAGE_ARCHIVE_AFTER_DAYS = int(os.getenv("MESSAGE_ARCHIVE_AFTER_DAYS", 90))  # 0 - не архивировать
+MESSAGE_ARCHIVE_RETENTION_DAYS = int(os.getenv("MESSAGE_ARCHIVE_RETENTION_DAYS", 0))  # 0 - хранить архивы всегда
+MESSAGE_RETENTION_BATCH = int(os.getenv("MESSAGE_RETENTION_BATCH", 5000))
+MESSAGE_RETENTION_PAUSE = float(os.getenv("MESSAGE_RETENTION_PAUSE", 0.1))
+MESSAGE_RETENTION_INTERVAL = float(os.getenv("MESSAGE_RETENTION_INTERVAL", 3600))
+
+ARCHIVE_PREFIX = "message_stats_archive_"
+
+MESSAGE_RETENTION_SCHEMA = [
+    # Уже существующие строки получают время миграции и живут полный срок от него
+    '''ALTER TABLE message_stats ADD COLUMN IF NOT EXISTS created_at TIMESTAMP DEFAULT (now() AT TIME ZONE 'utc')''',
+    '''CREATE INDEX CONCURRENTLY IF NOT EXISTS message_stats_created_idx ON message_stats (created_at)''',
+]
+
+TRIM_BATCH_SQL = '''
+    WITH batch AS (
+        SELECT chat_id, message_id FROM message_stats
+        WHERE created_at < $1 AND content IS NOT NULL AND ($2 = 0 OR length(content) > $2)
+        LIMIT $3 FOR UPDATE SKIP LOCKED
+    )
+    UPDATE message_stats m SET content = CASE WHEN $2 = 0 THEN NULL ELSE left(m.content, $2) END
+    FROM batch WHERE m.chat_id = batch.chat_id AND m.message_id = batch.message_id
+'''
+
+ARCHIVE_BATCH_SQL = '''
+    WITH moved AS (
+        DELETE FROM message_stats WHERE (chat_id, message_id) IN (
+            SELECT chat_id, message_id FROM message_stats
+            WHERE created_at >= $1 AND created_at < $2
+            LIMIT $3 FOR UPDATE SKIP LOCKED
+        )
+        RETURNING chat_id, message_id, user_id, length, reaction_count, created_at
+    )
+    INSERT INTO {table} SELECT * FROM moved ON CONFLICT (chat_id, message_id) DO NOTHING
+'''
+
+
+def rows_affected(status):
+    # asyncpg возвращает статус вида 'UPDATE 5000' / 'INSERT 0 5000'
+    try:
+        return int(status.split()[-1])
+    except (AttributeError, ValueError, IndexError):
+        return 0
+
+
+def _month_start(moment):
+    return moment.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def _next_month(moment):
+    return _month_start(_month_start(moment) + timedelta(days=32))
+
+
+def archive_table(moment):
+    return f"{ARCHIVE_PREFIX}{moment:%Y%m}"
+
+
+class MessageRetention:
+    def __init__(self, pool, content_days=MESSAGE_CONTENT_RETENTION_DAYS, truncate=MESSAGE_CONTENT_TRUNCATE,
+                 archive_days=MESSAGE_ARCHIVE_AFTER_DAYS, archive_retention_days=MESSAGE_ARCHIVE_RETENTION_DAYS,
+                 batch_size=MESSAGE_RETENTION_BATCH, pause=MESSAGE_RETENTION_PAUSE, interval=MESSAGE_RETENTION_INTERVAL):
+        self.pool = pool
+        self.content_days = content_days
+        self.truncate = truncate
+        self.archive_days = archive_days
+        self.archive_retention_days = archive_retention_days
+        self.batch_size = batch_size
+        self.pause = pause
+        self.interval = interval
+
+        self.phase = "idle"
+        self.runs = 0
+        self.errors = 0
+        self.batches = 0
+        self.rows_trimmed = 0
+        self.rows_archived = 0
+        self.tables_dropped = 0
+        self.last_run_at = None
+        self.last_run_duration = 0.0
+        self.last_run_rows = 0
+
+    async def _batches(self, sql, *args):
+        """Выполняет sql пачками, пока он что-то меняет; соединение возвращается в пул между пачками"""
+        total = 0
+        while True:
+            async with self.pool.acquire() as conn:
+                affected = rows_affected(await conn.execute(sql, *args, self.batch_size))
+            self.batches += 1
+            total += affected
+            if affected < self.batch_size:
+                return total
+            await asyncio.sleep(self.pause)
+
+    async def trim_content(self, now):
+        if not self.content_days:
+            return 0
+        self.phase = "trim"
+        rows = await self._batches(TRIM_BATCH_SQL, now - timedelta(days=self.content_days), self.truncate)
+        self.rows_trimmed += rows
+        return rows
+
+    async def archive(self, now):
+        if not self.archive_days:
+            return 0
+        self.phase = "archive"
+        cutoff = now - timedelta(days=self.archive_days)
+        total = 0
+        while True:
+            async with self.pool.acquire() as conn:
+                oldest = await conn.fetchval('SELECT min(created_at) FROM message_stats WHERE created_at < $1', cutoff)
+                if oldest is None:
+                    return total
+                table = archive_table(oldest)
+                await conn.execute(
+                    f'CREATE TABLE IF NOT EXISTS {table} (chat_id BIGINT, message_id BIGINT, user_id BIGINT, '
+                    f'length INTEGER, reaction_count INTEGER, created_at TIMESTAMP, PRIMARY KEY (chat_id, message_id))'
+                )
+            chunk_end = min(_next_month(oldest), cutoff)
+            rows = await self._batches(ARCHIVE_BATCH_SQL.format(table=table), _month_start(oldest), chunk_end)
+            self.rows_archived += rows
+            total += rows
+            if not rows:
+                # Все оставшиеся строки заблокированы другими транзакциями, продолжим в следующий раз
+                return total
+
+    async def archive_tables(self, conn):
+        rows = await conn.fetch("SELECT tablename FROM pg_tables WHERE tablename LIKE $1 ORDER BY tablename", ARCHIVE_PREFIX + "%")
+        return [r['tablename'] for r in rows]
+
+    async def drop_old_archives(self, now):
+        if not self.archive_retention_days:
+            return 0
+        self.phase = "drop_archives"
+        # Таблица удаляется, только когда весь ее месяц старше срока хранения
+        oldest_kept = archive_table(_month_start(now - timedelta(days=self.archive_retention_days)))
+        dropped = 0
+        async with self.pool.acquire() as conn:
+            for table in await self.archive_tables(conn):
+                if table < oldest_kept:
+                    await conn.execute(f'DROP TABLE IF EXISTS {table}')
+                    dropped += 1
+        self.tables_dropped += dropped
+        return dropped
+
+    async def run_once(self):
+        started = time.monotonic()
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        rows = 0
+        try:
+            rows += await self.trim_content(now)
+            rows += await self.archive(now)
+            await self.drop_old_archives(now)
+        finally:
+            self.phase = "idle"
+        self.runs += 1
+        self.last_run_at = time.time()
+        self.last_run_duration = time.monotonic() - started
+        self.last_run_rows = rows
+
+    async def run(self):
+        """Фоновое применение политики хранения"""
+        while True:
+            try:
+                await self.run_once()
+            except Exception as e:
+                self.errors += 1
+                logger.warning("Ошибка очистки message_stats: %s", e)
+            await asyncio.sleep(self.interval)
+
+    def stats(self):
+        return {
+            "phase": self.phase,
+            "runs": self.runs,
+            "errors": self.errors,
+            "batches": self.batches,
+            "rows_trimmed": self.rows_trimmed,
+            "rows_archived": self.rows_archived,
+            "tables_dropped": self.tables_dropped,
+            "last_run_at": self.last_run_at,
+            "last_run_duration_seconds": round(self.last_run_duration, 3),
+            "last_run_rows": self.last_run_rows,
+        }
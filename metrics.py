@@ -0,0 +1,161 @@
+import time
+from bisect import bisect_left
+
+from log import get_logger, fields
+
+logger = get_logger(__name__)
+
+# Простые метрики в памяти для /internal/metrics и /metrics (текстовый формат Prometheus)
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def time(self):
+        return _Timer(self)
+
+    def snapshot(self):
+        cumulative = 0
+        buckets = {}
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            cumulative += count
+            buckets["+Inf" if bound == float("inf") else str(bound)] = cumulative
+        return {"count": self.count, "sum": round(self.sum, 6), "buckets": buckets}
+
+
+class Counter:
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Gauge:
+    def __init__(self):
+        self.value = 0.0
+
+    def set(self, value):
+        self.value = value
+
+
+class Family:
+    """Метрика с метками: labels(...) возвращает дочернюю метрику для этого набора значений"""
+
+    def __init__(self, factory, labelnames):
+        self.factory = factory
+        self.labelnames = tuple(labelnames)
+        self.children = {}
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"Ожидаются метки {self.labelnames}, получено {values}")
+            child = self.children[values] = self.factory()
+        return child
+
+    def samples(self):
+        for values, child in self.children.items():
+            yield dict(zip(self.labelnames, values)), child
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(labels, extra=None):
+    items = list(labels.items()) + ([extra] if extra else [])
+    if not items:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in items) + "}"
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Registry:
+    """Набор метрик для /metrics. Метрики создаются здесь или отдаются функциями-сборщиками,
+    которые переводят счетчики из stats() модулей в семплы в момент запроса"""
+
+    def __init__(self, prefix="chatly_"):
+        self.prefix = prefix
+        self.metrics = {}     # имя -> (тип, описание, Family)
+        self.collectors = []  # () -> [(имя, тип, описание, [(метки, значение или Histogram)])]
+
+    def _family(self, kind, name, help, labelnames, factory):
+        family = Family(factory, labelnames)
+        self.metrics[self.prefix + name] = (kind, help, family)
+        return family if labelnames else family.labels()
+
+    def counter(self, name, help, labelnames=()):
+        return self._family("counter", name, help, labelnames, Counter)
+
+    def gauge(self, name, help, labelnames=()):
+        return self._family("gauge", name, help, labelnames, Gauge)
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._family("histogram", name, help, labelnames, lambda: Histogram(buckets))
+
+    def collector(self, collect):
+        self.collectors.append(collect)
+        return collect
+
+    def _families(self):
+        for name, (kind, help, family) in self.metrics.items():
+            yield name, kind, help, [(labels, child) for labels, child in family.samples()]
+        for collect in self.collectors:
+            try:
+                for name, kind, help, samples in collect():
+                    yield self.prefix + name, kind, help, samples
+            except Exception:
+                # Сломанный сборщик не должен ломать весь /metrics
+                logger.exception("Ошибка сборщика метрик", extra=fields(collector=collect.__name__))
+
+    def render(self):
+        lines = []
+        for name, kind, help, samples in self._families():
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                if isinstance(value, Histogram):
+                    cumulative = 0
+                    for bound, count in zip(value.buckets + (float("inf"),), value.counts):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{_labels(labels, ('le', _number(bound)))} {cumulative}")
+                    lines.append(f"{name}_sum{_labels(labels)} {_number(value.sum)}")
+                    lines.append(f"{name}_count{_labels(labels)} {value.count}")
+                else:
+                    if isinstance(value, (Counter, Gauge)):
+                        value = value.value
+                    lines.append(f"{name}{_labels(labels)} {_number(value)}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+class _Timer:
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started)
@@ -0,0 +1,139 @@
+import asyncio
+import os
+import sys
+
+from leader import lock_key
+from leaderboard import LEADERBOARD_SCHEMA
+from rollups import ROLLUP_SCHEMA
+from message_retention import MESSAGE_RETENTION_SCHEMA
+from chat_purge import CHAT_PURGE_SCHEMA
+from report_scheduler import REPORT_SCHEDULER_SCHEMA, REPORT_RETRY_SCHEMA
+from title_reconciler import TITLE_SCHEMA
+from jobs import JOBS_SCHEMA, JOBS_RELEASE_FAILED_SCHEMA
+from reactions import REACTIONS_SCHEMA
+from word_sketches import WORD_SKETCH_SCHEMA
+from api_cache import CHAT_VERSIONS_SCHEMA
+from log import get_logger, fields
+
+logger = get_logger(__name__)
+
+# Версионированные миграции схемы: примененные версии записаны в schema_migrations,
+# и при старте выполняется только то, чего в базе еще нет. Процессы, стартующие
+# одновременно, применяют миграции по очереди под advisory lock.
+#
+# Примененную миграцию не меняют: изменение схемы - новая версия в конце MIGRATIONS.
+# Все ранние миграции написаны с IF NOT EXISTS, поэтому база, созданная до появления
+# schema_migrations, просто получает записи о них без изменений.
+#
+#   python migrations.py status   # какие версии применены
+#   python migrations.py up       # применить недостающие
+
+DB_MIGRATE_ON_START = os.getenv("DB_MIGRATE_ON_START", "1") == "1"
+
+MIGRATIONS_SCHEMA = '''CREATE TABLE IF NOT EXISTS schema_migrations (version INTEGER PRIMARY KEY, name TEXT NOT NULL, applied_at TIMESTAMP NOT NULL DEFAULT (now() AT TIME ZONE 'utc'))'''
+
+BASE_SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS sticker_stats (chat_id BIGINT, unique_id TEXT, file_id TEXT, count INTEGER DEFAULT 1, PRIMARY KEY (chat_id, unique_id))''',
+    '''CREATE TABLE IF NOT EXISTS word_stats (chat_id BIGINT, word TEXT, count INTEGER DEFAULT 1, PRIMARY KEY (chat_id, word))''',
+    '''CREATE TABLE IF NOT EXISTS user_stats (chat_id BIGINT, user_id BIGINT, full_name TEXT, msg_count INTEGER DEFAULT 1, PRIMARY KEY (chat_id, user_id))''',
+    '''CREATE TABLE IF NOT EXISTS message_stats (chat_id BIGINT, message_id BIGINT, user_id BIGINT, full_name TEXT, content TEXT, length INTEGER, reaction_count INTEGER DEFAULT 0, PRIMARY KEY (chat_id, message_id))''',
+    '''CREATE TABLE IF NOT EXISTS chat_settings (chat_id BIGINT PRIMARY KEY, auto_report_interval INTEGER DEFAULT NULL, last_report_time TIMESTAMP DEFAULT NULL)''',
+]
+
+# (версия, имя, запросы)
+MIGRATIONS = [
+    (1, "base", BASE_SCHEMA),
+    (2, "leaderboard", LEADERBOARD_SCHEMA),
+    (3, "rollups", ROLLUP_SCHEMA),
+    (4, "message_retention", MESSAGE_RETENTION_SCHEMA),
+    (5, "chat_purge", CHAT_PURGE_SCHEMA),
+    (6, "report_scheduler", REPORT_SCHEDULER_SCHEMA),
+    (7, "titles", TITLE_SCHEMA),
+    (8, "jobs", JOBS_SCHEMA),
+    (9, "reactions", REACTIONS_SCHEMA),
+    (10, "word_sketches", WORD_SKETCH_SCHEMA),
+    (11, "chat_versions", CHAT_VERSIONS_SCHEMA),
+    (12, "report_retries", REPORT_RETRY_SCHEMA),
+    (13, "jobs_release_failed", JOBS_RELEASE_FAILED_SCHEMA),
+]
+
+
+def _transactional(statements):
+    # CREATE INDEX CONCURRENTLY нельзя выполнять в транзакции; такие миграции
+    # идемпотентны и после сбоя посередине просто повторяются целиком
+    return not any("CONCURRENTLY" in statement.upper() for statement in statements)
+
+
+async def applied_versions(conn):
+    if not await conn.fetchval("SELECT to_regclass('schema_migrations') IS NOT NULL"):
+        return set()
+    rows = await conn.fetch('SELECT version FROM schema_migrations')
+    return {row['version'] for row in rows}
+
+
+async def pending(pool):
+    async with pool.acquire() as conn:
+        applied = await applied_versions(conn)
+    return [m for m in MIGRATIONS if m[0] not in applied]
+
+
+async def _apply(conn, version, name, statements):
+    for statement in statements:
+        await conn.execute(statement)
+    await conn.execute('INSERT INTO schema_migrations (version, name) VALUES ($1, $2)', version, name)
+
+
+async def migrate(pool):
+    """Применяет недостающие миграции; возвращает число примененных"""
+    async with pool.acquire() as conn:
+        applied = await applied_versions(conn)
+        if all(version in applied for version, _, _ in MIGRATIONS):
+            return 0
+        key = lock_key("migrations")
+        await conn.execute('SELECT pg_advisory_lock($1)', key)
+        try:
+            await conn.execute(MIGRATIONS_SCHEMA)
+            # Пока ждали блокировку, миграции мог применить другой процесс
+            applied = await applied_versions(conn)
+            count = 0
+            for version, name, statements in MIGRATIONS:
+                if version in applied:
+                    continue
+                if _transactional(statements):
+                    async with conn.transaction():
+                        await _apply(conn, version, name, statements)
+                else:
+                    await _apply(conn, version, name, statements)
+                count += 1
+                logger.info("Применена миграция %d %s", version, name, extra=fields(version=version))
+            return count
+        finally:
+            await conn.execute('SELECT pg_advisory_unlock($1)', key)
+
+
+async def _main(argv):
+    import dotenv
+    from db import create_pool
+
+    dotenv.load_dotenv()
+    command = argv[1] if len(argv) > 1 else "status"
+    if command not in ("status", "up"):
+        print("Использование: python migrations.py [status|up]")
+        return 1
+
+    pool = await create_pool(os.getenv("DATABASE_URL"), min_size=1, max_size=1)
+    try:
+        if command == "up":
+            count = await migrate(pool)
+            print(f"✅ Применено миграций: {count}")
+        async with pool.acquire() as conn:
+            applied = await applied_versions(conn)
+        for version, name, _ in MIGRATIONS:
+            print(f"{'✅' if version in applied else '⏳'} {version:>3} {name}")
+    finally:
+        await pool.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(_main(sys.argv)))
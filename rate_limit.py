@@ -0,0 +1,72 @@
+import asyncio
+import time
+
+# Ведра токенов для ограничения частоты запросов к Telegram.
+
+
+class TokenBucket:
+    """Ведро токенов с резервированием: токены можно взять в долг, и тогда вызывающий
+    ждет, пока долг погасится. Поэтому ожидающие обслуживаются строго по очереди."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, tokens=1):
+        """Списывает токены и возвращает, сколько секунд нужно подождать"""
+        self._refill(time.monotonic())
+        self.tokens -= tokens
+        return max(0.0, -self.tokens / self.rate)
+
+    def idle(self):
+        self._refill(time.monotonic())
+        return self.tokens >= self.capacity
+
+    async def acquire(self, tokens=1):
+        delay = self.reserve(tokens)
+        if delay:
+            await asyncio.sleep(delay)
+        return delay
+
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 10
+
+
+class PriorityTokenBucket(TokenBucket):
+    """Ведро с классами приоритета: фоновые запросы не берут последние reserve токенов
+    и ждут, пока в очереди есть интерактивные"""
+
+    def __init__(self, rate, capacity, reserve=0.0):
+        super().__init__(rate, capacity)
+        self.reserve_tokens = min(reserve, capacity)
+        self.waiting = {PRIORITY_INTERACTIVE: 0, PRIORITY_BACKGROUND: 0}
+
+    def penalize(self, seconds):
+        """Telegram попросил подождать: никто не получает токены ближайшие seconds секунд"""
+        self._refill(time.monotonic())
+        self.tokens = min(self.tokens, -seconds * self.rate)
+
+    async def acquire(self, tokens=1, priority=PRIORITY_INTERACTIVE):
+        background = priority != PRIORITY_INTERACTIVE
+        need = min(tokens + (self.reserve_tokens if background else 0), self.capacity)
+        waited = 0.0
+        self.waiting[PRIORITY_BACKGROUND if background else PRIORITY_INTERACTIVE] += 1
+        try:
+            while True:
+                self._refill(time.monotonic())
+                if self.tokens >= need and not (background and self.waiting[PRIORITY_INTERACTIVE]):
+                    self.tokens -= tokens
+                    return waited
+                # Токенов хватает, но впереди интерактивные запросы - проверяем снова чуть позже
+                delay = (need - self.tokens) / self.rate if self.tokens < need else 0.05
+                await asyncio.sleep(delay)
+                waited += delay
+        finally:
+            self.waiting[PRIORITY_BACKGROUND if background else PRIORITY_INTERACTIVE] -= 1
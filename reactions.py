@@ -0,0 +1,195 @@
+import asyncio
+import os
+import time
+
+from db import Query
+from leaderboard import LEADERBOARD_SIZE
+from api_cache import BUMP_CHAT_VERSIONS
+from metrics import Histogram
+from log import get_logger
+
+logger = get_logger(__name__)
+
+# Реакции на сообщения: события копятся в памяти, и все изменения одного сообщения
+# за интервал сбрасываются одной строкой общего UPDATE. Итог по сообщению считается
+# из двух источников: message_reaction (один пользователь поменял свои реакции - к итогу
+# прибавляется разница) и message_reaction_count (анонимные реакции - Telegram
+# присылает готовый итог, и он заменяет накопленное). Топ сообщений по реакциям
+# держат лидерборды (вид "message"), отчеты и API не сканируют message_stats.
+
+REACTIONS_FLUSH_INTERVAL = float(os.getenv("REACTIONS_FLUSH_INTERVAL", 5.0))
+REACTIONS_FLUSH_MAX_KEYS = int(os.getenv("REACTIONS_FLUSH_MAX_KEYS", 5000))
+
+REACTIONS_SCHEMA = [
+    '''CREATE INDEX CONCURRENTLY IF NOT EXISTS message_stats_chat_reactions_idx ON message_stats (chat_id, reaction_count DESC) INCLUDE (message_id, full_name) WHERE reaction_count > 0''',
+    # Топ по реакциям дописывается к уже сохраненным лидербордам, остальные виды не трогаются;
+    # чаты без сохраненного лидерборда пересчитаются целиком при первом обращении
+    '''INSERT INTO chat_leaderboard (chat_id, kind, key, label, count)
+       SELECT chat_id, 'message', key, label, count FROM (
+           SELECT chat_id, message_id::text AS key, full_name AS label, reaction_count AS count,
+                  row_number() OVER (PARTITION BY chat_id ORDER BY reaction_count DESC) AS rn
+           FROM message_stats WHERE reaction_count > 0 AND chat_id IN (SELECT chat_id FROM chat_leaderboard)
+       ) ranked WHERE rn <= {size}
+       ON CONFLICT (chat_id, kind, key) DO NOTHING'''.format(size=LEADERBOARD_SIZE),
+]
+
+# total - итог из message_reaction_count или NULL, delta - изменения после него
+APPLY_REACTIONS = Query("apply_reactions", '''
+    UPDATE message_stats m SET reaction_count = GREATEST(0, COALESCE(x.total, m.reaction_count) + x.delta)
+    FROM unnest($1::bigint[], $2::bigint[], $3::int[], $4::int[]) AS x(c, mid, delta, total)
+    WHERE m.chat_id = x.c AND m.message_id = x.mid
+    RETURNING m.chat_id, m.message_id::text, m.full_name, m.reaction_count
+''')
+
+# Топ за период: частичный индекс содержит только сообщения с реакциями
+TOP_REACTED_SINCE = Query("top_reacted_since", '''
+    SELECT message_id::text AS key, full_name AS label, reaction_count AS count FROM message_stats
+    WHERE chat_id = $1 AND reaction_count > 0 AND created_at >= $2
+    ORDER BY reaction_count DESC LIMIT $3
+''')
+
+MESSAGE_DETAILS = Query(
+    "message_details", 'SELECT user_id, full_name, content, reaction_count FROM message_stats WHERE chat_id = $1 AND message_id = $2',
+)
+
+
+class ReactionBuffer:
+    def __init__(self, pool, stats_buffer, leaderboards=None, interval=REACTIONS_FLUSH_INTERVAL,
+                 max_keys=REACTIONS_FLUSH_MAX_KEYS):
+        self.pool = pool
+        self.stats_buffer = stats_buffer
+        self.leaderboards = leaderboards
+        self.interval = interval
+        self.max_keys = max_keys
+
+        self.pending = {}  # (chat_id, message_id) -> [delta, итог или None]
+        self._flush_lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        # Обработчики, вызываемые с множеством chat_id после успешного сброса
+        self.on_flush = []
+
+        self.events = 0
+        self.rows_written = 0
+        self.unmatched = 0
+        self.flush_count = 0
+        self.flush_errors = 0
+        self.flush_time = Histogram()
+
+    def _entry(self, chat_id, message_id):
+        if chat_id in self.stats_buffer.blocked_chats:
+            return None
+        self.events += 1
+        entry = self.pending.get((chat_id, message_id))
+        if entry is None:
+            entry = self.pending[(chat_id, message_id)] = [0, None]
+            if len(self.pending) >= self.max_keys:
+                self._wakeup.set()
+        return entry
+
+    def add_change(self, chat_id, message_id, old_count, new_count):
+        """Пользователь поменял свои реакции на сообщение"""
+        entry = self._entry(chat_id, message_id)
+        if entry is not None:
+            entry[0] += new_count - old_count
+
+    def set_total(self, chat_id, message_id, total):
+        """Итог по анонимным реакциям: заменяет все накопленное до него"""
+        entry = self._entry(chat_id, message_id)
+        if entry is not None:
+            entry[0] = 0
+            entry[1] = total
+
+    def _restore(self, batch):
+        # Более новые события поверх несброшенных: пришедший позже итог важнее старых изменений
+        for key, (delta, total) in batch.items():
+            entry = self.pending.get(key)
+            if entry is None:
+                self.pending[key] = [delta, total]
+            elif entry[1] is None:
+                entry[0] += delta
+                entry[1] = total
+
+    async def flush(self):
+        async with self._flush_lock:
+            self._wakeup.clear()
+            blocked = self.stats_buffer.blocked_chats
+            batch = {k: v for k, v in self.pending.items() if k[0] not in blocked}
+            self.pending = {}
+            if not batch:
+                return
+            # Реакция могла прийти раньше, чем сообщение записано в базу
+            await self.stats_buffer.flush()
+            started = time.monotonic()
+            keys = list(batch)
+            try:
+                async with self.pool.acquire() as conn:
+                    rows = await APPLY_REACTIONS.fetch(
+                        conn,
+                        [k[0] for k in keys], [k[1] for k in keys],
+                        [batch[k][0] for k in keys], [batch[k][1] for k in keys],
+                    )
+                    if rows:
+                        await BUMP_CHAT_VERSIONS.execute(conn, sorted({r[0] for r in rows}))
+            except Exception as e:
+                self.flush_errors += 1
+                self._restore(batch)
+                logger.warning("Ошибка сброса реакций: %s", e)
+                return
+
+            self.flush_count += 1
+            self.rows_written += len(rows)
+            # Сообщения до подключения бота или уже перенесенные в архив
+            self.unmatched += len(keys) - len(rows)
+            self.flush_time.observe(time.monotonic() - started)
+
+            if self.leaderboards is not None and rows:
+                try:
+                    await self.leaderboards.apply([(r[0], "message", r[1], r[2], r[3]) for r in rows])
+                except Exception as e:
+                    logger.warning("Ошибка обновления топа реакций: %s", e)
+
+            chat_ids = {r[0] for r in rows}
+            for callback in self.on_flush:
+                try:
+                    callback(chat_ids)
+                except Exception:
+                    logger.exception("Ошибка обработчика сброса реакций")
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            await self.flush()
+
+    async def top_since(self, chat_id, since, limit):
+        """[(message_id, автор, реакций), ...] среди сообщений, отправленных после since"""
+        async with self.pool.acquire() as conn:
+            rows = await TOP_REACTED_SINCE.fetch(conn, chat_id, since, limit)
+        return [(r['key'], r['label'], r['count']) for r in rows]
+
+    async def message(self, chat_id, message_id):
+        async with self.pool.acquire() as conn:
+            return await MESSAGE_DETAILS.fetchrow(conn, chat_id, message_id)
+
+    def collect(self):
+        yield "reaction_events_total", "counter", "События реакций", [({}, self.events)]
+        yield "reaction_rows_total", "counter", "Строки message_stats, обновленные сбросом реакций", [({}, self.rows_written)]
+        yield "reaction_unmatched_total", "counter", "Реакции на сообщения, которых нет в message_stats", [({}, self.unmatched)]
+        yield "reaction_flush_errors_total", "counter", "Ошибки сброса реакций", [({}, self.flush_errors)]
+        yield "reaction_pending_messages", "gauge", "Сообщения с несброшенными реакциями", [({}, len(self.pending))]
+        yield "reaction_flush_seconds", "histogram", "Длительность сброса реакций", [({}, self.flush_time)]
+
+    def stats(self):
+        written = self.rows_written + self.unmatched
+        return {
+            "pending_messages": len(self.pending),
+            "events": self.events,
+            "rows_written": self.rows_written,
+            "unmatched": self.unmatched,
+            "events_per_write": round(self.events / written, 2) if written else None,
+            "flush_count": self.flush_count,
+            "flush_errors": self.flush_errors,
+            "flush_time": self.flush_time.snapshot(),
+        }
@@ -0,0 +1,57 @@
+import hashlib
+import json
+import os
+from collections import OrderedDict
+
+from blob_cache import BlobCache
+
+# Кэш готовых карточек статистики. Ключ - хэш шаблона и входных данных
+# (вместо байтов аватарки/стикера берется их file_unique_id), поэтому
+# неизменившаяся статистика не рендерится и не загружается в Telegram повторно.
+
+RENDER_CACHE_VERSION = os.getenv("RENDER_CACHE_VERSION", "1")
+RENDER_CACHE_MEMORY_BYTES = int(os.getenv("RENDER_CACHE_MEMORY_BYTES", 64 * 1024 * 1024))
+RENDER_CACHE_DIR = os.getenv("RENDER_CACHE_DIR")  # дисковый уровень выключен, если не задан
+RENDER_CACHE_DISK_BYTES = int(os.getenv("RENDER_CACHE_DISK_BYTES", 512 * 1024 * 1024))
+RENDER_CACHE_FILE_IDS = int(os.getenv("RENDER_CACHE_FILE_IDS", 10000))
+
+
+def make_key(template, *values):
+    payload = json.dumps([RENDER_CACHE_VERSION, template, values], ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class RenderCache(BlobCache):
+    def __init__(self, max_bytes=RENDER_CACHE_MEMORY_BYTES, disk_dir=RENDER_CACHE_DIR,
+                 disk_max_bytes=RENDER_CACHE_DISK_BYTES, max_file_ids=RENDER_CACHE_FILE_IDS):
+        super().__init__(max_bytes, disk_dir, disk_max_bytes)
+        self.max_file_ids = max_file_ids
+        self.file_ids = OrderedDict()  # ключ -> file_id уже загруженного в Telegram файла
+        self.file_id_hits = 0
+
+    def contains(self, key):
+        return key in self.file_ids or super().contains(key)
+
+    # --- file_id от Telegram ---
+
+    def get_file_id(self, key):
+        file_id = self.file_ids.get(key)
+        if file_id:
+            self.file_ids.move_to_end(key)
+            self.file_id_hits += 1
+        return file_id
+
+    def put_file_id(self, key, file_id):
+        self.file_ids[key] = file_id
+        self.file_ids.move_to_end(key)
+        while len(self.file_ids) > self.max_file_ids:
+            self.file_ids.popitem(last=False)
+
+    def forget_file_id(self, key):
+        self.file_ids.pop(key, None)
+
+    def stats(self):
+        stats = super().stats()
+        stats["file_ids"] = len(self.file_ids)
+        stats["hits"]["file_id"] = self.file_id_hits
+        return stats
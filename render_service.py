@@ -0,0 +1,166 @@
+import asyncio
+import itertools
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import main_draw
+from metrics import Histogram
+from log import get_logger, fields
+
+logger = get_logger(__name__)
+
+# Очередь рендеринга карточек: ограниченный пул воркеров с прогретыми шаблонами,
+# интерактивный /stats обслуживается раньше плановых авто-отчетов.
+
+RENDER_EXECUTOR = os.getenv("RENDER_EXECUTOR", "process")  # process | thread
+RENDER_WORKERS = int(os.getenv("RENDER_WORKERS", 2))
+# В пуле процессов зависший рендер останавливается: пул пересоздается, а его процессы
+# завершаются. Поток остановить нельзя, в режиме thread таймаут ограничивает только ожидание
+RENDER_TIMEOUT = float(os.getenv("RENDER_TIMEOUT", 60))
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 10
+
+RENDERERS = {
+    "active": main_draw.create_active_user_image,
+    "words": main_draw.create_top_words_image,
+    "sticker": main_draw.create_top_sticker_image,
+    "sticker_video": main_draw.create_top_sticker_gif,
+    "reactions": main_draw.create_most_reacted_image,
+}
+
+RENDER_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _init_worker():
+    main_draw.assets.preload()
+
+
+def _render(template, args):
+    result = RENDERERS[template](*args)
+    return result.read() if result else None
+
+
+class RenderService:
+    def __init__(self, executor=RENDER_EXECUTOR, workers=RENDER_WORKERS, timeout=RENDER_TIMEOUT):
+        if executor not in ("process", "thread"):
+            raise ValueError(f"Неизвестный тип пула рендеринга: {executor}")
+        self.executor_type = executor
+        self.workers = workers
+        self.timeout = timeout
+        self.executor = None
+        self.queue = asyncio.PriorityQueue()
+        self.in_flight = {}  # ключ рендера -> future с результатом
+        self._seq = itertools.count()
+        self._dispatchers = []
+
+        self.completed = 0
+        self.failed = 0
+        self.timeouts = 0
+        self.recycles = 0
+        self.deduplicated = 0
+        self.queue_wait = Histogram(RENDER_BUCKETS)
+        self.render_time = {name: Histogram(RENDER_BUCKETS) for name in RENDERERS}
+
+    def _create_executor(self):
+        if self.executor_type == "process":
+            return ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker)
+        return ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="render")
+
+    def _recycle(self, executor):
+        """Заменяет пул процессов, в котором завис рендер, и завершает его процессы"""
+        if self.executor_type != "process" or self.executor is not executor:
+            return
+        self.executor = self._create_executor()
+        self.recycles += 1
+        # У ProcessPoolExecutor нет публичного способа остановить занятый процесс
+        for process in list(getattr(executor, "_processes", {}).values()):
+            process.terminate()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def start(self):
+        self.executor = self._create_executor()
+        self._dispatchers = [asyncio.create_task(self._dispatch()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._dispatchers:
+            task.cancel()
+        await asyncio.gather(*self._dispatchers, return_exceptions=True)
+        self._dispatchers = []
+        for future in self.in_flight.values():
+            if not future.done():
+                future.set_result(None)
+        self.in_flight.clear()
+        if self.executor:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+    async def render(self, template, args, key, priority=PRIORITY_BACKGROUND):
+        """Байты готовой карточки или None; одинаковые рендеры в работе объединяются"""
+        future = self.in_flight.get(key)
+        if future is not None:
+            self.deduplicated += 1
+            return await asyncio.shield(future)
+
+        future = asyncio.get_running_loop().create_future()
+        self.in_flight[key] = future
+        self.queue.put_nowait((priority, next(self._seq), template, args, key, future, time.perf_counter()))
+        return await asyncio.shield(future)
+
+    async def _dispatch(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            _, _, template, args, key, future, enqueued = await self.queue.get()
+            started = time.perf_counter()
+            self.queue_wait.observe(started - enqueued)
+            result = None
+            executor = self.executor
+            try:
+                try:
+                    result = await asyncio.wait_for(loop.run_in_executor(executor, _render, template, args), self.timeout)
+                except BrokenProcessPool:
+                    # Пул пересоздан из-за чужого зависшего рендера: повторяем в новом
+                    if self.executor is executor:
+                        raise
+                    executor = self.executor
+                    result = await asyncio.wait_for(loop.run_in_executor(executor, _render, template, args), self.timeout)
+                self.completed += 1
+            except asyncio.TimeoutError:
+                self.timeouts += 1
+                logger.warning("Превышено время рендеринга (%s с)", self.timeout, extra=fields(template=template))
+                self._recycle(executor)
+            except Exception as e:
+                self.failed += 1
+                logger.error("Ошибка генерации картинки: %s", e, extra=fields(template=template))
+            finally:
+                self.render_time[template].observe(time.perf_counter() - started)
+                self.in_flight.pop(key, None)
+                if not future.done():
+                    future.set_result(result)
+
+    def collect(self):
+        yield "render_seconds", "histogram", "Время рендеринга карточки", [({"template": n}, h) for n, h in self.render_time.items()]
+        yield "render_queue_wait_seconds", "histogram", "Ожидание в очереди рендеринга", [({}, self.queue_wait)]
+        yield "render_results_total", "counter", "Результаты рендеринга", [
+            ({"result": "ok"}, self.completed), ({"result": "error"}, self.failed), ({"result": "timeout"}, self.timeouts),
+        ]
+        yield "render_pool_recycles_total", "counter", "Пересоздания пула рендеринга после таймаута", [({}, self.recycles)]
+        yield "render_deduplicated_total", "counter", "Рендеры, объединенные с уже идущими", [({}, self.deduplicated)]
+        yield "render_queue_depth", "gauge", "Карточек в очереди рендеринга", [({}, self.queue.qsize())]
+
+    def stats(self):
+        return {
+            "executor": self.executor_type,
+            "workers": self.workers,
+            "queue_depth": self.queue.qsize(),
+            "in_flight": len(self.in_flight),
+            "completed": self.completed,
+            "failed": self.failed,
+            "timeouts": self.timeouts,
+            "recycles": self.recycles,
+            "deduplicated": self.deduplicated,
+            "queue_wait": self.queue_wait.snapshot(),
+            "render_time": {name: h.snapshot() for name, h in self.render_time.items()},
+        }
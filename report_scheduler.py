@@ -0,0 +1,244 @@
+import asyncio
+import heapq
+import os
+import random
+import time
+from datetime import datetime, timedelta
+
+from metrics import Histogram
+from log import get_logger, fields
+
+logger = get_logger(__name__)
+
+# Планировщик авто-отчетов: время следующего отчета хранится в chat_settings.next_report_at
+# (с индексом), ближайшие по времени чаты держатся в куче, а отчеты отправляются
+# параллельно, но не больше REPORT_CONCURRENCY одновременно. Время - локальное, как и
+# last_report_time.
+
+REPORT_CONCURRENCY = int(os.getenv("REPORT_CONCURRENCY", 4))
+REPORT_LOOKAHEAD = float(os.getenv("REPORT_LOOKAHEAD", 600))
+REPORT_REFRESH = float(os.getenv("REPORT_REFRESH", 60))
+REPORT_BATCH = int(os.getenv("REPORT_BATCH", 1000))
+REPORT_JITTER = float(os.getenv("REPORT_JITTER", 300))
+# Неотправленный отчет повторяется через REPORT_RETRY_DELAY, 2 * REPORT_RETRY_DELAY, ...,
+# а после REPORT_MAX_ATTEMPTS неудач подряд ждет следующего отчета по расписанию
+REPORT_RETRY_DELAY = float(os.getenv("REPORT_RETRY_DELAY", 900))
+REPORT_MAX_ATTEMPTS = int(os.getenv("REPORT_MAX_ATTEMPTS", 4))
+
+LAG_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 900, 3600)
+
+REPORT_SCHEDULER_SCHEMA = [
+    '''ALTER TABLE chat_settings ADD COLUMN IF NOT EXISTS next_report_at TIMESTAMP DEFAULT NULL''',
+    '''CREATE INDEX IF NOT EXISTS chat_settings_next_report_idx ON chat_settings (next_report_at) WHERE auto_report_interval IS NOT NULL''',
+]
+
+REPORT_RETRY_SCHEMA = [
+    '''ALTER TABLE chat_settings ADD COLUMN IF NOT EXISTS report_attempts INTEGER NOT NULL DEFAULT 0''',
+]
+
+DUE_SQL = '''
+    SELECT chat_id, auto_report_interval, next_report_at FROM chat_settings
+    WHERE auto_report_interval IS NOT NULL AND next_report_at <= $1
+    ORDER BY next_report_at LIMIT $2
+'''
+
+# Отчет забирается условным UPDATE: если настройки поменялись или отчет уже забрал
+# другой процесс, строка не обновится
+CLAIM_SQL = '''
+    UPDATE chat_settings SET next_report_at = $2, last_report_time = $3
+    WHERE chat_id = $1 AND next_report_at = $4 AND auto_report_interval = $5
+    RETURNING report_attempts
+'''
+
+# Повтор не сдвигает расписание, если его уже поменяли настройки чата
+RETRY_SQL = '''
+    UPDATE chat_settings SET next_report_at = $2, report_attempts = $3 WHERE chat_id = $1 AND next_report_at = $4
+'''
+
+
+class ReportScheduler:
+    def __init__(self, pool, send, concurrency=REPORT_CONCURRENCY, lookahead=REPORT_LOOKAHEAD,
+                 refresh=REPORT_REFRESH, batch=REPORT_BATCH, jitter=REPORT_JITTER, retry_delay=REPORT_RETRY_DELAY,
+                 max_attempts=REPORT_MAX_ATTEMPTS):
+        self.pool = pool
+        self.send = send  # async (chat_id, интервал в днях) -> bool, отправлен ли отчет
+        self.lookahead = lookahead
+        self.refresh = refresh
+        self.batch = batch
+        self.jitter = jitter
+        self.retry_delay = retry_delay
+        self.max_attempts = max_attempts
+
+        self.heap = []        # (время отчета, chat_id)
+        self.scheduled = {}   # chat_id -> (время отчета, интервал); записи кучи без пары здесь устарели
+        self.running = set()
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._wakeup = asyncio.Event()
+        self._tasks = set()
+        self._refilled_at = 0.0
+        self._active = False  # цикл run идет в этом процессе
+
+        self.sent = 0
+        self.failed = 0
+        self.skipped = 0
+        self.given_up = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self.lag = Histogram(LAG_BUCKETS)
+
+    def _jittered(self, moment):
+        return moment + timedelta(seconds=random.uniform(0, self.jitter))
+
+    async def _backfill(self):
+        """Заполняет next_report_at у чатов, настроенных до появления колонки"""
+        now = datetime.now()
+        async with self.pool.acquire() as conn:
+            rows = await conn.fetch(
+                'SELECT chat_id, auto_report_interval, last_report_time FROM chat_settings '
+                'WHERE auto_report_interval IS NOT NULL AND next_report_at IS NULL'
+            )
+            await conn.executemany(
+                'UPDATE chat_settings SET next_report_at = $2 WHERE chat_id = $1 AND next_report_at IS NULL',
+                [
+                    (r['chat_id'], self._jittered(max(now, r['last_report_time'] + timedelta(days=r['auto_report_interval']))
+                                                  if r['last_report_time'] else now))
+                    for r in rows
+                ],
+            )
+
+    def _push(self, chat_id, due, interval):
+        if chat_id in self.running or self.scheduled.get(chat_id) == (due, interval):
+            return
+        self.scheduled[chat_id] = (due, interval)
+        heapq.heappush(self.heap, (due, chat_id))
+
+    def reschedule(self, chat_id, due, interval):
+        """Вызывается при изменении настроек чата; due=None - отчеты отключены.
+        Без цикла run в этом процессе кучу некому разбирать: отчет подхватит
+        планировщик другого процесса по next_report_at"""
+        if not self._active:
+            return
+        self.scheduled.pop(chat_id, None)
+        if due is not None and due <= datetime.now() + timedelta(seconds=self.lookahead):
+            self._push(chat_id, due, interval)
+        self._wakeup.set()
+
+    async def _refill(self):
+        horizon = datetime.now() + timedelta(seconds=self.lookahead)
+        async with self.pool.acquire() as conn:
+            rows = await conn.fetch(DUE_SQL, horizon, self.batch)
+        for row in rows:
+            self._push(row['chat_id'], row['next_report_at'], row['auto_report_interval'])
+        self._refilled_at = time.monotonic()
+
+    async def run(self):
+        self._active = True
+        try:
+            await self._run()
+        finally:
+            self._active = False
+            self.heap.clear()
+            self.scheduled.clear()
+            self._refilled_at = 0.0
+
+    async def _run(self):
+        await self._backfill()
+        while True:
+            try:
+                if time.monotonic() - self._refilled_at >= self.refresh:
+                    await self._refill()
+            except Exception as e:
+                logger.warning("Ошибка загрузки расписания отчетов: %s", e)
+                self._refilled_at = time.monotonic()
+
+            now = datetime.now()
+            while self.heap and self.heap[0][0] <= now:
+                due, chat_id = heapq.heappop(self.heap)
+                entry = self.scheduled.get(chat_id)
+                if entry is None or entry[0] != due:
+                    continue
+                del self.scheduled[chat_id]
+                await self._semaphore.acquire()
+                self.running.add(chat_id)
+                task = asyncio.create_task(self._dispatch(chat_id, due, entry[1]))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+
+            timeout = self.refresh
+            if self.heap:
+                timeout = min(timeout, max(0.0, (self.heap[0][0] - datetime.now()).total_seconds()))
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    async def _dispatch(self, chat_id, due, interval):
+        try:
+            now = datetime.now()
+            lag = (now - due).total_seconds()
+            next_at = due + timedelta(days=interval)
+            if next_at <= now:
+                # Пропущено несколько отчетов (бот был выключен): отправляем один и сдвигаем расписание
+                next_at = self._jittered(now + timedelta(days=interval))
+
+            async with self.pool.acquire() as conn:
+                attempts = await conn.fetchval(CLAIM_SQL, chat_id, next_at, now, due, interval)
+            if attempts is None:
+                self.skipped += 1
+                return
+
+            self.last_lag = lag
+            self.max_lag = max(self.max_lag, lag)
+            self.lag.observe(lag)
+            logger.info("Отправка автоматического отчета", extra=fields(chat_id=chat_id, lag=round(lag, 1)))
+            if await self.send(chat_id, interval):
+                self.sent += 1
+                if attempts:
+                    async with self.pool.acquire() as conn:
+                        await conn.execute('UPDATE chat_settings SET report_attempts = 0 WHERE chat_id = $1', chat_id)
+                return
+
+            self.failed += 1
+            attempts += 1
+            if attempts >= self.max_attempts:
+                # Отчет в этот чат не уходит: следующая попытка - по обычному расписанию
+                self.given_up += 1
+                logger.warning("Авто-отчет не отправлен после %d попыток", attempts, extra=fields(chat_id=chat_id))
+                retry_at, attempts = next_at, 0
+            else:
+                retry_at = min(datetime.now() + timedelta(seconds=self.retry_delay * 2 ** (attempts - 1)), next_at)
+            async with self.pool.acquire() as conn:
+                await conn.execute(RETRY_SQL, chat_id, retry_at, attempts, next_at)
+        except Exception as e:
+            self.failed += 1
+            logger.warning("Ошибка отправки авто-отчета: %s", e, extra=fields(chat_id=chat_id))
+        finally:
+            self.running.discard(chat_id)
+            self._semaphore.release()
+
+    async def stop(self):
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def collect(self):
+        yield "reports_total", "counter", "Авто-отчеты по результату", [
+            ({"result": "sent"}, self.sent), ({"result": "failed"}, self.failed), ({"result": "skipped"}, self.skipped),
+            ({"result": "given_up"}, self.given_up),
+        ]
+        yield "report_lag_seconds", "histogram", "Задержка отправки авто-отчета относительно расписания", [({}, self.lag)]
+        yield "reports_scheduled", "gauge", "Отчеты в ближайшем окне расписания", [({}, len(self.scheduled))]
+        yield "reports_running", "gauge", "Отчеты, отправляемые сейчас", [({}, len(self.running))]
+
+    def stats(self):
+        return {
+            "scheduled": len(self.scheduled),
+            "running": len(self.running),
+            "sent": self.sent,
+            "failed": self.failed,
+            "skipped": self.skipped,
+            "given_up": self.given_up,
+            "last_lag_seconds": round(self.last_lag, 3),
+            "max_lag_seconds": round(self.max_lag, 3),
+        }
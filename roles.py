@@ -0,0 +1,38 @@
+import os
+
+# Роли процесса. Один и тот же код можно запустить несколькими процессами на одной базе:
+#   ingest    - прием апдейтов (polling или webhook) и запись статистики
+#   api       - HTTP API для сайта
+#   scheduler - авто-отчеты, титулы и обслуживание базы (в одном процессе из всех, см. leader.py)
+#   render    - рендеринг карточек и отправка отчетов из очереди заданий (см. jobs.py)
+# По умолчанию процесс выполняет все роли, как раньше.
+#   BOT_ROLES=ingest,api python bot.py
+#   python bot.py --role render
+
+ALL_ROLES = ("ingest", "api", "scheduler", "render")
+
+
+def parse_roles(spec):
+    spec = (spec or "").strip().lower()
+    if spec in ("", "all"):
+        return set(ALL_ROLES)
+    roles = {role.strip() for role in spec.split(",") if role.strip()}
+    unknown = roles - set(ALL_ROLES)
+    if unknown:
+        raise ValueError(f"Неизвестные роли: {', '.join(sorted(unknown))} (доступны: {', '.join(ALL_ROLES)})")
+    return roles
+
+
+BOT_ROLES = parse_roles(os.getenv("BOT_ROLES", "all"))
+
+
+def configure(spec):
+    """Меняет роли процесса (флаг --role); множество меняется на месте, чтобы его видели все импорты"""
+    roles = parse_roles(spec)
+    BOT_ROLES.clear()
+    BOT_ROLES.update(roles)
+    os.environ["BOT_ROLES"] = ",".join(sorted(roles))
+
+
+def has_role(role):
+    return role in BOT_ROLES
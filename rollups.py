@@ -0,0 +1,164 @@
+import asyncio
+import os
+import re
+import time
+from datetime import datetime, timedelta, timezone
+from db import Query
+from log import get_logger
+
+logger = get_logger(__name__)
+
+# Статистика за период: счетчики пользователей, слов и стикеров по часовым
+# корзинам (пишутся при сбросе StatsBuffer), которые со временем сжимаются в
+# суточные. Отчеты за период читают только эти корзины, а не message_stats.
+
+ROLLUP_HOURLY_RETENTION = float(os.getenv("ROLLUP_HOURLY_RETENTION", 48 * 3600))
+ROLLUP_DAILY_RETENTION_DAYS = int(os.getenv("ROLLUP_DAILY_RETENTION_DAYS", 400))
+ROLLUP_COMPACT_INTERVAL = float(os.getenv("ROLLUP_COMPACT_INTERVAL", 3600))
+MAX_WINDOW_DAYS = 365
+
+ROLLUP_SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS stats_rollup (chat_id BIGINT, kind TEXT, bucket_start TIMESTAMP, granularity TEXT, key TEXT, label TEXT, count INTEGER, PRIMARY KEY (chat_id, kind, bucket_start, granularity, key))''',
+    '''CREATE INDEX IF NOT EXISTS stats_rollup_compact_idx ON stats_rollup (granularity, bucket_start)''',
+]
+
+# Корзина - текущий час по UTC на момент сброса буфера
+UPSERT_ROLLUP_SQL = '''
+    INSERT INTO stats_rollup (chat_id, kind, bucket_start, granularity, key, label, count)
+    SELECT c, k, date_trunc('hour', now() AT TIME ZONE 'utc'), 'hour', key, label, n
+    FROM unnest($1::bigint[], $2::text[], $3::text[], $4::text[], $5::int[]) AS x(c, k, key, label, n)
+    ON CONFLICT (chat_id, kind, bucket_start, granularity, key) DO UPDATE
+    SET count = stats_rollup.count + EXCLUDED.count, label = COALESCE(EXCLUDED.label, stats_rollup.label)
+'''
+UPSERT_ROLLUP = Query("upsert_rollup", UPSERT_ROLLUP_SQL)
+
+# Переносит часовые корзины одних суток в суточную
+COMPACT_DAY_SQL = '''
+    WITH moved AS (
+        DELETE FROM stats_rollup
+        WHERE granularity = 'hour' AND bucket_start >= $1 AND bucket_start < $1 + interval '1 day'
+        RETURNING chat_id, kind, key, label, count
+    )
+    INSERT INTO stats_rollup (chat_id, kind, bucket_start, granularity, key, label, count)
+    SELECT chat_id, kind, $1, 'day', key, max(label), sum(count) FROM moved
+    GROUP BY chat_id, kind, key
+    ON CONFLICT (chat_id, kind, bucket_start, granularity, key) DO UPDATE
+    SET count = stats_rollup.count + EXCLUDED.count, label = COALESCE(EXCLUDED.label, stats_rollup.label)
+'''
+
+WINDOW_TOP_SQL = '''
+    SELECT key, max(label) AS label, sum(count)::int AS count
+    FROM stats_rollup WHERE chat_id = $1 AND kind = $2 AND bucket_start >= $3
+    GROUP BY key ORDER BY count DESC LIMIT $4
+'''
+WINDOW_TOP = Query("window_top", WINDOW_TOP_SQL)
+
+WINDOW_RE = re.compile(r"^(\d+)\s*([hdчд]?)$")
+
+
+def parse_window(value):
+    """'24h', '24ч', '7d', '7д' или просто число дней -> timedelta; None, если окно не задано"""
+    if value is None:
+        return None
+    value = str(value).strip().lower()
+    if not value:
+        return None
+    match = WINDOW_RE.match(value)
+    if not match:
+        raise ValueError(f"Неверный период: {value}")
+    amount, unit = int(match.group(1)), match.group(2)
+    window = timedelta(hours=amount) if unit in ("h", "ч") else timedelta(days=amount)
+    if amount < 1 or window > timedelta(days=MAX_WINDOW_DAYS):
+        raise ValueError(f"Период должен быть от 1 часа до {MAX_WINDOW_DAYS} дней")
+    return window
+
+
+def describe_window(window):
+    if window is None:
+        return "за все время"
+    hours = int(window.total_seconds() // 3600)
+    if hours % 24:
+        return f"за {hours} ч"
+    return f"за {hours // 24} дн"
+
+
+def utc_now():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+class Rollups:
+    def __init__(self, pool, hourly_retention=ROLLUP_HOURLY_RETENTION,
+                 daily_retention_days=ROLLUP_DAILY_RETENTION_DAYS, interval=ROLLUP_COMPACT_INTERVAL):
+        self.pool = pool
+        self.hourly_retention = hourly_retention
+        self.daily_retention_days = daily_retention_days
+        self.interval = interval
+
+        self.queries = 0
+        self.compactions = 0
+        self.days_compacted = 0
+        self.compact_errors = 0
+        self.last_compact_at = None
+        self.last_compact_duration = 0.0
+
+    async def top(self, chat_id, kind, window, limit):
+        """[(ключ, подпись, счетчик), ...] за последние window; старые корзины суточные,
+        поэтому граница окна старше часового хранения округляется до суток"""
+        since = utc_now() - window
+        if window.total_seconds() > self.hourly_retention:
+            since = since.replace(hour=0, minute=0, second=0, microsecond=0)
+        else:
+            since = since.replace(minute=0, second=0, microsecond=0)
+        self.queries += 1
+        async with self.pool.acquire() as conn:
+            rows = await WINDOW_TOP.fetch(conn, chat_id, kind, since, limit)
+        return [(r['key'], r['label'], r['count']) for r in rows]
+
+    async def compact(self):
+        """Сжимает часовые корзины старше хранения в суточные (по одним суткам за транзакцию)
+        и удаляет суточные корзины старше ROLLUP_DAILY_RETENTION_DAYS"""
+        started = time.monotonic()
+        now = utc_now()
+        cutoff = (now - timedelta(seconds=self.hourly_retention)).replace(hour=0, minute=0, second=0, microsecond=0)
+        days = 0
+        async with self.pool.acquire() as conn:
+            while True:
+                oldest = await conn.fetchval(
+                    "SELECT min(bucket_start) FROM stats_rollup WHERE granularity = 'hour' AND bucket_start < $1", cutoff
+                )
+                if oldest is None:
+                    break
+                day = oldest.replace(hour=0, minute=0, second=0, microsecond=0)
+                async with conn.transaction():
+                    await conn.execute(COMPACT_DAY_SQL, day)
+                days += 1
+
+            await conn.execute(
+                "DELETE FROM stats_rollup WHERE granularity = 'day' AND bucket_start < $1",
+                now - timedelta(days=self.daily_retention_days),
+            )
+
+        self.compactions += 1
+        self.days_compacted += days
+        self.last_compact_at = time.time()
+        self.last_compact_duration = time.monotonic() - started
+
+    async def run(self):
+        """Фоновое сжатие корзин"""
+        while True:
+            try:
+                await self.compact()
+            except Exception as e:
+                self.compact_errors += 1
+                logger.warning("Ошибка сжатия корзин статистики: %s", e)
+            await asyncio.sleep(self.interval)
+
+    def stats(self):
+        return {
+            "queries": self.queries,
+            "compactions": self.compactions,
+            "days_compacted": self.days_compacted,
+            "compact_errors": self.compact_errors,
+            "last_compact_at": self.last_compact_at,
+            "last_compact_duration_seconds": round(self.last_compact_duration, 4),
+        }
@@ -0,0 +1,308 @@
+import asyncio
+import os
+import time
+
+from db import Query
+from metrics import Histogram
+from rollups import UPSERT_ROLLUP
+from api_cache import BUMP_CHAT_VERSIONS
+from log import get_logger, fields
+
+logger = get_logger(__name__)
+
+# Буфер отложенной записи счетчиков: вместо десятков UPSERT-ов на каждое
+# сообщение копим дельты в памяти и сбрасываем их несколькими bulk-запросами.
+
+FLUSH_MAX_KEYS = int(os.getenv("STATS_FLUSH_MAX_KEYS", 5000))
+FLUSH_INTERVAL = float(os.getenv("STATS_FLUSH_INTERVAL", 2.0))
+# После стольких неудачных сбросов подряд дельты выбрасываются, а не возвращаются в буфер:
+# строка, которую база не принимает, иначе копится и растет с каждой попыткой
+FLUSH_MAX_FAILURES = int(os.getenv("STATS_FLUSH_MAX_FAILURES", 5))
+
+UPSERT_USERS_SQL = '''
+    INSERT INTO user_stats (chat_id, user_id, full_name, msg_count)
+    SELECT * FROM unnest($1::bigint[], $2::bigint[], $3::text[], $4::int[])
+    ON CONFLICT (chat_id, user_id) DO UPDATE
+    SET msg_count = user_stats.msg_count + EXCLUDED.msg_count, full_name = EXCLUDED.full_name
+    RETURNING chat_id, user_id::text, full_name, msg_count
+'''
+UPSERT_USERS = Query("upsert_users", UPSERT_USERS_SQL)
+
+UPSERT_WORDS_SQL = '''
+    INSERT INTO word_stats (chat_id, word, count)
+    SELECT * FROM unnest($1::bigint[], $2::text[], $3::int[])
+    ON CONFLICT (chat_id, word) DO UPDATE
+    SET count = word_stats.count + EXCLUDED.count
+    RETURNING chat_id, word, NULL, count, xmax = 0 AS inserted
+'''
+UPSERT_WORDS = Query("upsert_words", UPSERT_WORDS_SQL)
+
+UPSERT_STICKERS_SQL = '''
+    INSERT INTO sticker_stats (chat_id, unique_id, file_id, count)
+    SELECT * FROM unnest($1::bigint[], $2::text[], $3::text[], $4::int[])
+    ON CONFLICT (chat_id, unique_id) DO UPDATE
+    SET count = sticker_stats.count + EXCLUDED.count, file_id = EXCLUDED.file_id
+    RETURNING chat_id, unique_id, file_id, count
+'''
+UPSERT_STICKERS = Query("upsert_stickers", UPSERT_STICKERS_SQL)
+
+INSERT_MESSAGES_SQL = '''
+    INSERT INTO message_stats (chat_id, message_id, user_id, full_name, content, length, reaction_count)
+    SELECT c, m, u, n, t, l, 0 FROM unnest($1::bigint[], $2::bigint[], $3::bigint[], $4::text[], $5::text[], $6::int[]) AS x(c, m, u, n, t, l)
+    ON CONFLICT (chat_id, message_id) DO NOTHING
+'''
+INSERT_MESSAGES = Query("insert_messages", INSERT_MESSAGES_SQL)
+
+
+class StatsBuffer:
+    def __init__(self, pool, max_keys=FLUSH_MAX_KEYS, interval=FLUSH_INTERVAL, leaderboards=None, word_sketches=None,
+                 max_failures=FLUSH_MAX_FAILURES):
+        self.pool = pool
+        self.leaderboards = leaderboards
+        # Слова больших чатов считаются приближенно (word_sketches.py), остальные - в word_stats
+        self.word_sketches = word_sketches
+        self.max_keys = max_keys
+        self.interval = interval
+        self.max_failures = max_failures
+
+        self.users = {}      # (chat_id, user_id) -> [full_name, delta]
+        self.words = {}      # (chat_id, word) -> delta
+        self.stickers = {}   # (chat_id, unique_id) -> [file_id, delta]
+        self.messages = []   # строки для message_stats
+        self.blocked_chats = set()  # чаты, данные которых удаляются: новые счетчики не принимаются
+
+        self._flush_lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._oldest_pending = None
+        # Обработчики, вызываемые с множеством chat_id после успешного сброса
+        self.on_flush = []
+
+        self.flush_count = 0
+        self.flush_errors = 0
+        self.consecutive_errors = 0
+        self.rows_flushed = 0
+        self.rows_dropped = 0
+        self.last_flush_at = None
+        self.last_flush_duration = 0.0
+        self.last_flush_lag = 0.0
+        self.max_flush_lag = 0.0
+        self.flush_time = Histogram()
+        self.flush_lag = Histogram((0.1, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0, 60.0))
+
+    def pending_keys(self):
+        return len(self.users) + len(self.words) + len(self.stickers) + len(self.messages)
+
+    def _touch(self):
+        if self._oldest_pending is None:
+            self._oldest_pending = time.monotonic()
+        if self.pending_keys() >= self.max_keys:
+            self._wakeup.set()
+
+    def add_message(self, chat_id, message_id, user_id, full_name, text, words):
+        if chat_id in self.blocked_chats:
+            return
+        entry = self.users.get((chat_id, user_id))
+        if entry:
+            entry[0] = full_name
+            entry[1] += 1
+        else:
+            self.users[(chat_id, user_id)] = [full_name, 1]
+
+        self.messages.append((chat_id, message_id, user_id, full_name, text, len(text)))
+
+        for word in words:
+            key = (chat_id, word)
+            self.words[key] = self.words.get(key, 0) + 1
+
+        self._touch()
+
+    def add_sticker(self, chat_id, unique_id, file_id):
+        if chat_id in self.blocked_chats:
+            return
+        entry = self.stickers.get((chat_id, unique_id))
+        if entry:
+            entry[0] = file_id
+            entry[1] += 1
+        else:
+            self.stickers[(chat_id, unique_id)] = [file_id, 1]
+        self._touch()
+
+    def discard_chat(self, chat_id):
+        """Выбрасывает несброшенные дельты чата (бот удален из чата)"""
+        self.users = {k: v for k, v in self.users.items() if k[0] != chat_id}
+        self.words = {k: v for k, v in self.words.items() if k[0] != chat_id}
+        self.stickers = {k: v for k, v in self.stickers.items() if k[0] != chat_id}
+        self.messages = [m for m in self.messages if m[0] != chat_id]
+
+    def block_chat(self, chat_id):
+        """Перестает принимать счетчики чата и выбрасывает уже накопленные"""
+        self.blocked_chats.add(chat_id)
+        self.discard_chat(chat_id)
+
+    def unblock_chat(self, chat_id):
+        self.blocked_chats.discard(chat_id)
+
+    def _take(self):
+        batch = (self.users, self.words, self.stickers, self.messages, self._oldest_pending)
+        self.users, self.words, self.stickers, self.messages = {}, {}, {}, []
+        self._oldest_pending = None
+        return batch
+
+    def _restore(self, users, words, stickers, messages, oldest):
+        # Возвращаем несброшенные дельты обратно, поверх накопленных за время сброса;
+        # дельты чатов, удаленных за время сброса, не возвращаются
+        blocked = self.blocked_chats
+        if blocked:
+            users = {k: v for k, v in users.items() if k[0] not in blocked}
+            words = {k: v for k, v in words.items() if k[0] not in blocked}
+            stickers = {k: v for k, v in stickers.items() if k[0] not in blocked}
+            messages = [m for m in messages if m[0] not in blocked]
+        for key, (name, delta) in users.items():
+            entry = self.users.setdefault(key, [name, 0])
+            entry[1] += delta
+        for key, delta in words.items():
+            self.words[key] = self.words.get(key, 0) + delta
+        for key, (file_id, delta) in stickers.items():
+            entry = self.stickers.setdefault(key, [file_id, 0])
+            entry[1] += delta
+        self.messages = messages + self.messages
+        if oldest is not None and (self._oldest_pending is None or oldest < self._oldest_pending):
+            self._oldest_pending = oldest
+
+    @staticmethod
+    def _rollup_rows(users, words, stickers):
+        """Дельты в строки часовых корзин: (chat_id, вид, ключ, подпись, дельта)"""
+        rows = [(k[0], "user", str(k[1]), name, delta) for k, (name, delta) in users.items()]
+        rows += [(k[0], "word", k[1], None, delta) for k, delta in words.items()]
+        rows += [(k[0], "sticker", k[1], file_id, delta) for k, (file_id, delta) in stickers.items()]
+        return rows
+
+    async def flush(self):
+        async with self._flush_lock:
+            self._wakeup.clear()
+            if not self.pending_keys():
+                return
+            users, words, stickers, messages, oldest = self._take()
+            started = time.monotonic()
+            totals = []  # (chat_id, вид, ключ, подпись, итоговый счетчик) для лидербордов
+            new_words = {}  # chat_id -> новые строки word_stats
+
+            try:
+                async with self.pool.acquire() as conn:
+                    async with conn.transaction():
+                        if users:
+                            keys = list(users)
+                            rows = await UPSERT_USERS.fetch(
+                                conn,
+                                [k[0] for k in keys], [k[1] for k in keys],
+                                [users[k][0] for k in keys], [users[k][1] for k in keys],
+                            )
+                            totals += [(r[0], "user", r[1], r[2], r[3]) for r in rows]
+                        if messages:
+                            await INSERT_MESSAGES.execute(conn, *map(list, zip(*messages)))
+                        exact_words = rollup_words = words
+                        if words and self.word_sketches is not None:
+                            exact_words, sketched, rollup_words = await self.word_sketches.apply(conn, words)
+                            totals += sketched
+                        if exact_words:
+                            keys = list(exact_words)
+                            rows = await UPSERT_WORDS.fetch(
+                                conn,
+                                [k[0] for k in keys], [k[1] for k in keys], [exact_words[k] for k in keys],
+                            )
+                            totals += [(r[0], "word", r[1], r[2], r[3]) for r in rows]
+                            for r in rows:
+                                if r[4]:
+                                    new_words[r[0]] = new_words.get(r[0], 0) + 1
+                        if stickers:
+                            keys = list(stickers)
+                            rows = await UPSERT_STICKERS.fetch(
+                                conn,
+                                [k[0] for k in keys], [k[1] for k in keys],
+                                [stickers[k][0] for k in keys], [stickers[k][1] for k in keys],
+                            )
+                            totals += [(r[0], "sticker", r[1], r[2], r[3]) for r in rows]
+                        rollup = self._rollup_rows(users, rollup_words, stickers)
+                        if rollup:
+                            await UPSERT_ROLLUP.execute(conn, *map(list, zip(*rollup)))
+                        changed = {k[0] for k in users} | {k[0] for k in words} | {k[0] for k in stickers}
+                        if changed:
+                            await BUMP_CHAT_VERSIONS.execute(conn, sorted(changed))
+            except Exception as e:
+                self.flush_errors += 1
+                self.consecutive_errors += 1
+                if self.word_sketches is not None:
+                    self.word_sketches.invalidate({k[0] for k in words})
+                if self.consecutive_errors >= self.max_failures:
+                    dropped = len(users) + len(words) + len(stickers) + len(messages)
+                    self.rows_dropped += dropped
+                    self.consecutive_errors = 0
+                    logger.error(
+                        "Буфер статистики не сбрасывается %d раз подряд, дельты выброшены: %s", self.max_failures, e,
+                        extra=fields(rows=dropped),
+                    )
+                    return
+                self._restore(users, words, stickers, messages, oldest)
+                logger.warning("Ошибка сброса буфера статистики: %s", e)
+                return
+
+            finished = time.monotonic()
+            self.flush_count += 1
+            self.consecutive_errors = 0
+            self.rows_flushed += len(users) + len(words) + len(stickers) + len(messages)
+            self.last_flush_at = time.time()
+            self.last_flush_duration = finished - started
+            self.last_flush_lag = finished - oldest if oldest is not None else 0.0
+            self.max_flush_lag = max(self.max_flush_lag, self.last_flush_lag)
+            self.flush_time.observe(self.last_flush_duration)
+            self.flush_lag.observe(self.last_flush_lag)
+
+            if self.word_sketches is not None and new_words:
+                self.word_sketches.note_new_words(new_words)
+
+            if self.leaderboards is not None:
+                try:
+                    await self.leaderboards.apply(totals)
+                except Exception as e:
+                    logger.warning("Ошибка обновления лидербордов: %s", e)
+
+            chat_ids = {k[0] for k in users} | {k[0] for k in words} | {k[0] for k in stickers}
+            for callback in self.on_flush:
+                try:
+                    callback(chat_ids)
+                except Exception:
+                    logger.exception("Ошибка обработчика сброса статистики")
+
+    async def run(self):
+        """Фоновый сброс по таймеру или при переполнении буфера"""
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            await self.flush()
+
+    def collect(self):
+        yield "stats_buffer_pending_keys", "gauge", "Несброшенные ключи в буфере статистики", [({}, self.pending_keys())]
+        yield "stats_buffer_flushes_total", "counter", "Сбросы буфера статистики", [({}, self.flush_count)]
+        yield "stats_buffer_flush_errors_total", "counter", "Ошибки сброса буфера статистики", [({}, self.flush_errors)]
+        yield "stats_buffer_rows_total", "counter", "Строки, записанные при сбросах", [({}, self.rows_flushed)]
+        yield "stats_buffer_dropped_rows_total", "counter", "Дельты, выброшенные после неудачных сбросов", [({}, self.rows_dropped)]
+        yield "stats_buffer_flush_seconds", "histogram", "Длительность сброса буфера", [({}, self.flush_time)]
+        yield "stats_buffer_flush_lag_seconds", "histogram", "Возраст самой старой дельты при сбросе", [({}, self.flush_lag)]
+
+    def metrics(self):
+        pending_age = time.monotonic() - self._oldest_pending if self._oldest_pending is not None else 0.0
+        return {
+            "pending_keys": self.pending_keys(),
+            "pending_age_seconds": round(pending_age, 3),
+            "flush_count": self.flush_count,
+            "flush_errors": self.flush_errors,
+            "rows_flushed": self.rows_flushed,
+            "rows_dropped": self.rows_dropped,
+            "consecutive_errors": self.consecutive_errors,
+            "last_flush_at": self.last_flush_at,
+            "last_flush_duration_seconds": round(self.last_flush_duration, 4),
+            "last_flush_lag_seconds": round(self.last_flush_lag, 3),
+            "max_flush_lag_seconds": round(self.max_flush_lag, 3),
+        }
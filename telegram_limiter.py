@@ -0,0 +1,146 @@
+import asyncio
+import os
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+
+from metrics import Histogram
+from rate_limit import PriorityTokenBucket, PRIORITY_BACKGROUND, PRIORITY_INTERACTIVE
+from log import get_logger, fields
+
+logger = get_logger(__name__)
+
+# Общий ограничитель всех запросов бота к Telegram (middleware сессии aiogram):
+# глобальное ведро на бота, ведро на каждый чат для отправки сообщений, повтор
+# после RetryAfter и приоритет интерактивных запросов над фоновыми.
+# Лимиты Telegram: около 30 сообщений в секунду и до 20 сообщений в минуту в группу.
+
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", 25))
+TELEGRAM_GLOBAL_BURST = float(os.getenv("TELEGRAM_GLOBAL_BURST", 25))
+TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", 20 / 60))
+TELEGRAM_CHAT_BURST = float(os.getenv("TELEGRAM_CHAT_BURST", 10))
+# Доля ведра, которую фоновые запросы оставляют интерактивным
+TELEGRAM_INTERACTIVE_RESERVE = float(os.getenv("TELEGRAM_INTERACTIVE_RESERVE", 0.2))
+TELEGRAM_MAX_RETRIES = int(os.getenv("TELEGRAM_MAX_RETRIES", 3))
+TELEGRAM_RETRY_JITTER = float(os.getenv("TELEGRAM_RETRY_JITTER", 1.0))
+TELEGRAM_LIMITER_MAX_CHATS = int(os.getenv("TELEGRAM_LIMITER_MAX_CHATS", 10000))
+
+# Приоритет запросов текущей задачи; фоновые задачи оборачиваются в background_requests()
+request_priority = ContextVar("telegram_request_priority", default=PRIORITY_INTERACTIVE)
+
+
+@contextmanager
+def background_requests():
+    token = request_priority.set(PRIORITY_BACKGROUND)
+    try:
+        yield
+    finally:
+        request_priority.reset(token)
+
+
+def _is_send(name):
+    return name.startswith("send") or name in ("copyMessage", "copyMessages", "forwardMessage", "forwardMessages")
+
+
+class TelegramLimiter(BaseRequestMiddleware):
+    def __init__(self, rate=TELEGRAM_GLOBAL_RATE, burst=TELEGRAM_GLOBAL_BURST, chat_rate=TELEGRAM_CHAT_RATE,
+                 chat_burst=TELEGRAM_CHAT_BURST, reserve=TELEGRAM_INTERACTIVE_RESERVE,
+                 max_retries=TELEGRAM_MAX_RETRIES, jitter=TELEGRAM_RETRY_JITTER, max_chats=TELEGRAM_LIMITER_MAX_CHATS):
+        self.bucket = PriorityTokenBucket(rate, burst, burst * reserve)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.reserve = reserve
+        self.max_retries = max_retries
+        self.jitter = jitter
+        self.max_chats = max_chats
+        self.chats = {}    # chat_id -> PriorityTokenBucket
+        self.methods = {}  # имя метода -> счетчики
+        self.latency = {}  # имя метода -> Histogram времени запроса
+
+    def _chat_bucket(self, chat_id):
+        bucket = self.chats.get(chat_id)
+        if bucket is None:
+            if len(self.chats) >= self.max_chats:
+                # Полные ведра без ожидающих ничего не помнят, их можно выбросить
+                self.chats = {k: v for k, v in self.chats.items() if not v.idle() or any(v.waiting.values())}
+            bucket = self.chats[chat_id] = PriorityTokenBucket(self.chat_rate, self.chat_burst, self.chat_burst * self.reserve)
+        return bucket
+
+    def _method_stats(self, name):
+        stats = self.methods.get(name)
+        if stats is None:
+            stats = self.methods[name] = {
+                "calls": 0, "errors": 0, "retries": 0, "delayed": 0,
+                "wait_seconds": 0.0, "max_wait_seconds": 0.0, "request_seconds": 0.0,
+            }
+        return stats
+
+    async def __call__(self, make_request, bot, method):
+        name = method.__api_method__
+        priority = request_priority.get()
+        stats = self._method_stats(name)
+        chat_id = getattr(method, "chat_id", None)
+        chat_bucket = self._chat_bucket(chat_id) if chat_id is not None and _is_send(name) else None
+        # Альбом Telegram считает отдельными сообщениями
+        cost = len(method.media) if name == "sendMediaGroup" else 1
+
+        for attempt in range(self.max_retries + 1):
+            waited = await self.bucket.acquire(1, priority)
+            if chat_bucket is not None:
+                waited += await chat_bucket.acquire(cost, priority)
+            if waited:
+                stats["delayed"] += 1
+                stats["wait_seconds"] += waited
+                stats["max_wait_seconds"] = max(stats["max_wait_seconds"], waited)
+
+            stats["calls"] += 1
+            started = time.perf_counter()
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                # Ведро уходит в минус на retry_after, так что следующая попытка (и все остальные
+                # запросы в этот чат) дождутся его сами; сверху добавляем случайную задержку
+                (chat_bucket or self.bucket).penalize(e.retry_after)
+                if attempt == self.max_retries:
+                    stats["errors"] += 1
+                    raise
+                stats["retries"] += 1
+                delay = random.uniform(0, self.jitter * (attempt + 1))
+                logger.warning("Flood control, повтор через %.1f с", e.retry_after + delay, extra=fields(method=name, chat_id=chat_id))
+            except Exception:
+                stats["errors"] += 1
+                raise
+            finally:
+                elapsed = time.perf_counter() - started
+                stats["request_seconds"] += elapsed
+                latency = self.latency.get(name)
+                if latency is None:
+                    latency = self.latency[name] = Histogram()
+                latency.observe(elapsed)
+            await asyncio.sleep(delay)
+
+    def collect(self):
+        methods = self.methods.items()
+        yield "telegram_requests_total", "counter", "Запросы к Bot API", [({"method": n}, s["calls"]) for n, s in methods]
+        yield "telegram_errors_total", "counter", "Ошибки Bot API", [({"method": n}, s["errors"]) for n, s in methods]
+        yield "telegram_retries_total", "counter", "Повторы после RetryAfter", [({"method": n}, s["retries"]) for n, s in methods]
+        yield ("telegram_limiter_wait_seconds_total", "counter", "Ожидание в ограничителе перед запросом",
+               [({"method": n}, s["wait_seconds"]) for n, s in methods])
+        yield ("telegram_request_seconds", "histogram", "Время запроса к Bot API",
+               [({"method": n}, h) for n, h in self.latency.items()])
+        yield ("telegram_limiter_waiting", "gauge", "Запросы, ожидающие глобальное ведро",
+               [({"priority": str(p)}, n) for p, n in self.bucket.waiting.items()])
+
+    def stats(self):
+        return {
+            "chat_buckets": len(self.chats),
+            "waiting": dict(self.bucket.waiting),
+            "methods": {
+                name: {k: round(v, 3) if isinstance(v, float) else v for k, v in stats.items()}
+                for name, stats in self.methods.items()
+            },
+        }
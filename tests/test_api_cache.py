@@ -0,0 +1,33 @@
+import asyncio
+
+import pytest
+
+from api_cache import ApiResponseCache
+
+
+def test_cancelled_build_releases_waiters():
+    async def scenario():
+        cache = ApiResponseCache(versions=None)
+        started = asyncio.Event()
+
+        async def slow_build():
+            started.set()
+            await asyncio.sleep(3600)
+
+        leader = asyncio.create_task(cache.get(1, slow_build, version=1))
+        await started.wait()
+        waiter = asyncio.create_task(cache.get(1, slow_build, version=1))
+        await asyncio.sleep(0)
+        assert cache.coalesced == 1
+
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await asyncio.wait_for(waiter, timeout=1)
+        assert cache._pending == {}
+
+        async def build():
+            return {"chat_id": 1}
+
+        assert await cache.get(1, build, version=1) == {"chat_id": 1}
+
+    asyncio.run(scenario())
@@ -0,0 +1,49 @@
+import asyncio
+import time
+
+import pytest
+
+import media_cache
+from media_cache import MediaCache
+
+
+def test_cancelled_leader_releases_waiters():
+    async def scenario():
+        cache = MediaCache(bot=None)
+        started = asyncio.Event()
+
+        async def slow_fetch():
+            started.set()
+            await asyncio.sleep(3600)
+
+        leader = asyncio.create_task(cache._single_flight("key", slow_fetch))
+        await started.wait()
+        waiter = asyncio.create_task(cache._single_flight("key", slow_fetch))
+        await asyncio.sleep(0)
+        assert cache.coalesced == 1
+
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await asyncio.wait_for(waiter, timeout=1)
+        assert cache._pending == {}
+
+        async def fetch():
+            return b"data"
+
+        # Следующий запрос идет заново, а не к отмененному future
+        assert await cache._single_flight("key", fetch) == b"data"
+
+    asyncio.run(scenario())
+
+
+def test_remember_prunes_expired_before_evicting(monkeypatch):
+    monkeypatch.setattr(media_cache, "MEDIA_CACHE_MAX_LOOKUPS", 2)
+    cache = MediaCache(bot=None)
+    now = time.monotonic()
+    cache._remember(cache.file_paths, "fresh", ("a", now + 60))
+    cache._remember(cache.profile_photos, 1, ([], now - 1))
+    cache._remember(cache.file_paths, "expired", ("b", now - 1))
+    cache._remember(cache.file_paths, "new", ("c", now + 60))
+
+    assert list(cache.file_paths) == ["fresh", "new"]
+    assert cache.profile_photos == {}
@@ -0,0 +1,39 @@
+import re
+
+import pytest
+
+from text_analysis import STOP_WORDS, Lemmatizer
+
+pymorphy3 = pytest.importorskip("pymorphy3")
+
+
+def baseline_clean_and_split_text(morph, text):
+    """Разбор текста как в исходном clean_and_split_text из bot.py"""
+    words = []
+    for w in re.sub(r'[^\w\s]', '', text.lower()).split():
+        if len(w) > 2:
+            normalized = morph.parse(w)[0].normal_form.lower()
+            if normalized not in STOP_WORDS:
+                words.append(normalized)
+    return words
+
+
+@pytest.fixture(scope="module")
+def morph():
+    return pymorphy3.MorphAnalyzer()
+
+
+def test_lemmas_of_inflected_stop_words_are_kept(morph):
+    lemmatizer = Lemmatizer(morph=morph)
+    words = lemmatizer.analyze("большой маленький мочь стать должный нибыть")
+    assert words == ["большой", "маленький", "мочь", "стать", "должный", "нибыть"]
+
+
+def test_matches_baseline_top_words(morph):
+    lemmatizer = Lemmatizer(morph=morph)
+    text = (
+        "Большой дом стал ещё больше, а маленький кот может спать. "
+        "Должен ли он? Большие планы, маленькие шаги, стать лучше, мочь всё!"
+    )
+    assert lemmatizer.analyze(text) == baseline_clean_and_split_text(morph, text)
+    assert lemmatizer.analyze_many([text, text]) == [baseline_clean_and_split_text(morph, text)] * 2
@@ -0,0 +1,286 @@
+import asyncio
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from metrics import Histogram
+from log import get_logger
+
+try:
+    from pymorphy3 import MorphAnalyzer
+except ImportError:
+    MorphAnalyzer = None
+
+logger = get_logger(__name__)
+
+# Лемматизация слов из сообщений с LRU-кэшем: словарь чата очень повторяется,
+# поэтому полный разбор pymorphy3 нужен только для новых токенов.
+
+LEMMA_CACHE_SIZE = int(os.getenv("LEMMA_CACHE_SIZE", 200000))
+
+# inline - в цикле событий, thread - пул потоков, process - пул процессов
+TEXT_ANALYSIS_MODE = os.getenv("TEXT_ANALYSIS_MODE", "thread")
+TEXT_ANALYSIS_WORKERS = int(os.getenv("TEXT_ANALYSIS_WORKERS", 2))
+TEXT_ANALYSIS_QUEUE_SIZE = int(os.getenv("TEXT_ANALYSIS_QUEUE_SIZE", 1000))
+TEXT_ANALYSIS_BATCH_SIZE = int(os.getenv("TEXT_ANALYSIS_BATCH_SIZE", 32))
+TEXT_ANALYSIS_TIMEOUT = float(os.getenv("TEXT_ANALYSIS_TIMEOUT", 10))
+MIN_WORD_LENGTH = 3
+
+PUNCTUATION_RE = re.compile(r'[^\w\s]')
+
+STOP_WORDS = {
+    "и", "в", "не", "на", "я", "что", "с", "а", "то", "как", "у", "все", "но", "по", "он", "она", 
+    "так", "же", "от", "о", "ты", "за", "да", "из", "к", "мы", "бы", "вы", "ну", "ли", "ни", "много", 
+    "это", "этот", "эта", "эти", "этот", "эту", "этим", "этого", "этой", "этих", "этими", "этом",
+    "он", "она", "оно", "они", "его", "её", "их", "ему", "ей", "им", "его", "её", "их", "ним", "ней", "ними",
+    "мой", "моя", "моё", "мои", "твой", "твоя", "твоё", "твои", "наш", "наша", "наше", "наши", "ваш", "ваша", "ваше", "ваши",
+    "себя", "себе", "собой", "собою",
+    "кто", "что", "какой", "какая", "какое", "какие", "чей", "чья", "чьё", "чьи", "который", "которая", "которое", "которые",
+    "где", "куда", "откуда", "когда", "почему", "зачем", "как", "сколько", "чей",
+    "быть", "был", "была", "было", "были", "будет", "будут", "буду", "будешь", "будем", "будете",
+    "есть", "есть", "суть",
+    "весь", "вся", "всё", "все", "всего", "всей", "всем", "всеми", "всём",
+    "сам", "сама", "само", "сами", "самого", "самой", "самому", "самим", "самими", "самом", "самой",
+    "уже", "ещё", "тоже", "только", "лишь", "просто", "даже", "вот", "вон", "тут", "там", "здесь", "туда", "сюда",
+    "очень", "совсем", "почти", "чуть", "немного", "много", "мало", "больше", "меньше",
+    "или", "либо", "ни", "нибудь", "либо", "ли", "же", "ведь", "хотя", "если", "когда", "пока", "чтобы", "чтоб",
+    "без", "для", "до", "из", "к", "на", "над", "о", "об", "от", "перед", "по", "под", "при", "про", "с", "со", "у", "через",
+    "можно", "нужно", "надо", "должен", "должна", "должно", "должны", "может", "может", "может", "могут",
+    "будет", "будет", "будет", "будут", "стал", "стала", "стало", "стали", "станет", "станут"
+}
+
+
+class Lemmatizer:
+    def __init__(self, cache_size=LEMMA_CACHE_SIZE, morph=None):
+        if morph is None and MorphAnalyzer is not None:
+            morph = MorphAnalyzer()
+        self.morph = morph
+        self.cache_size = cache_size
+        self.cache = OrderedDict()  # токен -> лемма или None для стоп-слов
+        # В режиме thread кэш общий для потоков пула; разбор pymorphy3 идет вне блокировки
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.parse_time = 0.0
+        # Лемма сверяется с исходным списком как раньше; леммы словоформ из списка
+        # (больше -> большой, может -> мочь) не добавляются, иначе из топа пропадут обычные слова
+        self.stop_lemmas = frozenset(STOP_WORDS)
+
+    def lemma(self, token):
+        """Нормальная форма слова без кэша; без pymorphy3 просто нижний регистр"""
+        if self.morph is None:
+            return token.lower()
+        try:
+            return self.morph.parse(token)[0].normal_form.lower()
+        except Exception:
+            return token.lower()
+
+    def normalize(self, token):
+        """Лемма токена через кэш или None, если это стоп-слово"""
+        cache = self.cache
+        with self._lock:
+            if token in cache:
+                self.hits += 1
+                cache.move_to_end(token)
+                return cache[token]
+            self.misses += 1
+
+        started = time.perf_counter()
+        lemma = self.lemma(token)
+        elapsed = time.perf_counter() - started
+        result = None if lemma in self.stop_lemmas else lemma
+
+        with self._lock:
+            self.parse_time += elapsed
+            cache[token] = result
+            if len(cache) > self.cache_size:
+                cache.popitem(last=False)
+        return result
+
+    def analyze(self, text):
+        """Список лемм одного сообщения без стоп-слов"""
+        normalize = self.normalize
+        return [lemma for lemma in map(normalize, tokenize(text)) if lemma is not None]
+
+    def analyze_many(self, texts):
+        """Пакетная обработка: каждый уникальный токен разбирается один раз на весь пакет"""
+        tokenized = [tokenize(text) for text in texts]
+        resolved = {}
+        for tokens in tokenized:
+            for token in tokens:
+                if token not in resolved:
+                    resolved[token] = self.normalize(token)
+        return [[resolved[t] for t in tokens if resolved[t] is not None] for tokens in tokenized]
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "backend": "pymorphy3" if self.morph is not None else "lowercase",
+            "cache_size": len(self.cache),
+            "cache_limit": self.cache_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            "parse_seconds": round(self.parse_time, 4),
+        }
+
+
+def tokenize(text):
+    if not text:
+        return []
+    text = PUNCTUATION_RE.sub('', text.lower())
+    return [w for w in text.split() if len(w) >= MIN_WORD_LENGTH]
+
+
+lemmatizer = Lemmatizer()
+
+
+def normalize_word(word):
+    return lemmatizer.lemma(word)
+
+
+def clean_and_split_text(text):
+    return lemmatizer.analyze(text)
+
+
+def clean_and_split_texts(texts):
+    return lemmatizer.analyze_many(texts)
+
+
+def _analyze_in_worker(texts):
+    """Разбор в процессе-воркере: вместе с результатом возвращает обращения к его кэшу лемм"""
+    hits, misses = lemmatizer.hits, lemmatizer.misses
+    results = lemmatizer.analyze_many(texts)
+    return results, lemmatizer.hits - hits, lemmatizer.misses - misses
+
+
+def _init_worker():
+    # Прогреваем словари pymorphy3 в процессе-воркере до первого сообщения
+    lemmatizer.lemma("привет")
+
+
+class TextAnalysisService:
+    """Вынос разбора текста из цикла событий с ограниченной очередью"""
+
+    def __init__(self, mode=TEXT_ANALYSIS_MODE, workers=TEXT_ANALYSIS_WORKERS,
+                 queue_size=TEXT_ANALYSIS_QUEUE_SIZE, batch_size=TEXT_ANALYSIS_BATCH_SIZE,
+                 timeout=TEXT_ANALYSIS_TIMEOUT):
+        if mode not in ("inline", "thread", "process"):
+            raise ValueError(f"Неизвестный режим анализа текста: {mode}")
+        self.mode = mode
+        self.workers = workers
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.executor = None
+        self._consumers = []
+
+        self.dropped = 0
+        # В режиме process у каждого воркера свой кэш лемм: обращения к ним суммируются здесь,
+        # а размер этих кэшей в stats() лемматизатора основного процесса не виден
+        self.worker_hits = 0
+        self.worker_misses = 0
+        self.stage_latency = {
+            "queue_wait": Histogram(),
+            "analyze": Histogram(),
+            "total": Histogram(),
+        }
+
+    def start(self):
+        if self.mode == "thread":
+            self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="text-analysis")
+        elif self.mode == "process":
+            self.executor = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker)
+        if self.executor:
+            self._consumers = [asyncio.create_task(self._consume()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._consumers:
+            task.cancel()
+        await asyncio.gather(*self._consumers, return_exceptions=True)
+        self._consumers = []
+        while not self.queue.empty():
+            _, future, _ = self.queue.get_nowait()
+            if not future.done():
+                future.set_result([])
+        if self.executor:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+    async def analyze(self, text):
+        started = time.perf_counter()
+        if not self.executor:
+            words = lemmatizer.analyze(text)
+            elapsed = time.perf_counter() - started
+            self.stage_latency["analyze"].observe(elapsed)
+            self.stage_latency["total"].observe(elapsed)
+            return words
+
+        future = asyncio.get_running_loop().create_future()
+        item = (text, future, started)
+        try:
+            self.queue.put_nowait(item)
+        except asyncio.QueueFull:
+            # Очередь переполнена: ждем места, но не дольше таймаута
+            try:
+                await asyncio.wait_for(self.queue.put(item), timeout=self.timeout)
+            except asyncio.TimeoutError:
+                self.dropped += 1
+                return []
+
+        words = await future
+        self.stage_latency["total"].observe(time.perf_counter() - started)
+        return words
+
+    async def _consume(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            while len(batch) < self.batch_size and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+
+            dequeued = time.perf_counter()
+            for _, _, enqueued in batch:
+                self.stage_latency["queue_wait"].observe(dequeued - enqueued)
+
+            try:
+                texts = [t for t, _, _ in batch]
+                if self.mode == "process":
+                    results, hits, misses = await loop.run_in_executor(self.executor, _analyze_in_worker, texts)
+                    self.worker_hits += hits
+                    self.worker_misses += misses
+                else:
+                    results = await loop.run_in_executor(self.executor, clean_and_split_texts, texts)
+            except Exception as e:
+                logger.warning("Ошибка анализа текста: %s", e)
+                results = [[] for _ in batch]
+            self.stage_latency["analyze"].observe(time.perf_counter() - dequeued)
+
+            for (_, future, _), words in zip(batch, results):
+                if not future.done():
+                    future.set_result(words)
+
+    def collect(self):
+        yield ("text_analysis_seconds", "histogram", "Этапы разбора текста",
+               [({"stage": n}, h) for n, h in self.stage_latency.items()])
+        yield "text_analysis_dropped_total", "counter", "Сообщения, не разобранные из-за переполнения очереди", [({}, self.dropped)]
+        yield "text_analysis_queue_depth", "gauge", "Сообщений в очереди разбора", [({}, self.queue.qsize())]
+        yield "lemma_cache_lookups_total", "counter", "Обращения к кэшу лемм", [
+            ({"result": "hit"}, lemmatizer.hits + self.worker_hits),
+            ({"result": "miss"}, lemmatizer.misses + self.worker_misses),
+        ]
+
+    def stats(self):
+        return {
+            "mode": self.mode,
+            "workers": self.workers,
+            "queue_depth": self.queue.qsize(),
+            "queue_limit": self.queue.maxsize,
+            "dropped": self.dropped,
+            "worker_cache_hits": self.worker_hits,
+            "worker_cache_misses": self.worker_misses,
+            "stage_latency": {name: h.snapshot() for name, h in self.stage_latency.items()},
+        }
@@ -0,0 +1,241 @@
+import asyncio
+import os
+import time
+from datetime import datetime, timedelta, timezone
+
+from aiogram.enums import ChatMemberStatus
+from aiogram.exceptions import TelegramBadRequest
+
+from metrics import Histogram
+from rate_limit import TokenBucket
+from telegram_limiter import background_requests
+from log import get_logger, fields
+
+logger = get_logger(__name__)
+
+# Титул "Самый активный" для лидера чата по сообщениям. Запоминаем, кому титул уже
+# выдан, и обращаемся к Telegram только когда лидер сменился. get_me и права бота в
+# чате кэшируются, права обновляются из апдейтов my_chat_member. Если апдейты принимает
+# другой процесс (track_activity), чаты с новыми сообщениями берутся из message_stats.
+
+TITLE_TEXT = "Самый активный"
+TITLE_MIN_MESSAGES = int(os.getenv("TITLE_MIN_MESSAGES", 10))
+TITLE_INTERVAL = float(os.getenv("TITLE_INTERVAL", 3600))
+TITLE_CONCURRENCY = int(os.getenv("TITLE_CONCURRENCY", 4))
+TITLE_API_RATE = float(os.getenv("TITLE_API_RATE", 2))
+TITLE_API_BURST = float(os.getenv("TITLE_API_BURST", 5))
+TITLE_RIGHTS_TTL = float(os.getenv("TITLE_RIGHTS_TTL", 6 * 3600))
+
+TITLE_SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS chat_titles (chat_id BIGINT PRIMARY KEY, user_id BIGINT, titled_at TIMESTAMP)''',
+]
+
+
+class TitleReconciler:
+    def __init__(self, bot, pool, leaderboards, interval=TITLE_INTERVAL, concurrency=TITLE_CONCURRENCY,
+                 rate=TITLE_API_RATE, burst=TITLE_API_BURST, rights_ttl=TITLE_RIGHTS_TTL, track_activity=False):
+        self.bot = bot
+        self.pool = pool
+        self.leaderboards = leaderboards
+        self.interval = interval
+        self.concurrency = concurrency
+        self.bucket = TokenBucket(rate, burst)
+        self.rights_ttl = rights_ttl
+        self.track_activity = track_activity
+        self.activity_since = None
+
+        self.bot_id = None
+        self.rights = {}    # chat_id -> (может ли бот назначать админов, истекает)
+        self.titled = {}    # chat_id -> user_id, которому выдан титул, или None, если титула нет
+        self.dirty = set()  # чаты с новыми сообщениями с прошлого прохода
+        self._locks = {}
+
+        self.checks = 0
+        self.unchanged = 0
+        self.titles_set = 0
+        self.errors = 0
+        self.api_calls = 0
+        self.last_pass_duration = 0.0
+        self.pass_time = Histogram((0.1, 0.5, 1, 5, 15, 60, 300, 900))
+        self.pass_lag = Histogram((0.01, 0.1, 1, 5, 15, 60, 300))
+
+    async def load(self):
+        async with self.pool.acquire() as conn:
+            rows = await conn.fetch('SELECT chat_id, user_id FROM chat_titles')
+        self.titled = {r['chat_id']: r['user_id'] for r in rows}
+
+    async def _titled_user(self, chat_id):
+        """Кому выдан титул в чате; вне ведущего процесса load не вызывается,
+        поэтому строка чата читается из базы при первой проверке"""
+        if chat_id not in self.titled:
+            async with self.pool.acquire() as conn:
+                self.titled[chat_id] = await conn.fetchval('SELECT user_id FROM chat_titles WHERE chat_id = $1', chat_id)
+        return self.titled[chat_id]
+
+    def mark_dirty(self, chat_ids):
+        self.dirty |= set(chat_ids)
+
+    async def _load_activity(self):
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        since, self.activity_since = self.activity_since or now - timedelta(seconds=self.interval), now
+        async with self.pool.acquire() as conn:
+            rows = await conn.fetch('SELECT DISTINCT chat_id FROM message_stats WHERE created_at >= $1', since)
+        self.mark_dirty(r['chat_id'] for r in rows)
+
+    def forget(self, chat_id):
+        self.titled.pop(chat_id, None)
+        self.rights.pop(chat_id, None)
+        self.dirty.discard(chat_id)
+        self._locks.pop(chat_id, None)
+
+    async def _call(self, method, *args, **kwargs):
+        await self.bucket.acquire()
+        self.api_calls += 1
+        return await method(*args, **kwargs)
+
+    # --- права бота ---
+
+    async def _get_bot_id(self):
+        if self.bot_id is None:
+            self.bot_id = (await self._call(self.bot.get_me)).id
+        return self.bot_id
+
+    def on_bot_member(self, event):
+        """Права бота из апдейта my_chat_member, без запроса к API"""
+        member = event.new_chat_member
+        can_promote = member.status == ChatMemberStatus.ADMINISTRATOR and bool(getattr(member, "can_promote_members", False))
+        self.rights[event.chat.id] = (can_promote, time.monotonic() + self.rights_ttl)
+        if can_promote:
+            self.dirty.add(event.chat.id)
+
+    async def _can_promote(self, chat_id):
+        cached = self.rights.get(chat_id)
+        if cached and cached[1] > time.monotonic():
+            return cached[0]
+        bot_member = await self._call(self.bot.get_chat_member, chat_id, await self._get_bot_id())
+        can_promote = bot_member.status == ChatMemberStatus.ADMINISTRATOR and bool(bot_member.can_promote_members)
+        self.rights[chat_id] = (can_promote, time.monotonic() + self.rights_ttl)
+        return can_promote
+
+    # --- выдача титула ---
+
+    async def reconcile(self, chat_id):
+        lock = self._locks.setdefault(chat_id, asyncio.Lock())
+        try:
+            async with lock:
+                await self._reconcile(chat_id)
+        except Exception as e:
+            self.errors += 1
+            logger.warning("Ошибка обновления титула: %s", e, extra=fields(chat_id=chat_id))
+
+    async def _reconcile(self, chat_id):
+        self.checks += 1
+        top = await self.leaderboards.top(chat_id, "user", 1)
+        if not top or top[0][2] < TITLE_MIN_MESSAGES:
+            return
+        user_id = int(top[0][0])
+        if await self._titled_user(chat_id) == user_id:
+            self.unchanged += 1
+            return
+
+        if not await self._can_promote(chat_id):
+            return
+
+        logger.info("Новый лидер чата", extra=fields(chat_id=chat_id, user_id=user_id, messages=top[0][2]))
+        user_member = await self._call(self.bot.get_chat_member, chat_id, user_id)
+
+        if user_member.status == ChatMemberStatus.MEMBER:
+            try:
+                await self._call(
+                    self.bot.promote_chat_member,
+                    chat_id=chat_id,
+                    user_id=user_id,
+                    can_manage_chat=False,
+                    can_delete_messages=False,
+                    can_manage_video_chats=False,
+                    can_restrict_members=False,
+                    can_promote_members=False,
+                    can_change_info=False,
+                    can_invite_users=False,
+                    can_post_messages=False,
+                    can_edit_messages=False,
+                    can_pin_messages=False,
+                    can_manage_topics=False
+                )
+                await asyncio.sleep(1)
+            except TelegramBadRequest as e:
+                if "user is already" not in str(e).lower():
+                    self._note_rights_error(chat_id, e)
+                    raise
+        elif user_member.status != ChatMemberStatus.ADMINISTRATOR:
+            logger.warning("Статус пользователя не поддерживается: %s", user_member.status, extra=fields(chat_id=chat_id, user_id=user_id))
+            return
+
+        try:
+            await self._call(self.bot.set_chat_administrator_custom_title, chat_id, user_id, TITLE_TEXT)
+        except TelegramBadRequest as e:
+            self._note_rights_error(chat_id, e)
+            raise
+
+        self.titled[chat_id] = user_id
+        self.titles_set += 1
+        async with self.pool.acquire() as conn:
+            await conn.execute('''
+                INSERT INTO chat_titles (chat_id, user_id, titled_at) VALUES ($1, $2, now() AT TIME ZONE 'utc')
+                ON CONFLICT (chat_id) DO UPDATE SET user_id = $2, titled_at = EXCLUDED.titled_at
+            ''', chat_id, user_id)
+        logger.info("Установлен титул '%s'", TITLE_TEXT, extra=fields(chat_id=chat_id, user_id=user_id))
+
+    def _note_rights_error(self, chat_id, error):
+        if "not enough rights" in str(error).lower():
+            self.rights[chat_id] = (False, time.monotonic() + self.rights_ttl)
+
+    # --- фоновый проход ---
+
+    async def reconcile_dirty(self):
+        started = time.monotonic()
+        chat_ids, self.dirty = self.dirty, set()
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def worker(chat_id):
+            async with semaphore:
+                await self.reconcile(chat_id)
+
+        await asyncio.gather(*(worker(chat_id) for chat_id in chat_ids))
+        self.last_pass_duration = time.monotonic() - started
+        self.pass_time.observe(self.last_pass_duration)
+
+    async def run(self):
+        await self.load()
+        while True:
+            due = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            self.pass_lag.observe(max(0.0, time.monotonic() - due))
+            try:
+                if self.track_activity:
+                    await self._load_activity()
+                with background_requests():
+                    await self.reconcile_dirty()
+            except Exception as e:
+                logger.warning("Ошибка в проходе по титулам: %s", e)
+
+    def collect(self):
+        yield "title_checks_total", "counter", "Проверки лидера чата", [({}, self.checks)]
+        yield "titles_set_total", "counter", "Выданные титулы", [({}, self.titles_set)]
+        yield "title_errors_total", "counter", "Ошибки выдачи титулов", [({}, self.errors)]
+        yield "title_api_calls_total", "counter", "Запросы к Bot API при выдаче титулов", [({}, self.api_calls)]
+        yield "title_dirty_chats", "gauge", "Чаты, ожидающие проверки лидера", [({}, len(self.dirty))]
+        yield "title_pass_seconds", "histogram", "Длительность прохода по титулам", [({}, self.pass_time)]
+        yield "title_pass_lag_seconds", "histogram", "Опоздание начала прохода по титулам", [({}, self.pass_lag)]
+
+    def stats(self):
+        return {
+            "titled_chats": sum(1 for user_id in self.titled.values() if user_id is not None),
+            "dirty_chats": len(self.dirty),
+            "checks": self.checks,
+            "unchanged": self.unchanged,
+            "titles_set": self.titles_set,
+            "errors": self.errors,
+            "api_calls": self.api_calls,
+            "last_pass_duration_seconds": round(self.last_pass_duration, 3),
+        }
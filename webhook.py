@@ -0,0 +1,140 @@
+import asyncio
+import hashlib
+import hmac
+import os
+import time
+
+from aiogram import types
+from pydantic import ValidationError
+
+from metrics import Histogram
+from log import get_logger, fields
+
+logger = get_logger(__name__)
+
+# Режим webhook: Telegram присылает апдейты POST-запросами на маршрут FastAPI,
+# маршрут проверяет секрет и сразу отвечает 200, а апдейты из ограниченной очереди
+# разбирают несколько обработчиков через dp.feed_update.
+#
+# Проверить локально можно записанным апдейтом:
+#   curl -X POST http://localhost:8000/telegram/webhook \
+#        -H "X-Telegram-Bot-Api-Secret-Token: $WEBHOOK_SECRET" \
+#        -H "Content-Type: application/json" -d @update.json
+
+BOT_MODE = os.getenv("BOT_MODE", "polling")  # polling | webhook
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # публичный адрес сервера, например https://example.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", 1000))
+WEBHOOK_CONSUMERS = int(os.getenv("WEBHOOK_CONSUMERS", 8))
+WEBHOOK_DRAIN_TIMEOUT = float(os.getenv("WEBHOOK_DRAIN_TIMEOUT", 10))
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", 40))
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+def webhook_secret(bot_token):
+    """Секрет из WEBHOOK_SECRET или производный от токена, одинаковый во всех воркерах"""
+    if WEBHOOK_SECRET:
+        return WEBHOOK_SECRET
+    return hashlib.sha256(f"webhook:{bot_token}".encode()).hexdigest()
+
+
+class WebhookReceiver:
+    def __init__(self, bot, dp, secret, queue_size=WEBHOOK_QUEUE_SIZE, consumers=WEBHOOK_CONSUMERS):
+        self.bot = bot
+        self.dp = dp
+        self.secret = secret
+        self.consumers = consumers
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self._tasks = []
+
+        self.received = 0
+        self.processed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.unauthorized = 0
+        self.malformed = 0
+        self.queue_wait = Histogram()
+        self.handle_time = Histogram()
+
+    async def setup(self, url, allowed_updates):
+        await self.bot.set_webhook(
+            url=url,
+            secret_token=self.secret,
+            allowed_updates=allowed_updates,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+        )
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._consume()) for _ in range(self.consumers)]
+
+    async def stop(self):
+        """Дорабатывает уже принятые апдейты и останавливает обработчики"""
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout=WEBHOOK_DRAIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning("Не обработано апдейтов webhook при остановке: %d", self.queue.qsize())
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def check_secret(self, header_value):
+        return hmac.compare_digest(header_value or "", self.secret)
+
+    def accept(self, body):
+        """Кладет апдейт в очередь; False, если очередь переполнена (Telegram повторит доставку).
+        Неразбираемый апдейт отбрасывается: повторная доставка его не исправит"""
+        try:
+            update = types.Update.model_validate_json(body, context={"bot": self.bot})
+        except ValidationError as e:
+            self.malformed += 1
+            logger.warning("Неразбираемый апдейт webhook: %s", e.errors(include_url=False, include_input=False)[:3])
+            return True
+        try:
+            self.queue.put_nowait((time.perf_counter(), update))
+        except asyncio.QueueFull:
+            self.rejected += 1
+            return False
+        self.received += 1
+        return True
+
+    async def _consume(self):
+        while True:
+            queued_at, update = await self.queue.get()
+            started = time.perf_counter()
+            self.queue_wait.observe(started - queued_at)
+            try:
+                await self.dp.feed_update(self.bot, update)
+                self.processed += 1
+            except Exception:
+                self.failed += 1
+                logger.exception("Ошибка обработки апдейта", extra=fields(update_id=update.update_id))
+            finally:
+                self.handle_time.observe(time.perf_counter() - started)
+                self.queue.task_done()
+
+    def collect(self):
+        yield "webhook_updates_total", "counter", "Апдейты webhook по результату", [
+            ({"result": "processed"}, self.processed), ({"result": "failed"}, self.failed),
+            ({"result": "rejected"}, self.rejected), ({"result": "unauthorized"}, self.unauthorized),
+            ({"result": "malformed"}, self.malformed),
+        ]
+        yield "webhook_queue_depth", "gauge", "Апдейтов в очереди webhook", [({}, self.queue.qsize())]
+        yield "webhook_queue_wait_seconds", "histogram", "Ожидание апдейта в очереди", [({}, self.queue_wait)]
+        yield "webhook_handle_seconds", "histogram", "Обработка апдейта из очереди", [({}, self.handle_time)]
+
+    def stats(self):
+        return {
+            "queue_depth": self.queue.qsize(),
+            "queue_limit": self.queue.maxsize,
+            "consumers": self.consumers,
+            "received": self.received,
+            "processed": self.processed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "unauthorized": self.unauthorized,
+            "malformed": self.malformed,
+            "queue_wait": self.queue_wait.snapshot(),
+            "handle_time": self.handle_time.snapshot(),
+        }
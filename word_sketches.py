@@ -0,0 +1,522 @@
+import argparse
+import asyncio
+import heapq
+import math
+import os
+import struct
+import sys
+import time
+import zlib
+from collections import Counter, OrderedDict
+
+from db import Query
+from leader import lock_key
+from log import get_logger, fields
+
+logger = get_logger(__name__)
+
+# Приближенный подсчет слов для больших чатов. В word_stats каждая лемма чата живет
+# отдельной строкой навсегда, и длинный хвост опечаток, имен и разовых слов раздувает
+# таблицу, индекс и каждый UPSERT, хотя отчеты показывают только топ-3 и топ-10.
+# Чат, словарь которого перерос WORD_SKETCH_PROMOTE_AT, переводится на Space-Saving:
+# не больше capacity = ceil(1 / epsilon) счетчиков, сжатых в одну строку word_sketches,
+# а его строки word_stats удаляются. Оценка слова завышена не больше чем на
+# epsilon * (всего слов чата), и любое слово чаще этой границы гарантированно в сводке.
+# Маленькие чаты считаются точно, как раньше. В корзины stats_rollup переведенные чаты
+# пишут только слова из первых WORD_SKETCH_ROLLUP_WORDS своей сводки: суточные корзины
+# живут больше года, и хвост словаря не должен попадать в них каждый день. Топ слов
+# за период у таких чатов - приближенный: слово вне общего топа чата в него не попадет.
+#
+#   python word_sketches.py compare CHAT_ID           # сводка против точного подсчета по message_stats
+#   python word_sketches.py compare --synthetic 200000
+#   python word_sketches.py promote CHAT_ID           # перевести чат вручную
+
+WORD_SKETCH_PROMOTE_AT = int(os.getenv("WORD_SKETCH_PROMOTE_AT", 50000))  # 0 - всегда точный подсчет
+WORD_SKETCH_EPSILON = float(os.getenv("WORD_SKETCH_EPSILON", 0.0005))
+WORD_SKETCH_CACHE_CHATS = int(os.getenv("WORD_SKETCH_CACHE_CHATS", 1000))
+WORD_SKETCH_ROLLUP_WORDS = int(os.getenv("WORD_SKETCH_ROLLUP_WORDS", 100))
+WORD_VOCABULARY_MAX_CHATS = 50000
+
+WORD_SKETCH_SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS word_sketches (chat_id BIGINT PRIMARY KEY, capacity INTEGER NOT NULL, total BIGINT NOT NULL, version BIGINT NOT NULL DEFAULT 0, data BYTEA NOT NULL, promoted_at TIMESTAMP DEFAULT (now() AT TIME ZONE 'utc'), updated_at TIMESTAMP)''',
+]
+
+# Сброс счетчиков берет блокировку совместно, перевод чата - монопольно: сброс
+# не может записать в word_stats слова чата, который переводится в этот момент
+WORDS_LOCK = lock_key("word_sketches")
+
+LOCK_SKETCHES = Query(
+    "word_sketches_lock", 'SELECT chat_id, version FROM word_sketches WHERE chat_id = ANY($1::bigint[]) FOR UPDATE',
+)
+LOAD_SKETCHES = Query(
+    "word_sketches_load", 'SELECT chat_id, version, data FROM word_sketches WHERE chat_id = ANY($1::bigint[])',
+)
+SAVE_SKETCHES = Query("word_sketches_save", '''
+    UPDATE word_sketches w SET data = x.data, total = x.total, version = w.version + 1, updated_at = now() AT TIME ZONE 'utc'
+    FROM unnest($1::bigint[], $2::bytea[], $3::bigint[]) AS x(c, data, total) WHERE w.chat_id = x.c
+''')
+
+FORMAT_VERSION = 1
+_HEADER = struct.Struct(">BIQ")  # версия формата, capacity, total
+
+
+def _write_varint(out, value):
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _read_varint(data, pos):
+    result = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+
+class SpaceSaving:
+    """Space-Saving (Metwally и др.): capacity счетчиков [оценка, ошибка]. Новое слово при
+    полной сводке вытесняет минимальный счетчик и наследует его значение как ошибку, поэтому
+    оценка - верхняя граница, а оценка минус ошибка - нижняя"""
+
+    def __init__(self, capacity, total=0):
+        self.capacity = capacity
+        self.total = total
+        self.counters = {}  # слово -> [оценка, ошибка]
+        self._heap = []     # (оценка, слово); устаревшие записи пропускаются при извлечении
+
+    @classmethod
+    def for_epsilon(cls, epsilon):
+        return cls(max(1, math.ceil(1 / epsilon)))
+
+    @classmethod
+    def from_counts(cls, capacity, counts):
+        """Сводка из точных счетчиков: самые частые слова переносятся без ошибки, остальные
+        учитываются только в total (каждое из них не чаще минимального счетчика)"""
+        sketch = cls(capacity)
+        ranked = sorted(counts, key=lambda item: item[1], reverse=True)
+        sketch.total = sum(count for _, count in ranked)
+        sketch.counters = {word: [count, 0] for word, count in ranked[:capacity]}
+        sketch._rebuild_heap()
+        return sketch
+
+    def _rebuild_heap(self):
+        self._heap = [(entry[0], word) for word, entry in self.counters.items()]
+        heapq.heapify(self._heap)
+
+    def _min_entry(self):
+        while self._heap:
+            count, word = self._heap[0]
+            entry = self.counters.get(word)
+            if entry is not None and entry[0] == count:
+                return count, word
+            heapq.heappop(self._heap)
+        return 0, None
+
+    def offer(self, word, weight=1):
+        """Добавляет weight вхождений слова и возвращает его новую оценку"""
+        self.total += weight
+        entry = self.counters.get(word)
+        if entry is not None:
+            entry[0] += weight
+        elif len(self.counters) < self.capacity:
+            entry = self.counters[word] = [weight, 0]
+        else:
+            floor, victim = self._min_entry()
+            heapq.heappop(self._heap)
+            del self.counters[victim]
+            entry = self.counters[word] = [floor + weight, floor]
+        heapq.heappush(self._heap, (entry[0], word))
+        if len(self._heap) > 4 * self.capacity:
+            self._rebuild_heap()
+        return entry[0]
+
+    def max_error(self):
+        """Наибольшее завышение оценки сейчас: минимальный счетчик полной сводки"""
+        if len(self.counters) < self.capacity:
+            return 0
+        return self._min_entry()[0]
+
+    def error_bound(self):
+        """Гарантия алгоритма: total / capacity"""
+        return self.total / self.capacity
+
+    def estimate(self, word):
+        entry = self.counters.get(word)
+        return entry[0] if entry is not None else self.max_error()
+
+    def top(self, k):
+        """[(слово, оценка, ошибка), ...] по убыванию оценки"""
+        ranked = heapq.nlargest(k, self.counters.items(), key=lambda item: item[1][0])
+        return [(word, count, error) for word, (count, error) in ranked]
+
+    def guaranteed(self, k):
+        """Сколько первых слов топа-k точно стоят на своих местах среди всех слов"""
+        ranked = self.top(k + 1)
+        for i in range(min(k, len(ranked))):
+            rest = ranked[i + 1][1] if i + 1 < len(ranked) else self.max_error()
+            if ranked[i][1] - ranked[i][2] < rest:
+                return i
+        return min(k, len(ranked))
+
+    def to_bytes(self):
+        out = bytearray(_HEADER.pack(FORMAT_VERSION, self.capacity, self.total))
+        for word, (count, error) in self.counters.items():
+            raw = word.encode("utf-8")
+            _write_varint(out, count)
+            _write_varint(out, error)
+            _write_varint(out, len(raw))
+            out += raw
+        return zlib.compress(bytes(out))
+
+    @classmethod
+    def from_bytes(cls, blob):
+        data = zlib.decompress(blob)
+        version, capacity, total = _HEADER.unpack_from(data)
+        if version != FORMAT_VERSION:
+            raise ValueError(f"Неизвестный формат сводки слов: {version}")
+        sketch = cls(capacity, total)
+        pos = _HEADER.size
+        while pos < len(data):
+            count, pos = _read_varint(data, pos)
+            error, pos = _read_varint(data, pos)
+            length, pos = _read_varint(data, pos)
+            sketch.counters[data[pos:pos + length].decode("utf-8")] = [count, error]
+            pos += length
+        sketch._rebuild_heap()
+        return sketch
+
+
+class WordSketches:
+    def __init__(self, pool, promote_at=WORD_SKETCH_PROMOTE_AT, epsilon=WORD_SKETCH_EPSILON,
+                 cache_chats=WORD_SKETCH_CACHE_CHATS, rollup_words=WORD_SKETCH_ROLLUP_WORDS):
+        self.pool = pool
+        self.promote_at = promote_at
+        self.epsilon = epsilon
+        self.capacity = max(1, math.ceil(1 / epsilon))
+        self.cache_chats = cache_chats
+        self.rollup_words = rollup_words
+        self.cache = OrderedDict()       # chat_id -> (version, SpaceSaving)
+        self.vocabulary = OrderedDict()  # chat_id -> строк в word_stats (приблизительно)
+        self._counting = set()
+        self._promoting = set()
+        self._tasks = set()
+
+        self.promotions = 0
+        self.words_folded = 0
+        self.sketch_updates = 0
+        self.rollup_skipped = 0
+        self.loads = 0
+
+    # --- сводки в базе ---
+
+    def _cached(self, chat_id, version):
+        cached = self.cache.get(chat_id)
+        if cached is None or cached[0] != version:
+            return None
+        self.cache.move_to_end(chat_id)
+        return cached[1]
+
+    def _remember(self, chat_id, version, sketch):
+        self.cache[chat_id] = (version, sketch)
+        self.cache.move_to_end(chat_id)
+        while len(self.cache) > self.cache_chats:
+            self.cache.popitem(last=False)
+
+    async def _sketches(self, conn, versions):
+        """Сводки чатов нужных версий: из кэша или из базы"""
+        sketches = {chat_id: self._cached(chat_id, version) for chat_id, version in versions.items()}
+        missing = [chat_id for chat_id, sketch in sketches.items() if sketch is None]
+        if missing:
+            for row in await LOAD_SKETCHES.fetch(conn, missing):
+                sketch = SpaceSaving.from_bytes(row['data'])
+                self._remember(row['chat_id'], row['version'], sketch)
+                sketches[row['chat_id']] = sketch
+            self.loads += len(missing)
+        return sketches
+
+    async def apply(self, conn, words):
+        """В транзакции сброса: дельты слов переведенных чатов уходят в их сводки.
+        Возвращает (дельты для word_stats, итоги для лидербордов, дельты для корзин stats_rollup)"""
+        await conn.execute('SELECT pg_advisory_xact_lock_shared($1)', WORDS_LOCK)
+        rows = await LOCK_SKETCHES.fetch(conn, list({key[0] for key in words}))
+        if not rows:
+            return words, [], words
+        versions = {row['chat_id']: row['version'] for row in rows}
+        sketches = await self._sketches(conn, versions)
+
+        exact = {}
+        totals = []
+        for key, delta in words.items():
+            sketch = sketches.get(key[0])
+            if sketch is None:
+                exact[key] = delta
+            else:
+                totals.append((key[0], "word", key[1], None, sketch.offer(key[1], delta)))
+
+        rollup = dict(exact)
+        top_words = {
+            chat_id: {word for word, _, _ in sketch.top(self.rollup_words)} for chat_id, sketch in sketches.items()
+        }
+        for key, delta in words.items():
+            if key[0] in top_words:
+                if key[1] in top_words[key[0]]:
+                    rollup[key] = delta
+                else:
+                    self.rollup_skipped += 1
+
+        chat_ids = list(sketches)
+        await SAVE_SKETCHES.execute(
+            conn, chat_ids, [sketches[c].to_bytes() for c in chat_ids], [sketches[c].total for c in chat_ids],
+        )
+        # Если транзакция не зафиксируется, сброс вызовет invalidate для этих чатов
+        for chat_id in chat_ids:
+            self._remember(chat_id, versions[chat_id] + 1, sketches[chat_id])
+        self.sketch_updates += len(words) - len(exact)
+        return exact, totals, rollup
+
+    def invalidate(self, chat_ids):
+        """Сброс не удался: сводки в памяти могли уйти вперед базы"""
+        for chat_id in chat_ids:
+            self.cache.pop(chat_id, None)
+
+    def forget(self, chat_id):
+        self.cache.pop(chat_id, None)
+        self.vocabulary.pop(chat_id, None)
+
+    # --- источник лидерборда слов ---
+
+    async def top_rows(self, conn, chat_id, kind, limit):
+        """Топ слов переведенного чата в виде строк лидерборда; None, если чат считается точно"""
+        rows = await LOAD_SKETCHES.fetch(conn, [chat_id])
+        if not rows:
+            return None
+        row = rows[0]
+        sketch = self._cached(chat_id, row['version'])
+        if sketch is None:
+            sketch = SpaceSaving.from_bytes(row['data'])
+            self._remember(chat_id, row['version'], sketch)
+        return [{"kind": kind, "key": word, "label": None, "count": count} for word, count, _ in sketch.top(limit)]
+
+    async def all_top_rows(self, conn, kind, limit):
+        """Топ слов всех переведенных чатов для полного пересчета лидербордов"""
+        rows = []
+        async with conn.transaction():
+            async for row in conn.cursor('SELECT chat_id, data FROM word_sketches'):
+                sketch = SpaceSaving.from_bytes(row['data'])
+                rows += [(row['chat_id'], kind, word, None, count) for word, count, _ in sketch.top(limit)]
+        return rows
+
+    # --- перевод чатов ---
+
+    def note_new_words(self, counts):
+        """После сброса: сколько новых строк word_stats появилось у каждого чата"""
+        if not self.promote_at:
+            return
+        for chat_id, added in counts.items():
+            if chat_id in self._promoting:
+                continue
+            known = self.vocabulary.get(chat_id)
+            if known is None:
+                if chat_id not in self._counting:
+                    self._counting.add(chat_id)
+                    self._spawn(self._count(chat_id))
+                continue
+            self.vocabulary[chat_id] = known + added
+            self.vocabulary.move_to_end(chat_id)
+            self._check(chat_id)
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _count(self, chat_id):
+        try:
+            async with self.pool.acquire() as conn:
+                self.vocabulary[chat_id] = await conn.fetchval('SELECT count(*) FROM word_stats WHERE chat_id=$1', chat_id)
+            while len(self.vocabulary) > WORD_VOCABULARY_MAX_CHATS:
+                self.vocabulary.popitem(last=False)
+            self._check(chat_id)
+        except Exception as e:
+            logger.warning("Ошибка подсчета словаря чата: %s", e, extra=fields(chat_id=chat_id))
+        finally:
+            self._counting.discard(chat_id)
+
+    def _check(self, chat_id):
+        if self.vocabulary.get(chat_id, 0) >= self.promote_at and chat_id not in self._promoting:
+            self._promoting.add(chat_id)
+            self._spawn(self._promote_task(chat_id))
+
+    async def _promote_task(self, chat_id):
+        try:
+            await self.promote(chat_id)
+        except Exception as e:
+            logger.warning("Ошибка перевода чата на приближенный подсчет слов: %s", e, extra=fields(chat_id=chat_id))
+        finally:
+            self._promoting.discard(chat_id)
+
+    async def promote(self, chat_id):
+        """Сворачивает word_stats чата в сводку; False, если чат уже переведен"""
+        started = time.monotonic()
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute('SELECT pg_advisory_xact_lock($1)', WORDS_LOCK)
+                if await conn.fetchval('SELECT 1 FROM word_sketches WHERE chat_id=$1', chat_id):
+                    self.vocabulary.pop(chat_id, None)
+                    return False
+                rows = await conn.fetch('DELETE FROM word_stats WHERE chat_id=$1 RETURNING word, count', chat_id)
+                sketch = SpaceSaving.from_counts(self.capacity, [(r['word'], r['count']) for r in rows])
+                await conn.execute(
+                    'INSERT INTO word_sketches (chat_id, capacity, total, version, data) VALUES ($1, $2, $3, 0, $4)',
+                    chat_id, sketch.capacity, sketch.total, sketch.to_bytes(),
+                )
+        self._remember(chat_id, 0, sketch)
+        self.vocabulary.pop(chat_id, None)
+        self.promotions += 1
+        self.words_folded += len(rows)
+        logger.info(
+            "Чат переведен на приближенный подсчет слов",
+            extra=fields(chat_id=chat_id, words=len(rows), capacity=sketch.capacity, seconds=round(time.monotonic() - started, 2)),
+        )
+        return True
+
+    async def stop(self):
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def collect(self):
+        yield "word_sketch_promotions_total", "counter", "Чаты, переведенные на приближенный подсчет слов", [({}, self.promotions)]
+        yield "word_sketch_folded_words_total", "counter", "Строки word_stats, свернутые в сводки", [({}, self.words_folded)]
+        yield "word_sketch_updates_total", "counter", "Дельты слов, записанные в сводки", [({}, self.sketch_updates)]
+        yield "word_sketch_rollup_skipped_total", "counter", "Дельты слов вне топа сводки, не записанные в корзины", [({}, self.rollup_skipped)]
+        yield "word_sketch_cached", "gauge", "Сводки слов в памяти", [({}, len(self.cache))]
+
+    def stats(self):
+        return {
+            "promote_at": self.promote_at,
+            "epsilon": self.epsilon,
+            "capacity": self.capacity,
+            "cached_sketches": len(self.cache),
+            "tracked_vocabularies": len(self.vocabulary),
+            "promoting": len(self._promoting),
+            "promotions": self.promotions,
+            "words_folded": self.words_folded,
+            "sketch_updates": self.sketch_updates,
+            "rollup_words": self.rollup_words,
+            "rollup_skipped": self.rollup_skipped,
+            "loads": self.loads,
+        }
+
+
+# --- сравнение с точным подсчетом ---
+
+def compare(word_lists, epsilon=WORD_SKETCH_EPSILON, top=10):
+    """Точные счетчики и Space-Saving по одному потоку лемм"""
+    exact = Counter()
+    sketch = SpaceSaving.for_epsilon(epsilon)
+    for words in word_lists:
+        for word in words:
+            exact[word] += 1
+            sketch.offer(word)
+
+    exact_top = exact.most_common(top)
+    sketch_top = sketch.top(top)
+    errors = [count - exact[word] for word, (count, _) in sketch.counters.items()]
+    exact_bytes = sum(len(word.encode("utf-8")) + 8 for word in exact)
+    return {
+        "words": sketch.total,
+        "vocabulary": len(exact),
+        "capacity": sketch.capacity,
+        "error_bound": round(sketch.error_bound(), 1),
+        "max_error": max(errors, default=0),
+        "mean_error": round(sum(errors) / len(errors), 2) if errors else 0.0,
+        "top_recall": len({w for w, _ in exact_top} & {w for w, _, _ in sketch_top}) / len(exact_top) if exact_top else 1.0,
+        "top_same_order": [w for w, _ in exact_top] == [w for w, _, _ in sketch_top],
+        "top_guaranteed": sketch.guaranteed(top),
+        "sketch_bytes": len(sketch.to_bytes()),
+        "exact_bytes": exact_bytes,
+        "exact_top": exact_top,
+        "sketch_top": [(w, c) for w, c, _ in sketch_top],
+    }
+
+
+def _synthetic_texts(count, tail=0.05, seed=42):
+    """Сообщения корпуса бенчмарков с примесью уникальных слов (опечатки, имена)"""
+    from benchmarks.corpus import ChatCorpus
+
+    corpus = ChatCorpus(chats=1, seed=seed)
+    for _ in range(count):
+        text = corpus.text()
+        if corpus.random.random() < tail:
+            text += f" слово{corpus.random.randrange(10 ** 9)}"
+        yield text
+
+
+async def _chat_texts(pool, chat_id):
+    texts = []
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            async for row in conn.cursor(
+                'SELECT content FROM message_stats WHERE chat_id=$1 AND content IS NOT NULL ORDER BY created_at, message_id', chat_id,
+            ):
+                texts.append(row['content'])
+    return texts
+
+
+def _print_comparison(result):
+    print(f"Слов: {result['words']}, различных: {result['vocabulary']}, счетчиков в сводке: {result['capacity']}")
+    print(f"Ошибка оценки: граница {result['error_bound']}, максимум {result['max_error']}, в среднем {result['mean_error']}")
+    print(f"Топ: совпало {result['top_recall']:.0%}, порядок {'совпадает' if result['top_same_order'] else 'отличается'}, "
+          f"гарантированы первые {result['top_guaranteed']}")
+    print(f"Размер: сводка {result['sketch_bytes']} байт, точные счетчики ~{result['exact_bytes']} байт")
+    print("Точно:    " + ", ".join(f"{w} {c}" for w, c in result['exact_top']))
+    print("Сводка:   " + ", ".join(f"{w} {c}" for w, c in result['sketch_top']))
+
+
+async def _main(argv):
+    import dotenv
+    from db import create_pool
+    from text_analysis import lemmatizer
+
+    dotenv.load_dotenv()
+    parser = argparse.ArgumentParser(prog="python word_sketches.py")
+    commands = parser.add_subparsers(dest="command", required=True)
+    compare_parser = commands.add_parser("compare", help="сравнить сводку с точным подсчетом")
+    compare_parser.add_argument("chat_id", type=int, nargs="?")
+    compare_parser.add_argument("--synthetic", type=int, metavar="N", help="N сообщений корпуса бенчмарков вместо чата")
+    compare_parser.add_argument("--epsilon", type=float, default=WORD_SKETCH_EPSILON)
+    compare_parser.add_argument("--top", type=int, default=10)
+    promote_parser = commands.add_parser("promote", help="перевести чат на приближенный подсчет")
+    promote_parser.add_argument("chat_id", type=int)
+    args = parser.parse_args(argv[1:])
+
+    if args.command == "compare" and args.synthetic:
+        texts = list(_synthetic_texts(args.synthetic))
+        _print_comparison(compare(lemmatizer.analyze_many(texts), args.epsilon, args.top))
+        return 0
+    if args.command == "compare" and args.chat_id is None:
+        parser.error("нужен chat_id или --synthetic")
+
+    pool = await create_pool(os.getenv("DATABASE_URL"), min_size=1, max_size=2)
+    try:
+        if args.command == "promote":
+            promoted = await WordSketches(pool).promote(args.chat_id)
+            print("✅ Чат переведен" if promoted else "Чат уже переведен")
+        else:
+            # Текст старых сообщений мог быть удален политикой хранения
+            texts = await _chat_texts(pool, args.chat_id)
+            print(f"Сообщений с текстом: {len(texts)}")
+            _print_comparison(compare(lemmatizer.analyze_many(texts), args.epsilon, args.top))
+    finally:
+        await pool.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(_main(sys.argv)))